@@ -0,0 +1,804 @@
+#!/usr/bin/python
+
+# final_benchmark.py - Controller micro-benchmarks for the CSE 150 final project
+# Kyle Won, UCSC
+# kwon, 1724327
+# CSE 150 Final Project
+#
+# Needs POX on the path but not a running controller or Mininet:
+#   $ PYTHONPATH=<pox directory> python final_benchmark.py [benchmark ...]
+
+import json
+import os
+import random
+import resource
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import namedtuple
+
+import pox.lib.packet as pkt
+from pox.lib.addresses import IPAddr
+import final_campus
+import final_controller
+import final_matrix
+import final_policy
+import final_replay
+import final_routing
+from final_controller import Final, MessageBatcher
+from final_policy import ALLOW, DROP, FORWARD
+
+# Hosts of the final_topology network plus an address the policy does not know
+def topologyHosts():
+  hosts = []
+  for switchConnections in (final_controller.DataCenterSwitchConnections,
+                            final_controller.Floor1Switch1Connections,
+                            final_controller.Floor1Switch2Connections,
+                            final_controller.Floor2Switch1Connections):
+    hosts += sorted(switchConnections)
+  hosts += ["104.24.32.100", "108.44.83.103"]
+  hosts += ["40.2.5.%d" % i for i in range(1, 7)]
+  hosts.append("8.8.8.8")
+  return hosts
+
+# Builds a parsed ethernet/ipv4 packet of the given IP protocol
+def buildIPPacket(srcip, dstip, protocol):
+  ip = pkt.ipv4(srcip=srcip, dstip=dstip, protocol=protocol)
+  if protocol == pkt.ipv4.ICMP_PROTOCOL:
+    ip.payload = pkt.icmp()
+  elif protocol == pkt.ipv4.TCP_PROTOCOL:
+    ip.payload = pkt.tcp(srcport=40000, dstport=80)
+  eth = pkt.ethernet(type=pkt.ethernet.IP_TYPE)
+  eth.payload = ip
+  return eth
+
+# Every (packet, switch_id) combination of all host pairs, protocols and switches
+def allPairsWorkload():
+  hosts = topologyHosts()
+  workload = []
+  for protocol in (pkt.ipv4.ICMP_PROTOCOL, pkt.ipv4.TCP_PROTOCOL, pkt.ipv4.UDP_PROTOCOL):
+    for src in hosts:
+      for dst in hosts:
+        if src == dst:
+          continue
+        packet = buildIPPacket(src, dst, protocol)
+        for switch_id in range(1, 7):
+          workload.append((packet, switch_id))
+  return workload
+
+# Stand-ins for the LinkEvent openflow.discovery raises and the link it carries
+DiscoveryLink = namedtuple("DiscoveryLink", "dpid1 port1 dpid2 port2")
+LinkEvent = namedtuple("LinkEvent", "link added")
+
+class NullConnection (object):
+  """
+  Connection stand-in for benchmarks that only classify packets.
+  """
+  dpid = 1
+
+  def addListeners(self, listener):
+    pass
+
+  def send(self, msg):
+    pass
+
+# Runs classify over the workload for at least minSeconds, returns decisions/sec
+def timeDecisions(classify, workload, minSeconds = 1.0):
+  decisions = 0
+  start = time.time()
+  elapsed = 0
+  while elapsed < minSeconds:
+    for packet, switch_id in workload:
+      classify(packet, switch_id)
+    decisions += len(workload)
+    elapsed = time.time() - start
+  return decisions / elapsed
+
+# Compares the compiled policy classifier with the original if/elif chain
+def benchmarkClassifier():
+  final = Final(NullConnection(), final_controller.compilePolicy())
+  workload = allPairsWorkload()
+  mismatches = 0
+  for packet, switch_id in workload:
+    if final.classify(packet, switch_id) != final.classifyLegacy(packet, switch_id):
+      mismatches += 1
+  print "Classifier: %d decisions in workload, %d mismatches" % (len(workload), mismatches)
+  legacy = timeDecisions(final.classifyLegacy, workload)
+  compiled = timeDecisions(final.classify, workload)
+  print "  legacy:   %10.0f decisions/sec" % legacy
+  print "  compiled: %10.0f decisions/sec (%.1fx)" % (compiled, compiled / legacy)
+  return mismatches == 0
+
+# Outcome of the highest priority rule a switch would apply, (action, port)
+def ruleOutcome(rules, srcip, dstip, protocol):
+  rule = final_policy.lookupFlowRules(rules, srcip, dstip, protocol)
+  if rule is None:
+    return None
+  return (rule.action, rule.port)
+
+# Checks that destination-prefix rules give the same outcome as per-pair rules for
+# every host pair and protocol on every switch, and reports the flow count saving
+def benchmarkAggregation():
+  policy = final_controller.compilePolicy()
+  hosts = [final_policy.ipToInt(host) for host in final_controller.knownHosts()]
+  mismatches = 0
+  print "Aggregation: flows per switch, per-pair vs destination prefix"
+  for switch_id in range(1, 7):
+    pairRules = policy.pairRules(switch_id, final_controller.knownHosts(), 100)
+    aggregateRules = policy.aggregateRules(switch_id, 100)
+    for src in hosts:
+      for dst in hosts:
+        if src == dst:
+          continue
+        for protocol in final_policy.CLASS_PROTOCOL_NUMBERS:
+          if ruleOutcome(pairRules, src, dst, protocol) != \
+             ruleOutcome(aggregateRules, src, dst, protocol):
+            mismatches += 1
+    print "  s%d: %4d -> %3d flows (%.0f%% fewer)" % (
+      switch_id, len(pairRules), len(aggregateRules),
+      100.0 * (len(pairRules) - len(aggregateRules)) / len(pairRules))
+  print "  %d outcome mismatches" % mismatches
+  return mismatches == 0
+
+# Repeated PacketIns for the same flows with and without the decision cache
+def benchmarkCache():
+  policy = final_controller.compilePolicy()
+  uncached = Final(NullConnection(), policy)
+  cache = final_policy.DecisionCache(8192, final_controller.timeout)
+  cached = Final(NullConnection(), policy, cache=cache)
+  workload = allPairsWorkload()
+  mismatches = 0
+  for packet, switch_id in workload:
+    if cached.classify(packet, switch_id, 1) != uncached.classify(packet, switch_id, 1):
+      mismatches += 1
+  classifyCached = lambda packet, switch_id: cached.classify(packet, switch_id, 1)
+  print "Decision cache: %d flows, %d mismatches" % (len(workload), mismatches)
+  print "  uncached: %10.0f decisions/sec" % timeDecisions(uncached.classify, workload)
+  print "  cached:   %10.0f decisions/sec" % timeDecisions(classifyCached, workload)
+  print "  %s" % cache.stats()
+  return mismatches == 0
+
+# Times parse over every frame for at least minSeconds, returns microseconds per frame
+def timeParse(parse, frames, minSeconds = 1.0):
+  parsed = 0
+  start = time.time()
+  elapsed = 0
+  while elapsed < minSeconds:
+    for frame in frames:
+      parse(frame)
+    parsed += len(frames)
+    elapsed = time.time() - start
+  return elapsed / parsed * 1e6
+
+# Per-packet parse cost of the full POX parser vs the raw header fast path
+def benchmarkParser():
+  frames = list(set(packet.pack() for packet, switch_id in allPairsWorkload()))
+  mismatches = 0
+  for frame in frames:
+    ip = pkt.ethernet(frame).find('ipv4')
+    headers = final_controller.parseRawHeaders(frame)
+    if headers is None or headers[1:] != (ip.protocol, ip.srcip.toUnsigned(),
+                                          ip.dstip.toUnsigned()):
+      mismatches += 1
+  # What the controller needs from each path: the packet and its headers
+  def fullParse(frame):
+    packet = pkt.ethernet(frame)
+    packet.find('arp')
+    packet.find('ipv4')
+  print "Parser: %d frames, %d mismatches" % (len(frames), mismatches)
+  print "  full POX parse: %6.2f us/packet" % timeParse(fullParse, frames)
+  print "  raw fast path:  %6.2f us/packet" % timeParse(final_controller.parseRawHeaders, frames)
+  return mismatches == 0
+
+# Replay scenarios through the emulated network (see final_replay.py), failing if
+# any is worse than its final_replay.Baselines entry
+def benchmarkReplay():
+  reports, ok = final_replay.runSuite(check=True)
+  return ok
+
+# Controller delay (queueing plus handling) of well-behaved hosts' PacketIns while
+# the untrusted host floods the controller with a TCP scan and non-IP frames faster
+# than it can handle them, without and with PacketIn limits
+def benchmarkOverload(rate = 500, floodRate = 20000):
+  attacker = "108.44.83.103"
+  good = final_replay.paced(final_replay.allPairsTCP(1), rate)
+  count = int(good[-1][3] * floodRate / 2)
+  flood = final_replay.interleave(
+    final_replay.paced(final_replay.tcpScan(count, attacker), floodRate / 2),
+    final_replay.paced(final_replay.nonIPFlood(count, attacker), floodRate / 2))
+  hosts = set(final_policy.ipToInt(host) for host in final_controller.knownHosts())
+  hosts.discard(final_policy.ipToInt(attacker))
+  limits = {"port_rate": "100/50", "source_rate": "100/50"}
+  ok = True
+  print "Overload: %d well-behaved frames at %d/sec, %d flood frames at %d/sec" % (
+    len(good), rate, 2 * count, floodRate)
+  for name, frames, options in (("no flood", good, {}),
+                                ("flood", final_replay.interleave(good, flood), {}),
+                                ("flood, limited", final_replay.interleave(good, flood), limits)):
+    options = final_controller.finalOptions(**options)
+    replay = final_replay.Replay(**options)
+    report = replay.run(frames)
+    print "  %-15s well-behaved p50 %9.1f us, p99 %9.1f us; %5d PacketIns" % (
+      name, replay.stats.delayPercentile(0.50, hosts) * 1e6,
+      replay.stats.delayPercentile(0.99, hosts) * 1e6, report["packet_ins"])
+    limiter = options["limiter"]
+    if limiter is not None:
+      print "    %s" % options["metrics"].snapshot()["limiter"]
+      # Only the attacker's port and address may have been refused
+      location = final_controller.hostLocations()[attacker]
+      for kind, dpid, key, refused in limiter.topLimited(None):
+        if (dpid, key) != location and key != final_policy.ipToInt(attacker):
+          print "    refused %d PacketIns from well-behaved %s %s on s%d" % (
+            refused, kind, key, dpid)
+          ok = False
+  return ok
+
+# Replays frames and returns how much PacketIns, flow mods and deliveries grew
+def replayDelta(replay, frames):
+  before = replay.stats.report()
+  after = replay.run(frames)
+  return dict((key, after[key] - before[key])
+              for key in ("packet_ins", "flow_mods", "delivered", "dropped"))
+
+# spec with two access rules changed: Trusted Host may use TCP to the Web Server
+# again and host1 may no longer ping it
+def changedPolicySpec(spec):
+  changed = final_policy.PolicySpec.fromDocument(spec.toDocument())
+  changed.accessRules = [rule for rule in changed.accessRules if rule[1] != "TCP"]
+  changed.accessRules.append((None, "ICMP", "10.2.7.10/32", "30.1.4.66/32", DROP))
+  return changed
+
+# spec with a rule put first that lets the untrusted host use TCP to the Web Server,
+# which an "IP" rule drops: those drops do not match on the IP protocol
+def openedPolicySpec(spec):
+  changed = final_policy.PolicySpec.fromDocument(spec.toDocument())
+  changed.accessRules.insert(0, (None, "TCP", "108.44.83.103/32", "30.1.4.66/32", ALLOW))
+  return changed
+
+# spec with one more drop rule at the end: host1 may no longer use TCP to the Web
+# Server
+def appendedPolicySpec(spec):
+  changed = final_policy.PolicySpec.fromDocument(spec.toDocument())
+  changed.accessRules.append((None, "TCP", "10.2.7.10/32", "30.1.4.66/32", DROP))
+  return changed
+
+# An ICMP and a TCP frame between every pair of known hosts, from the source's port
+def pairFrames():
+  locations = final_controller.hostLocations()
+  frames = []
+  for protocol in (pkt.ipv4.ICMP_PROTOCOL, pkt.ipv4.TCP_PROTOCOL):
+    for src in final_controller.knownHosts():
+      for dst in final_controller.knownHosts():
+        if src != dst:
+          frames.append(locations[src] + (final_replay.ipFrame(src, dst, protocol),))
+  return frames
+
+# Hot-reloads the policy of options (see final_controller.finalOptions) from a
+# policy document, as a PolicyWatcher does when the file is edited
+def reloadDocument(options, document, routing = None):
+  with tempfile.NamedTemporaryFile(suffix=".json") as policyFile:
+    json.dump(document, policyFile)
+    policyFile.flush()
+    final_controller.PolicyWatcher(policyFile.name, options, routing).reload()
+
+# Checks that final_policy.json is the built-in policy, then changes access rules
+# (see changedPolicySpec, openedPolicySpec and appendedPolicySpec) and compares a live reload (only the
+# differing flow mods) with restarting the controller: both must forward and drop
+# the same traffic afterwards
+def benchmarkReload():
+  path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "final_policy.json")
+  builtin = final_controller.builtinPolicySpec()
+  spec = final_policy.PolicySpec.load(path)
+  mismatches = 0
+  if spec.hosts != builtin.hosts or spec.switchLinks() != builtin.switchLinks():
+    mismatches += 1
+  filePolicy, builtinPolicy = spec.compile(), builtin.compile()
+  for packet, switch_id in allPairsWorkload():
+    ip = packet.find('ipv4')
+    fields = (switch_id, ip.srcip.toUnsigned(), ip.dstip.toUnsigned(), ip.protocol)
+    if filePolicy.classify(*fields) != builtinPolicy.classify(*fields):
+      mismatches += 1
+  print "Reload: %s vs built-in policy, %d mismatches" % (os.path.basename(path), mismatches)
+
+  frames = pairFrames()
+  for changeName, changed in (("two rules changed", changedPolicySpec(spec)),
+                              ("TCP allowed over an IP drop", openedPolicySpec(spec)),
+                              ("drop rule appended", appendedPolicySpec(spec))):
+    print "  %s:" % changeName
+    policy = changed.compile(filePolicy)
+    changes = final_policy.changedFlowMatches(filePolicy, policy)
+    for name, launchOptions in (("reactive", {}), ("proactive", {"proactive": True}),
+                                ("aggregate", {"aggregate": True})):
+      replay = final_replay.Replay(**final_controller.finalOptions(**launchOptions))
+      replay.run(frames)
+      before = replay.stats.flow_mods
+      for final in replay.finals.values():
+        final.updatePolicy(policy, changed.knownHosts(), changes)
+      replay.flush()
+      reloadMods = replay.stats.flow_mods - before
+      reloaded = replayDelta(replay, frames)
+      options = final_controller.finalOptions(**launchOptions)
+      options["policy"] = policy
+      restart = final_replay.Replay(**options)
+      restarted = replayDelta(restart, frames)
+      if (reloaded["delivered"], reloaded["dropped"]) != \
+         (restarted["delivered"], restarted["dropped"]):
+        mismatches += 1
+      # A rule set replaced in place must never cost more than installing it afresh
+      if name != "reactive" and reloadMods + reloaded["flow_mods"] > restart.stats.flow_mods:
+        mismatches += 1
+      print "    %-9s reload: %4d flow mods, %4d PacketIns; restart: %4d flow mods, " \
+            "%4d PacketIns; %d/%d delivered" % (
+        name, reloadMods + reloaded["flow_mods"], reloaded["packet_ins"],
+        restart.stats.flow_mods, restarted["packet_ins"], reloaded["delivered"],
+        restarted["delivered"])
+
+  # A file that loads but is wrong (a link without its second port) must leave the
+  # running policy in place
+  options = final_controller.finalOptions(policy_file=path)
+  document = spec.toDocument()
+  document["links"][0] = document["links"][0][:3]
+  policy = options["policy"]
+  reloadDocument(options, document, final_controller.RouteUpdater(spec, options))
+  if options["policy"] is not policy:
+    mismatches += 1
+
+  # With --arp_proxy, hosts taken out of the file must no longer be answered for,
+  # unless their address was learned from ARP traffic
+  options = final_controller.finalOptions(policy_file=path, arp_proxy=True)
+  replay = final_replay.Replay(**options)
+  locations = spec.hostLocations()
+  removed, learned = sorted(spec.knownHosts())[:2]
+  replay.run([locations[learned] + (final_replay.arpRequestFrame(learned, removed),)])
+  document = spec.toDocument()
+  del document["hosts"][removed], document["hosts"][learned]
+  reloadDocument(options, document)
+  arpTable = options["arp_table"]
+  if IPAddr(removed) in arpTable or IPAddr(learned) not in arpTable:
+    mismatches += 1
+
+  # With --discovery, a link added to the file must be routed over, while a link
+  # discovery reported down stays out of the switch graph
+  options = final_controller.finalOptions(policy_file=path)
+  routing = final_controller.RouteUpdater(spec, options)
+  routing._handle_LinkEvent(LinkEvent(DiscoveryLink(6, 1, 1, 5), False))
+  document = spec.toDocument()
+  document["links"].append([2, 9, 3, 9])
+  reloadDocument(options, document, routing)
+  expected = final_policy.PolicySpec.fromDocument(document)
+  expected.links.remove((1, 5, 6, 1))
+  if options["policy"].forwardingTables != expected.compile().forwardingTables:
+    mismatches += 1
+  print "  %d mismatches" % mismatches
+  return mismatches == 0
+
+# Restarts the controller under a changed policy after traffic between every pair of
+# hosts: cold (POX clears the switches' tables and the controller starts empty) and
+# warm (--warm_restart reads the flows back and reconciles them). Both must forward
+# and drop the same traffic afterwards as a controller that always had the new policy.
+def benchmarkRestart():
+  changed = changedPolicySpec(final_controller.builtinPolicySpec())
+  frames = pairFrames()
+  mismatches = 0
+  print "Restart: traffic between all pairs, restart with two access rules changed, " \
+        "same traffic again"
+  for name, launchOptions in (("reactive", {}), ("proactive", {"proactive": True}),
+                              ("aggregate", {"aggregate": True})):
+    options = final_controller.finalOptions(**launchOptions)
+    options["policy"] = changed.compile()
+    options["hosts"] = changed.knownHosts()
+    expected = replayDelta(final_replay.Replay(**options), frames)
+    for restartName, warm in (("cold", False), ("warm", True)):
+      replay = final_replay.Replay(**final_controller.finalOptions(**launchOptions))
+      replay.run(frames)
+      options = final_controller.finalOptions(warm_restart=warm, **launchOptions)
+      options["policy"] = changed.compile()
+      options["hosts"] = changed.knownHosts()
+      before = replay.stats.flow_mods
+      replay.restart(not warm, **options)
+      restartMods = replay.stats.flow_mods - before
+      after = replayDelta(replay, frames)
+      if (after["delivered"], after["dropped"]) != (expected["delivered"], expected["dropped"]):
+        mismatches += 1
+      print "  %-9s %-4s %4d flow mods at restart, then %4d PacketIns, %4d flow mods; " \
+            "%d delivered, %d dropped" % (name, restartName, restartMods,
+                                          after["packet_ins"], after["flow_mods"],
+                                          after["delivered"], after["dropped"])
+  print "  %d mismatches" % mismatches
+  return mismatches == 0
+
+# Campus network for the routing benchmark: a ring of core switches (dpids 1..cores)
+# and edge switches dual-homed to two neighbouring cores, each edge with a /24 of
+# hosts behind it. Returns (links, {host IP: (dpid, port)}, [(prefix, dpid)]).
+def campusNetwork(cores, edges, hostsPerEdge):
+  links = []
+  for i in range(cores):
+    links.append((i + 1, 1, (i + 1) % cores + 1, 2))
+  nextPort = dict((core, 3) for core in range(1, cores + 1))
+  hosts = {}
+  routes = []
+  for i in range(edges):
+    dpid = cores + 1 + i
+    for port, core in ((1, i % cores + 1), (2, (i + 1) % cores + 1)):
+      links.append((dpid, port, core, nextPort[core]))
+      nextPort[core] += 1
+    network = "10.%d.%d" % (i // 256, i % 256)
+    routes.append((network + ".0/24", dpid))
+    for h in range(hostsPerEdge):
+      hosts["%s.%d" % (network, h + 1)] = (dpid, h + 3)
+  return links, hosts, routes
+
+# Checks the router against a full recomputation: same hop counts, and every next
+# hop leads to a switch one hop closer to the destination
+def routingMismatches(router):
+  fresh = final_routing.Router(router.links(), router.switches())
+  peers = dict(((dpid, port), neighbour) for dpid, neighbours in router.ports.items()
+               for neighbour, ports in neighbours.items() for port in ports)
+  mismatches = 0
+  for dst in router.switches():
+    dist = router.dist[dst]
+    if dist != fresh.dist[dst]:
+      mismatches += 1
+    for dpid, port in router.nextPort[dst].items():
+      if dist.get(peers.get((dpid, port))) != dist[dpid] - 1:
+        mismatches += 1
+  return mismatches
+
+# Builds next-hop and forwarding tables for a generated campus of a few hundred
+# switches, times forwarding lookups in the compiled policy, and compares
+# incremental link down/up updates with recomputing every destination
+def benchmarkRouting(cores = 8, edges = 400, hostsPerEdge = 4, flaps = 50):
+  links, hosts, routes = campusNetwork(cores, edges, hostsPerEdge)
+  start = time.time()
+  router = final_routing.Router(links)
+  buildTime = time.time() - start
+  start = time.time()
+  tables = router.forwardingTables(hosts, routes)
+  tableTime = time.time() - start
+  entries = sum(len(table) for table in tables.values())
+  print "Routing: %d switches, %d links, %d hosts" % (len(router.switches()), len(links),
+                                                     len(hosts))
+  print "  next hops:  %8.1f ms; forwarding tables: %8.1f ms, %.1f entries per switch" % (
+    buildTime * 1000, tableTime * 1000, float(entries) / len(tables))
+
+  policy = final_policy.CompiledPolicy(tables, [])
+  rng = random.Random(150)
+  ips = [final_policy.ipToInt(ip) for ip in hosts]
+  dpids = router.switches()
+  lookups = [(rng.choice(dpids), rng.choice(ips), rng.choice(ips)) for i in range(20000)]
+  mismatches = 0
+  for dpid, src, dst in lookups:
+    hostDpid, hostPort = hosts[final_policy.intToIP(dst)]
+    port = hostPort if hostDpid == dpid else router.nextHop(dpid, hostDpid)
+    if policy.classify(dpid, src, dst, pkt.ipv4.TCP_PROTOCOL) != (final_policy.FORWARD, port):
+      mismatches += 1
+  decisions = 0
+  start = time.time()
+  while time.time() - start < 1.0:
+    for dpid, src, dst in lookups:
+      policy.classify(dpid, src, dst, pkt.ipv4.TCP_PROTOCOL)
+    decisions += len(lookups)
+  print "  lookups:    %8.0f decisions/sec" % (decisions / (time.time() - start))
+
+  flapped = rng.sample(links, flaps)
+  changed = 0
+  start = time.time()
+  for link in flapped:
+    changed += len(router.linkDown(*link))
+  for link in flapped:
+    changed += len(router.linkUp(*link))
+  incremental = (time.time() - start) / (2 * flaps)
+  mismatches += routingMismatches(router)
+  start = time.time()
+  router.recompute()
+  full = time.time() - start
+  print "  link change: %7.2f ms incremental (%.1f switches rerouted), %.2f ms full " \
+        "recompute" % (incremental * 1000, float(changed) / (2 * flaps), full * 1000)
+  print "  %d mismatches" % mismatches
+  return mismatches == 0
+
+# Peak resident memory of the process so far, in MB (ru_maxrss is in KB on Linux)
+def peakMemory():
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+# Compiles the policy of a generated campus with 1000 hosts on 111 switches,
+# checks and times classification against the plan, and reports proactive flow
+# counts and memory
+def benchmarkScale(floors = 10, switchesPerFloor = 10, hostsPerSwitch = 10):
+  memory = peakMemory()
+  plan = final_campus.generateCampus(floors, switchesPerFloor, hostsPerSwitch)
+  spec = plan.policySpec()
+  start = time.time()
+  policy = spec.compile()
+  compileTime = time.time() - start
+  compileMemory = peakMemory()
+  print "Scale: %d floors, %d switches, %d hosts" % (floors, len(plan.switches),
+                                                    len(plan.hosts))
+  print "  compile: %8.1f ms, peak memory %.1f MB -> %.1f MB" % (
+    compileTime * 1000, memory, compileMemory)
+
+  # Expected verdicts: ICMP between neighbouring floors is dropped, everything else
+  # goes out of the host's port or towards its edge switch
+  router = spec.router()
+  floorOf = dict((host.ip, (host.dpid - floors - 2) // switchesPerFloor)
+                 for host in plan.hosts)
+  rng = random.Random(150)
+  lookups = []
+  for i in range(20000):
+    src, dst = rng.choice(plan.hosts), rng.choice(plan.hosts)
+    lookups.append((rng.choice(plan.switches), final_policy.ipToInt(src.ip),
+                    final_policy.ipToInt(dst.ip), rng.choice(final_policy.CLASS_PROTOCOL_NUMBERS),
+                    src, dst))
+  mismatches = 0
+  for dpid, srcip, dstip, protocol, src, dst in lookups:
+    if protocol == final_policy.ICMP_PROTOCOL and abs(floorOf[src.ip] - floorOf[dst.ip]) == 1:
+      expected = (DROP, "ICMP")
+    elif dst.dpid == dpid:
+      expected = (final_policy.FORWARD, dst.port)
+    else:
+      expected = (final_policy.FORWARD, router.nextHop(dpid, dst.dpid))
+    if policy.classify(dpid, srcip, dstip, protocol) != expected:
+      mismatches += 1
+  decisions = 0
+  start = time.time()
+  while time.time() - start < 1.0:
+    for dpid, srcip, dstip, protocol, src, dst in lookups:
+      policy.classify(dpid, srcip, dstip, protocol)
+    decisions += len(lookups)
+  print "  classify: %8.0f decisions/sec" % (decisions / (time.time() - start))
+
+  flows = [len(policy.aggregateRules(dpid, 100)) for dpid in plan.switches]
+  print "  --aggregate: %d flows in total, at most %d per switch (per host pair: over %d " \
+        "per switch)" % (sum(flows), max(flows), len(plan.hosts) * (len(plan.hosts) - 1))
+  finals = [Final(NullConnection(), policy) for dpid in plan.switches]
+  print "  peak memory with a controller per switch: %.1f MB" % peakMemory()
+  print "  %d mismatches" % mismatches
+  return mismatches == 0
+
+# Non-IP traffic between every pair of hosts with exact-match flood rules and with
+# MAC learning: PacketIns, flow mods, flow table entries and frames delivered to
+# hosts (each pair should get its frames rounds times; floods deliver more). Both
+# must reach every destination.
+def benchmarkL2(rounds = 3):
+  locations = final_controller.hostLocations()
+  pairs = len(locations) * (len(locations) - 1)
+  ok = True
+  print "L2: %d host pairs, %d rounds of non-IP frames" % (pairs, rounds)
+  for name, launchOptions in (("flood rules", {"mac_limit": 0}), ("MAC learning", {})):
+    replay = final_replay.Replay(**final_controller.finalOptions(**launchOptions))
+    report = replay.run(final_replay.l2Pairs(rounds))
+    entries = sum(len(switch.flows) + sum(len(flows) for flows in switch.exact.values())
+                  for switch in replay.switches.values())
+    ok = ok and report["delivered"] >= pairs * rounds and report["dropped"] == 0
+    print "  %-12s %5d PacketIns, %5d flow mods, %5d flow entries, %5d frames delivered" % (
+      name, report["packet_ins"], report["flow_mods"], entries, report["delivered"])
+  return ok
+
+# Switches with small flow tables: the untrusted host's ICMP sweep fills them with
+# drops, then every pair of hosts talks. Without tracking, new flows fail with
+# table full errors and their packets keep coming to the controller (or are lost
+# with the buffer); with --table_capacity the controller evicts the sweep's drops
+# to make room.
+def benchmarkCapacity(capacity = 200):
+  sweep = final_replay.icmpSweep()
+  traffic = final_replay.allPairsTCP()
+  print "Capacity: %d flows per switch, ICMP sweep then TCP between all pairs" % capacity
+  results = []
+  for name, launchOptions in (("untracked", {}), ("tracked", {"table_capacity": capacity})):
+    replay = final_replay.Replay(capacity=capacity,
+                                 **final_controller.finalOptions(**launchOptions))
+    replay.run(sweep)
+    after = replayDelta(replay, traffic)
+    evicted = sum(final.flowTable.evicted for final in replay.finals.values()
+                  if final.flowTable is not None)
+    print "  %-9s %4d PacketIns, %4d flow mods, %4d table full errors, %4d evicted, " \
+          "%3d delivered" % (name, after["packet_ins"], after["flow_mods"],
+                             replay.stats.table_full, evicted, after["delivered"])
+    results.append(after["delivered"])
+  return results[1] >= results[0]
+
+class SocketConnection (object):
+  """
+  Connection stand-in that writes messages to one end of a socket pair, with a
+  thread reading the other end as a switch would.
+  """
+  dpid = 1
+
+  def __init__ (self):
+    self.sock, self.peer = socket.socketpair()
+    self.received = 0
+    self.reader = threading.Thread(target=self._read)
+    self.reader.daemon = True
+    self.reader.start()
+
+  def _read(self):
+    while True:
+      data = self.peer.recv(65536)
+      if not data:
+        return
+      self.received += len(data)
+
+  def send(self, msg):
+    self.sock.sendall(msg if isinstance(msg, bytes) else msg.pack())
+
+  def close(self):
+    self.sock.close()
+    self.reader.join()
+
+# Time to get rules flow mods to a switch over a socket, sending each one as it is
+# built (as the PacketIn handlers do) with and without the message batcher
+def benchmarkBatching(rules = 20000):
+  plan = final_campus.generateCampus(10, 10, 10)
+  policy = plan.policySpec().compile()
+  final = Final(NullConnection(), policy, batch_messages=False)
+  msgs = [final.flowModFromRule(rule) for rule in policy.aggregateRules(1, 100)]
+  msgs = (msgs * (rules // len(msgs) + 1))[:rules]
+  size = sum(len(msg.pack()) for msg in msgs)
+  print "Batching: %d flow mods, %d bytes" % (len(msgs), size)
+  results = []
+  for name, deferred in (("unbatched", False), ("batched", True)):
+    connection = SocketConnection()
+    later = []
+    batcher = MessageBatcher(connection, deferred, later.append)
+    start = time.time()
+    for msg in msgs:
+      batcher.send(msg)
+    # The event loop would get to the flush once the handlers are done
+    for call in later:
+      call()
+    while connection.received < size:
+      time.sleep(0.0001)
+    elapsed = time.time() - start
+    connection.close()
+    print "  %-9s %7.1f ms, %8.0f rules/sec, %5d writes" % (
+      name, elapsed * 1000, len(msgs) / elapsed, batcher.writes)
+    results.append(batcher.messages)
+  return results == [len(msgs), len(msgs)]
+
+# Replays the scenarios and checks the controller's metrics agree with the replay's
+# own counts, then times the cost of recording a PacketIn
+def benchmarkMetrics(calls = 200000):
+  options = final_controller.finalOptions(table_capacity=1500, source_rate=1000)
+  metrics = options["metrics"]
+  replay = final_replay.Replay(**options)
+  for name in sorted(final_replay.Scenarios):
+    replay.run(final_replay.Scenarios[name]())
+  snapshot = metrics.snapshot()
+  packetIns = sum(count for ports in snapshot["packet_ins"].values()
+                  for actions in ports.values() for count in actions.values())
+  flowMods = sum(count for classes in snapshot["flow_mods"].values()
+                 for count in classes.values())
+  latency = snapshot["latency"]
+  print "Metrics: %d PacketIns (replay %d), %d flow mods (replay %d)" % (
+    packetIns, replay.stats.packet_ins, flowMods, replay.stats.flow_mods)
+  for dpid in sorted(snapshot["packet_ins"]):
+    actions = {}
+    for counts in snapshot["packet_ins"][dpid].values():
+      for action, count in counts.items():
+        actions[action] = actions.get(action, 0) + count
+    print "  s%d: PacketIns %s; flow mods %s" % (
+      dpid, ", ".join("%s %d" % item for item in sorted(actions.items())),
+      ", ".join("%s %d" % item for item in sorted(snapshot["flow_mods"].get(dpid, {}).items())))
+  print "  latency: p50 < %d us, p99 < %d us, max %.0f us; %d events, %d sampled" % (
+    latency["p50_us"], latency["p99_us"], latency["max_us"], snapshot["events"],
+    len(metrics.takeEvents()))
+  for name in ("cache", "mac_table", "limiter"):
+    print "  %s: %s" % (name, snapshot[name])
+  tables = snapshot["flow_table"]
+  print "  flow tables: %s" % ", ".join("s%d %d/%d" % (
+    dpid, tables[dpid]["entries"], tables[dpid]["capacity"]) for dpid in sorted(tables))
+  # The components' counters must be the live ones
+  watched = snapshot["cache"] == options["cache"].stats() and \
+            snapshot["limiter"]["admitted"] == options["limiter"].admitted and \
+            sorted(tables) == sorted(replay.switches)
+
+  # Cost per PacketIn: the counter and histogram update plus one event
+  metrics = final_policy.ControllerMetrics()
+  start = time.time()
+  for i in xrange(calls):
+    metrics.packetIn(1, 2, "forward", 0.0001)
+    metrics.event(1, "allow", i, i)
+  elapsed = time.time() - start
+  print "  recording: %.2f us per PacketIn" % (elapsed / calls * 1e6)
+  return packetIns == replay.stats.packet_ins and flowMods == replay.stats.flow_mods and watched
+
+# What happens to traffic of a protocol class from src to dst, following the policy
+# hop by hop with CompiledPolicy.classify, as a final_matrix outcome character
+def referenceOutcome(policy, locations, links, hostAt, src, dst, protocolClass):
+  if src == dst:
+    return final_matrix.SELF
+  srcip, dstip = final_policy.ipToInt(src), final_policy.ipToInt(dst)
+  protocol = final_policy.CLASS_PROTOCOL_NUMBERS[protocolClass]
+  dpid, in_port = locations[src]
+  for hop in range(final_matrix.MAX_HOPS):
+    action, port = policy.classify(dpid, srcip, dstip, protocol)
+    if action == DROP:
+      return final_matrix.DENIED
+    if action != FORWARD:
+      return final_matrix.NO_ROUTE
+    if port == in_port:
+      return final_matrix.MISROUTED
+    if hostAt.get((dpid, port)) == dst:
+      return final_matrix.DELIVERED
+    if (dpid, port) not in links:
+      return final_matrix.MISROUTED
+    dpid, in_port = links[(dpid, port)]
+  return final_matrix.LOOP
+
+# Number of host pairs and protocols where a PolicyMatrix and referenceOutcome differ
+def matrixMismatches(spec, matrix):
+  locations = spec.hostLocations()
+  links = spec.switchLinks()
+  hostAt = dict((location, ip) for ip, location in locations.items())
+  mismatches = 0
+  for name, protocolClass in final_matrix.PROTOCOLS:
+    rows = matrix.rows(protocolClass, 0, len(matrix.hosts))
+    for i, src in enumerate(matrix.hosts):
+      for j, dst in enumerate(matrix.hosts):
+        if chr(rows[i][j]) != referenceOutcome(matrix.policy, locations, links, hostAt,
+                                               src, dst, protocolClass):
+          mismatches += 1
+  return mismatches
+
+# Checks the all-pairs matrix against following the policy hop by hop, on the final
+# topology and a small campus, then times it on a campus of 10000 hosts
+def benchmarkMatrix(floors = 10, switchesPerFloor = 20, hostsPerSwitch = 50):
+  if final_matrix.numpy is None:
+    print "Matrix: skipped, NumPy is not installed"
+    return True
+  mismatches = 0
+  for spec in (final_controller.builtinPolicySpec(),
+               final_campus.generateCampus(3, 2, 4).policySpec()):
+    mismatches += matrixMismatches(spec, final_matrix.PolicyMatrix(spec))
+  plan = final_campus.generateCampus(floors, switchesPerFloor, hostsPerSwitch)
+  spec = plan.policySpec()
+  start = time.time()
+  policy = spec.compile()
+  compiled = time.time()
+  matrix = final_matrix.PolicyMatrix(spec, policy)
+  built = time.time()
+  out = tempfile.TemporaryFile()
+  counts = matrix.write(out)
+  written = time.time()
+  pairs = len(matrix.hosts) ** 2 * len(final_matrix.PROTOCOLS)
+  print "Matrix: %d hosts, %d switches, %d host pairs x %d protocols" % (
+    len(matrix.hosts), len(matrix.switches), len(matrix.hosts) ** 2,
+    len(final_matrix.PROTOCOLS))
+  print "  compile policy: %6.1f s" % (compiled - start)
+  print "  paths:          %6.1f s" % (built - compiled)
+  print "  verdicts+write: %6.1f s, %.1fM pairs/sec, %d bytes" % (
+    written - built, pairs / (written - built) / 1e6, out.tell())
+  for name, protocolClass in final_matrix.PROTOCOLS:
+    totals = sorted(counts[name].items())
+    print "  %-4s %s" % (name, ", ".join("%s %d" % item for item in totals))
+  print "  %d mismatches with the hop by hop policy" % mismatches
+  return mismatches == 0
+
+Benchmarks = {
+  "aggregation": benchmarkAggregation,
+  "batching": benchmarkBatching,
+  "cache": benchmarkCache,
+  "capacity": benchmarkCapacity,
+  "classifier": benchmarkClassifier,
+  "l2": benchmarkL2,
+  "matrix": benchmarkMatrix,
+  "metrics": benchmarkMetrics,
+  "overload": benchmarkOverload,
+  "parser": benchmarkParser,
+  "reload": benchmarkReload,
+  "replay": benchmarkReplay,
+  "restart": benchmarkRestart,
+  "routing": benchmarkRouting,
+  "scale": benchmarkScale,
+}
+
+def main(names):
+  ok = True
+  for name in names or sorted(Benchmarks):
+    ok = Benchmarks[name]() and ok
+  return ok
+
+if __name__ == '__main__':
+  sys.exit(0 if main(sys.argv[1:]) else 1)
@@ -0,0 +1,133 @@
+#!/usr/bin/python
+
+# final_campus.py - Generated campus networks for scale testing the CSE 150 final project
+# Kyle Won, UCSC
+# kwon, 1724327
+# CSE 150 Final Project
+#
+# Lays out a campus of floors like the final project network, but as large as asked
+# for: a core switch, one distribution switch per floor and edge switches with hosts
+# on each floor, every edge switch with a subnet of its own. The plan is plain data
+# and does not need Mininet, so the controller and benchmarks can use it directly;
+# final_topology.campus_topo builds the matching Mininet network. Run on its own, it
+# prints the plan as a policy file for the controller's --policy_file:
+#   $ python final_campus.py --floors=10 --switches=10 --hosts=10 > campus.json
+
+import json
+import sys
+from collections import namedtuple
+
+import final_policy
+from final_policy import DROP
+
+# A generated host: Mininet name, IP address, prefix length of its subnet, MAC
+# address, and the switch (dpid) and port it is attached to
+CampusHost = namedtuple("CampusHost", "name ip length mac dpid port")
+
+class CampusPlan (object):
+  """
+  A generated campus network: switch dpids (switch sN is dpid N), hosts, links
+  between switches as (dpid, port, dpid, port), routes as (prefix, dpid) and
+  access rules in the controller's format.
+  """
+
+  def __init__ (self, switches, hosts, links, routes, accessRules):
+    self.switches = switches
+    self.hosts = hosts
+    self.links = links
+    self.routes = routes
+    self.accessRules = accessRules
+
+  # The plan as a final_policy.PolicySpec, forwarding tables computed from the routes
+  def policySpec(self):
+    hosts = dict((host.ip, (host.dpid, host.port, host.mac)) for host in self.hosts)
+    return final_policy.PolicySpec(hosts, list(self.links), None, list(self.accessRules),
+                                   self.routes)
+
+  def toDocument(self):
+    return self.policySpec().toDocument()
+
+# Splits a prefix into count equal subnets, rounded up to a power of two.
+# Raises ValueError if the prefix is too small.
+def splitPrefix(prefix, count):
+  network, length = final_policy.parsePrefix(prefix)
+  bits = 0
+  while 2 ** bits < count:
+    bits += 1
+  if length + bits > 32:
+    raise ValueError("%s cannot be split into %d subnets" % (prefix, count))
+  size = 2 ** (32 - length - bits)
+  return [(network + i * size, length + bits) for i in range(count)]
+
+# Generates a campus with the given number of floors, edge switches per floor and
+# hosts per edge switch. floorSubnets gives each floor's address block; by default
+# they are carved out of supernet. Each floor's block is split evenly between its
+# edge switches. By default floor i cannot send ICMP to floor i + 1 and vice versa,
+# as with Floor 1 and Floor 2 of the final project network; pass accessRules to
+# replace that.
+def generateCampus(floors = 4, switchesPerFloor = 4, hostsPerSwitch = 8,
+                   supernet = "10.0.0.0/8", floorSubnets = None, accessRules = None):
+  if floorSubnets is None:
+    floorSubnets = [final_policy.prefixString(prefix)
+                    for prefix in splitPrefix(supernet, floors)]
+  if len(floorSubnets) != floors:
+    raise ValueError("%d floor subnets given for %d floors" % (len(floorSubnets), floors))
+  core = 1
+  switches = [core]
+  hosts = []
+  links = []
+  routes = [("0.0.0.0/0", core)]
+  dpid = core + floors
+  for floor, floorSubnet in enumerate(floorSubnets):
+    # Port floor + 1 of the core to port 1 of the floor's distribution switch
+    distribution = core + 1 + floor
+    switches.append(distribution)
+    links.append((core, floor + 1, distribution, 1))
+    routes.append((floorSubnet, distribution))
+    for i, (network, length) in enumerate(splitPrefix(floorSubnet, switchesPerFloor)):
+      # Port i + 2 of the distribution switch to port 1 of the edge switch
+      dpid += 1
+      switches.append(dpid)
+      links.append((distribution, i + 2, dpid, 1))
+      routes.append((final_policy.prefixString((network, length)), dpid))
+      if hostsPerSwitch > 2 ** (32 - length) - 2:
+        raise ValueError("%d hosts do not fit in %s" % (
+          hostsPerSwitch, final_policy.prefixString((network, length))))
+      for h in range(hostsPerSwitch):
+        index = len(hosts) + 1
+        mac = ":".join("%02x" % ((index >> shift) & 0xff) for shift in range(40, -8, -8))
+        hosts.append(CampusHost("h%d" % index, final_policy.intToIP(network + h + 1),
+                                length, mac, dpid, h + 2))
+  if accessRules is None:
+    accessRules = []
+    for floor in range(floors - 1):
+      a, b = floorSubnets[floor], floorSubnets[floor + 1]
+      accessRules.append((None, "ICMP", a, b, DROP))
+      accessRules.append((None, "ICMP", b, a, DROP))
+  return CampusPlan(switches, hosts, links, routes, accessRules)
+
+# generateCampus() keyword arguments from --floors, --switches, --hosts, --supernet
+# and --floor_subnets=<prefix>,<prefix>,... command line options
+def campusOptions(args):
+  names = {"floors": "floors", "switches": "switchesPerFloor", "hosts": "hostsPerSwitch",
+           "supernet": "supernet", "floor_subnets": "floorSubnets"}
+  options = {}
+  for arg in args:
+    name, _, value = arg.lstrip("-").partition("=")
+    if name not in names:
+      raise ValueError("unknown option %s" % arg)
+    if name == "floor_subnets":
+      options[names[name]] = value.split(",")
+    elif name == "supernet":
+      options[names[name]] = value
+    else:
+      options[names[name]] = int(value)
+  return options
+
+def main(args):
+  plan = generateCampus(**campusOptions(args))
+  json.dump(plan.toDocument(), sys.stdout, indent=2, sort_keys=True, separators=(",", ": "))
+  sys.stdout.write("\n")
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
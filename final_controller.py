@@ -3,16 +3,32 @@
 # kwon, 1724327
 # CSE 150 Final Project
 
+import os
+import struct
+import time
+from collections import namedtuple
 from pox.core import core
+from pox.lib.recoco import Timer
 import pox.openflow.libopenflow_01 as of
-from pox.lib.addresses import IPAddr
+from pox.lib.addresses import IPAddr, EthAddr
+from pox.lib.util import str_to_bool
 import pox.lib.packet as pkt
+import final_policy
+from final_policy import FORWARD, DROP, IGNORE, ARP, FLOOD, ALLOW
 
-# Set debug mode to print information to console
-DEBUG_MODE = False
 log = core.getLogger()
 timeout = 50
 
+# (idle_timeout, hard_timeout) for each class of reactive rule; see final_policy.FlowTimeouts.
+# Forwarding rules stay while in use, drops and single-packet floods go away quickly.
+TimeoutProfiles = {
+  "forward": (timeout, 6 * timeout),
+  "drop": (timeout // 5, timeout),
+  "arp": (timeout, timeout),
+  "flood": (timeout // 5, timeout),
+  "unicast": (timeout // 5, timeout),
+}
+
 # For every switch in the network, map connected devices (hosts or switches) to ports
 # Used for general IP traffic routing
 CoreSwitchConnections = {
@@ -39,6 +55,255 @@ Floor2Switch1Connections = {
   "10.2.7.10": 2,
   "10.2.7.20": 3
 }
+# switch_id of each switch named in CoreSwitchConnections, and the connection map of the
+# switch's own hosts. Port 1 of every one of these switches connects to the core switch.
+SwitchIds = {
+  "DataCenterSwitch": 2,
+  "Floor1Switch1": 3,
+  "Floor1Switch2": 4,
+  "Floor2Switch1": 5,
+  "AirGappedSwitch": 6,
+}
+SwitchConnections = {
+  1: CoreSwitchConnections,
+  2: DataCenterSwitchConnections,
+  3: Floor1Switch1Connections,
+  4: Floor1Switch2Connections,
+  5: Floor2Switch1Connections,
+}
+# Air-gapped floor subnet, and the secure clients actually attached to it (see final_topology.py)
+AirGappedSubnet = "40.2.5.0/24"
+AirGappedClients = "40.2.5.0/29"
+
+# Ordered IP access rules: (switch_id or None for every switch, protocol, source prefix,
+# destination prefix, action). The first matching rule wins; allowed traffic and traffic
+# matching no rule is forwarded using the switch's connection table.
+AccessRules = [
+  # Air-gapped switch only carries traffic between secure clients
+  (6, "IP", AirGappedSubnet, AirGappedSubnet, ALLOW),
+  (6, "IP", "0.0.0.0/0", "0.0.0.0/0", DROP),
+  # Trusted Host cannot send TCP to Web Server
+  (None, "TCP", "104.24.32.100/32", "30.1.4.66/32", DROP),
+  # Untrusted Host cannot send ICMP to Floor 1, Floor 2, or Web Server
+  (None, "ICMP", "108.44.83.103/32", "20.2.1.0/24", DROP),
+  (None, "ICMP", "108.44.83.103/32", "10.2.7.0/24", DROP),
+  (None, "ICMP", "108.44.83.103/32", "30.1.4.66/32", DROP),
+  # Trusted Host cannot send ICMP traffic Floor 1 Department A, or Web Server
+  (None, "ICMP", "104.24.32.100/32", "20.2.1.0/24", DROP),
+  (None, "ICMP", "104.24.32.100/32", "30.1.4.66/32", DROP),
+  # Hosts in Floor 1 Dept. A cannot send ICMP traffic to Floor 2 Dept. B, and vice versa
+  (None, "ICMP", "20.2.1.0/24", "10.2.7.0/24", DROP),
+  (None, "ICMP", "10.2.7.0/24", "20.2.1.0/24", DROP),
+  # Untrusted Host cannot send any IP traffic to Web Server (enforced at the data center)
+  (2, "IP", "108.44.83.103/32", "30.1.4.66/32", DROP),
+]
+
+# Networks behind a switch rather than single hosts: (prefix, switch_id). The whole
+# air-gapped subnet lives behind its switch, and the core switch is the way out.
+Routes = [
+  (AirGappedSubnet, SwitchIds["AirGappedSwitch"]),
+  ("0.0.0.0/0", 1),
+]
+
+# Builds the per-switch IP forwarding tables (switch_id -> [(destination prefix, port)])
+# from shortest paths over the switch links to each host and route
+def buildForwardingTables():
+  return builtinPolicySpec().forwardingTables()
+
+# MAC address of every host, as assigned in final_topology.py (secure clients below)
+HostMACs = {
+  "30.1.4.66": "00:00:00:00:00:66",
+  "20.2.1.10": "00:00:00:00:00:01",
+  "20.2.1.20": "00:00:00:00:00:02",
+  "20.2.1.30": "00:00:00:00:00:03",
+  "20.2.1.40": "00:00:00:00:00:04",
+  "10.2.7.10": "00:00:00:00:00:05",
+  "10.2.7.20": "00:00:00:00:00:06",
+  "104.24.32.100": "00:00:00:00:00:07",
+  "108.44.83.103": "00:00:00:00:00:08",
+}
+
+# Maps every host IP address to its MAC address
+def hostMACs():
+  macs = dict(HostMACs)
+  # Same addressing as final_topo.defineSecureClients
+  network, length = final_policy.parsePrefix(AirGappedClients)
+  for i in range(1, 2 ** (32 - length) - 1):
+    macs[final_policy.intToIP(network + i)] = "00:00:00:00:00:" + str(i * 10)
+  return macs
+
+# Returns the IP address of every host in the topology
+def knownHosts():
+  return sorted(hostLocations(), key=final_policy.ipToInt)
+
+# Maps every host IP address to the (switch_id, port) it is attached to
+def hostLocations():
+  locations = {}
+  for switch_id, switchConnections in SwitchConnections.items():
+    for device, port in switchConnections.items():
+      if device not in SwitchIds:
+        locations[device] = (switch_id, port)
+  # Same addressing as final_topo.defineSecureClients
+  network, length = final_policy.parsePrefix(AirGappedClients)
+  for i in range(1, 2 ** (32 - length) - 1):
+    locations[final_policy.intToIP(network + i)] = (SwitchIds["AirGappedSwitch"], i + 1)
+  return locations
+
+# Maps (switch_id, port) of both ends of every switch-to-switch link to the other end
+def switchLinks():
+  links = {}
+  for device, port in CoreSwitchConnections.items():
+    if device in SwitchIds:
+      links[(1, port)] = (SwitchIds[device], 1)
+      links[(SwitchIds[device], 1)] = (1, port)
+  return links
+
+# Fixed-offset views of the headers the policy needs, for the raw fast path
+EthernetType = struct.Struct("!12xH")
+IPv4Header = struct.Struct("!14xB8xB2xII")  # version/IHL, protocol, source, destination
+
+# Stands in for the parsed ipv4 header when a frame was handled by the fast path
+RawIPHeader = namedtuple("RawIPHeader", "srcip dstip protocol")
+
+# Reads (ethertype, IP protocol, source, destination) straight out of a raw ethernet
+# frame without building POX packet objects. Addresses are 32-bit integers and are
+# None for ARP. Returns None for anything else (VLAN tags, other ethertypes,
+# truncated or non-IPv4 headers) so the caller can fall back to the full parser.
+def parseRawHeaders(data):
+  if data is None or len(data) < EthernetType.size:
+    return None
+  ethertype = EthernetType.unpack_from(data)[0]
+  if ethertype == pkt.ethernet.ARP_TYPE:
+    return (ethertype, None, None, None)
+  if ethertype != pkt.ethernet.IP_TYPE or len(data) < IPv4Header.size:
+    return None
+  versionLength, protocol, srcip, dstip = IPv4Header.unpack_from(data)
+  if versionLength >> 4 != 4 or versionLength & 0x0f < 5:
+    return None
+  return (ethertype, protocol, srcip, dstip)
+
+# Key of a flow in a final_policy.FlowTable: its priority and match fields
+def flowKey(match, priority):
+  return (priority, match.in_port, match.dl_src, match.dl_dst, match.dl_vlan,
+          match.dl_type, match.nw_proto, addressKey(match.get_nw_src()),
+          addressKey(match.get_nw_dst()), match.tp_src, match.tp_dst)
+
+# An (address, prefix length) of a match, with every wildcarded address the same
+def addressKey(address):
+  if address[0] is None or address[1] == 0:
+    return None
+  return address
+
+# The final_policy.FlowRule an IP flow on a switch (an ofp_flow_stats entry)
+# implements, or None if it matches on more than IP fields or does more than drop
+# or output to one port
+def ruleFromFlowStats(stats):
+  match = stats.match
+  if match.dl_type != pkt.ethernet.IP_TYPE:
+    return None
+  if (match.dl_src, match.dl_dst, match.dl_vlan, match.tp_src, match.tp_dst) != \
+     (None, None, None, None, None):
+    return None
+  ports = [action.port for action in stats.actions
+           if isinstance(action, of.ofp_action_output)]
+  if len(ports) != len(stats.actions) or len(ports) > 1:
+    return None
+  prefixes = []
+  for address, length in (match.get_nw_src(), match.get_nw_dst()):
+    if address is None or length == 0:
+      prefixes.append(None)
+    else:
+      prefixes.append(final_policy.parsePrefix("%s/%d" % (address, length)))
+  if ports:
+    return final_policy.FlowRule(stats.priority, match.nw_proto, prefixes[0], prefixes[1],
+                                 match.in_port, FORWARD, ports[0])
+  return final_policy.FlowRule(stats.priority, match.nw_proto, prefixes[0], prefixes[1],
+                               match.in_port, DROP, None)
+
+# Compiles the access rules and forwarding tables. Called once from launch()
+def compilePolicy():
+  return final_policy.CompiledPolicy(buildForwardingTables(), AccessRules)
+
+# The tables above as a final_policy.PolicySpec, the policy used without --policy_file
+# (final_policy.json holds the same policy)
+def builtinPolicySpec():
+  macs = hostMACs()
+  hosts = dict((ip, location + (macs.get(ip),)) for ip, location in hostLocations().items())
+  links = [end + peer for end, peer in sorted(switchLinks().items()) if end < peer]
+  return final_policy.PolicySpec(hosts, links, None, list(AccessRules), Routes)
+
+class MessageBatcher (object):
+  """
+  Outbound messages of one connection. With deferred set, messages queue up and
+  are packed into a single write when the event loop gets to flush(), so
+  everything sent while handling a burst of events goes out together. Otherwise
+  each send() (or sendAll() list) is written at once.
+
+  barrier() queues a barrier request: the switch finishes everything sent before
+  it before anything after it, and replies. Its callback runs on the reply;
+  pending() counts the barriers not answered yet.
+  """
+
+  def __init__ (self, connection, deferred = True, schedule = None):
+    self.connection = connection
+    self.deferred = deferred
+    self.schedule = schedule if schedule is not None else core.callLater
+    self.queue = []
+    self.scheduled = False
+    # xid of each unanswered barrier -> callback or None
+    self.barriers = {}
+    self.writes = 0
+    self.messages = 0
+
+  def send(self, msg):
+    self.queue.append(msg)
+    self._queued()
+
+  def sendAll(self, msgs):
+    if msgs:
+      self.queue.extend(msgs)
+      self._queued()
+
+  def _queued(self):
+    if not self.deferred:
+      self.flush()
+    elif not self.scheduled:
+      self.scheduled = True
+      self.schedule(self.flush)
+
+  # Queues a barrier request; callback (if any) is called once the switch replies.
+  # Returns its xid.
+  def barrier(self, callback = None):
+    msg = of.ofp_barrier_request()
+    self.barriers[msg.xid] = callback
+    self.send(msg)
+    return msg.xid
+
+  # Writes every queued message in one buffer
+  def flush(self):
+    self.scheduled = False
+    if not self.queue:
+      return
+    msgs, self.queue = self.queue, []
+    if len(msgs) == 1:
+      self.connection.send(msgs[0])
+    else:
+      self.connection.send(b''.join(msg.pack() for msg in msgs))
+    self.writes += 1
+    self.messages += len(msgs)
+
+  # Handles the reply to a barrier. Returns false if it was not one of ours.
+  def barrierReply(self, xid):
+    if xid not in self.barriers:
+      return False
+    callback = self.barriers.pop(xid)
+    if callback is not None:
+      callback()
+    return True
+
+  def pending(self):
+    return len(self.barriers)
+
 
 class Final (object):
   """
@@ -46,14 +311,372 @@ class Final (object):
   A Connection object for that switch is passed to the __init__ function.
   """
  
-  def __init__ (self, connection):
+  def __init__ (self, connection, policy = None, proactive = False, aggregate = False,
+                cache = None, fast_path = False, arp_table = None, switches = None,
+                ingress = None, timeouts = None, limiter = None, hosts = None,
+                metrics = None, macs = None, table_capacity = None,
+                batch_messages = True, warm_restart = False):
     # Keep track of the connection to the switch so that we can
     # send it messages!
     self.connection = connection
+    # Every message to the switch goes through this, written once per event loop
+    # pass when batch_messages is set
+    self.batcher = MessageBatcher(connection, batch_messages)
+
+    # Compiled access rules and forwarding tables shared by all switches
+    if policy is None:
+      policy = compilePolicy()
+    self.policy = policy
+    # Optional final_policy.DecisionCache of IP verdicts, shared by all switches
+    self.cache = cache
+    # Classify IP and ARP frames from the raw PacketIn data instead of event.parsed
+    self.fast_path = fast_path
+    # final_policy.ArpTable (IP -> MAC) shared by all switches. When set, ARP requests
+    # are answered by the controller instead of flooded.
+    self.arp_table = arp_table
+    # dpid -> Final of every connected switch, shared by all switches
+    if switches is None:
+      switches = {}
+    self.switches = switches
+    self.switches[connection.dpid] = self
+    # host IP -> (dpid, port) it is attached to. When set, drops are installed on the
+    # source's ingress port.
+    self.ingress = ingress
+    # final_policy.FlowTimeouts shared by all switches
+    if timeouts is None:
+      timeouts = final_policy.FlowTimeouts(TimeoutProfiles)
+    self.timeouts = timeouts
+    # Optional final_policy.PacketInLimiter shared by all switches
+    self.limiter = limiter
+    # IP addresses of the known hosts, for proactive per-pair rules
+    if hosts is None:
+      hosts = knownHosts()
+    self.hosts = hosts
+    # final_policy.ControllerMetrics shared by all switches
+    if metrics is None:
+      metrics = final_policy.ControllerMetrics()
+    self.metrics = metrics
+    # Optional final_policy.MacTable shared by all switches. When set, non-IP frames
+    # to learned addresses get unicast rules instead of being flooded.
+    self.macs = macs
+    # final_policy.FlowTable shadowing this switch's flows when a capacity is given
+    self.flowTable = None
+    if table_capacity is not None:
+      self.flowTable = final_policy.FlowTable(table_capacity)
+      self.metrics.watch("flow_table", self.flowTable.stats, connection.dpid)
+    self.tableFullErrors = 0
+    # final_policy.FlowRules installed by installProactiveRules, None if reactive
+    self.installedRules = None
+    self.proactive = proactive or aggregate
+    self.aggregate = aggregate
+    # True until the reply to the flow stats request of a warm restart comes in
+    self.resyncing = False
 
     # This binds our PacketIn event listener
     connection.addListeners(self)
 
+    if warm_restart:
+      # Flows left on the switch by an earlier run are kept; see resync()
+      self.resyncing = True
+      self.send(of.ofp_stats_request(body=of.ofp_flow_stats_request()))
+    elif self.proactive:
+      self.installProactiveRules(aggregate)
+
+  # Switches to a new compiled policy, dropping verdicts cached under the old one
+  def setPolicy(self, policy):
+    self.policy = policy
+    if self.cache is not None:
+      self.cache.invalidate()
+
+  # Sets the timeouts of a flow mod for its class of rule, tags it with the class
+  # cookie and records it in the shadow flow table. Adaptive timeouts need to hear
+  # when the flow is removed.
+  def setTimeouts(self, msg, ruleClass):
+    msg.idle_timeout, msg.hard_timeout = self.timeouts.get(ruleClass)
+    msg.cookie = final_policy.ruleClassCookie(ruleClass)
+    if self.timeouts.adaptive:
+      msg.flags |= of.OFPFF_SEND_FLOW_REM
+    self.trackFlow(msg, ruleClass)
+
+  # Records a flow mod about to be sent in the shadow flow table, first evicting
+  # flows if the table is nearly full. The switch is asked to report the flow's
+  # removal so the shadow stays in step.
+  def trackFlow(self, msg, ruleClass):
+    if self.flowTable is None:
+      return
+    msg.flags |= of.OFPFF_SEND_FLOW_REM
+    if self.flowTable.needsEviction():
+      self.evictFlows()
+    self.flowTable.add(flowKey(msg.match, msg.priority), ruleClass, msg.match, msg.priority,
+                       msg.idle_timeout, msg.hard_timeout, msg.xid)
+
+  # Forgets the flows a delete flow mod about to be sent removes
+  def untrackDelete(self, msg):
+    if self.flowTable is None:
+      return
+    if msg.command == of.OFPFC_DELETE_STRICT:
+      self.flowTable.remove(flowKey(msg.match, msg.priority))
+    else:
+      self.flowTable.removeCovered(msg.match.matches_with_wildcards)
+
+  # Deletes the flows the shadow flow table picks to make room (see
+  # final_policy.FlowTable.evictions)
+  def evictFlows(self):
+    msgs = []
+    for key, match, priority in self.flowTable.evictions():
+      msg = of.ofp_flow_mod(command=of.OFPFC_DELETE_STRICT)
+      msg.match = match
+      msg.priority = priority
+      msgs.append(msg)
+    if msgs:
+      self.metrics.event(self.connection.dpid, "evict", len(msgs))
+      self.metrics.flowMod(self.connection.dpid, "evict", len(msgs))
+      self.sendBatch(msgs)
+      # The room must be made before the flows that need it are added
+      self.batcher.barrier()
+
+  # Switches to a new compiled policy and set of known hosts, sending only the flow
+  # mods that differ. Proactive rules are diffed rule by rule; additions and
+  # modifications go first so no traffic misses the table while the old rules are
+  # deleted. Reactive flows covered by changes (see final_policy.changedFlowMatches)
+  # are deleted to be learned again. In proactive mode that delete would also hit
+  # the proactive rules, so leftover reactive flows are left to their timeouts.
+  def updatePolicy(self, policy, hosts, changes):
+    self.setPolicy(policy)
+    self.hosts = hosts
+    msgs = []
+    deleteMsgs = []
+    if self.installedRules is not None:
+      rules = self.proactiveRules()
+      adds, modifies, deletes = final_policy.diffRules(self.installedRules, rules)
+      msgs += [self.flowModFromRule(rule) for rule in adds]
+      for rule in modifies:
+        msg = self.flowModFromRule(rule)
+        msg.command = of.OFPFC_MODIFY_STRICT
+        msgs.append(msg)
+      for msg in msgs:
+        self.trackFlow(msg, "proactive")
+      for rule in deletes:
+        msg = self.flowModFromRule(rule)
+        msg.command = of.OFPFC_DELETE_STRICT
+        del msg.actions[:]
+        self.untrackDelete(msg)
+        deleteMsgs.append(msg)
+      self.installedRules = rules
+    else:
+      for rule in changes.get(None, []) + changes.get(self.connection.dpid, []):
+        msg = of.ofp_flow_mod(command=of.OFPFC_DELETE)
+        msg.match = self.matchFromRule(rule)
+        self.untrackDelete(msg)
+        msgs.append(msg)
+    count = len(msgs) + len(deleteMsgs)
+    log.debug("Policy update: %d flow mods for %s" % (count, self.connection))
+    if count:
+      self.metrics.flowMod(self.connection.dpid, "update", count)
+      self.sendBatch(msgs)
+      if msgs and deleteMsgs:
+        # The replacements must be in place before the old rules go
+        self.batcher.barrier()
+      self.sendBatch(deleteMsgs)
+      self.batcher.barrier()
+
+  # Builds the IP match of a final_policy.FlowRule
+  def matchFromRule(self, rule):
+    match = of.ofp_match()
+    match.dl_type = pkt.ethernet.IP_TYPE
+    if rule.protocol is not None:
+      match.nw_proto = rule.protocol
+    if rule.in_port is not None:
+      match.in_port = rule.in_port
+    if rule.src is not None:
+      match.nw_src = final_policy.prefixString(rule.src)
+    if rule.dst is not None:
+      match.nw_dst = final_policy.prefixString(rule.dst)
+    return match
+
+  # Builds a flow mod for a final_policy.FlowRule
+  def flowModFromRule(self, rule, duration = 0):
+    msg = of.ofp_flow_mod()
+    msg.cookie = final_policy.ruleClassCookie("proactive")
+    msg.priority = rule.priority
+    msg.match = self.matchFromRule(rule)
+    msg.idle_timeout = duration
+    msg.hard_timeout = duration
+    if rule.action == FORWARD:
+      msg.actions.append(of.ofp_action_output(port=rule.port))
+    # DROP: omit action to drop
+    return msg
+
+  # Computes every allow/drop/forward rule this switch needs for the known hosts and
+  # pushes them (plus the ARP flood rule) in one batch. Rules are permanent, so IP
+  # traffic between known hosts never reaches the controller. With aggregate, the
+  # rules match destination prefixes instead of every (source, destination) pair.
+  def installProactiveRules(self, aggregate = False):
+    self.aggregate = aggregate
+    self.installedRules = self.proactiveRules()
+    msgs = [self.flowModFromRule(rule) for rule in self.installedRules]
+    if self.arp_table is None:
+      # With the ARP proxy, ARP has to keep coming to the controller
+      msgs.append(self.arpFloodRule())
+    for msg in msgs:
+      self.trackFlow(msg, "proactive")
+    log.debug("Installing %d proactive rules on %s" % (len(msgs), self.connection))
+    self.metrics.flowMod(self.connection.dpid, "proactive", len(msgs))
+    self.sendBatch(msgs)
+    self.batcher.barrier(lambda: log.debug("Proactive rules installed on %s" %
+                                           (self.connection,)))
+
+  # The permanent rule flooding ARP that goes with the proactive rules
+  def arpFloodRule(self):
+    msg = of.ofp_flow_mod()
+    msg.cookie = final_policy.ruleClassCookie("proactive")
+    msg.match.dl_type = pkt.ethernet.ARP_TYPE
+    msg.actions.append(of.ofp_action_output(port=of.OFPP_FLOOD))
+    return msg
+
+  # Rebuilds this switch's state from the flows an earlier run of the controller left
+  # on it (ofp_flow_stats entries) and brings them in line with the current policy.
+  # Proactive rules are diffed against the policy's like on a policy update, so only
+  # missing ones are added and stale ones deleted. Reactive flows are kept if the
+  # policy still gives them the same verdict, and unicast rules teach the MAC table
+  # where their destinations are. Flows kept go into the shadow flow table with the
+  # time they have left. Flows without one of our cookies are left alone.
+  def resync(self, stats):
+    now = time.time()
+    dpid = self.connection.dpid
+    # Proactive rules wanted and found, by flowKey, so they are compared the way the
+    # switch matches them
+    wanted = {}
+    if self.proactive:
+      rules = self.proactiveRules()
+      msgs = [self.flowModFromRule(rule) for rule in rules]
+      if self.arp_table is None:
+        msgs.append(self.arpFloodRule())
+      wanted = dict((flowKey(msg.match, msg.priority), msg) for msg in msgs)
+      self.installedRules = rules
+    found = set()
+    kept = []
+    stale = []
+    msgs = []
+    for entry in stats:
+      ruleClass = final_policy.cookieRuleClass(entry.cookie)
+      if ruleClass is None:
+        continue
+      if ruleClass == "proactive":
+        key = flowKey(entry.match, entry.priority)
+        msg = wanted.get(key)
+        if msg is None:
+          stale.append(entry)
+          continue
+        found.add(key)
+        if list(entry.actions) == list(msg.actions):
+          kept.append((entry, ruleClass))
+        else:
+          msg.command = of.OFPFC_MODIFY_STRICT
+          msgs.append(msg)
+      elif self.flowStillValid(ruleClass, entry, now):
+        kept.append((entry, ruleClass))
+      else:
+        stale.append(entry)
+    msgs += [msg for key, msg in wanted.items() if key not in found]
+
+    deletes = []
+    for entry in stale:
+      msg = of.ofp_flow_mod(command=of.OFPFC_DELETE_STRICT)
+      msg.match = entry.match
+      msg.priority = entry.priority
+      deletes.append(msg)
+    for entry, ruleClass in kept:
+      self.trackStats(entry, ruleClass, now)
+    for msg in msgs:
+      self.trackFlow(msg, "proactive")
+
+    count = len(msgs) + len(deletes)
+    log.info("Resynchronized %s: kept %d of %d flows, %d flow mods" % (
+      self.connection, len(kept), len(stats), count))
+    self.metrics.event(dpid, "resync", len(kept), count)
+    if count:
+      self.metrics.flowMod(dpid, "resync", count)
+      self.sendBatch(msgs)
+      if msgs and deletes:
+        # The replacements must be in place before the old rules go
+        self.batcher.barrier()
+      self.sendBatch(deletes)
+      self.batcher.barrier()
+
+  # Returns true if a reactive flow found on the switch (an ofp_flow_stats entry of
+  # the given class) still agrees with the policy and options. A unicast rule that
+  # does also teaches the MAC table its destination: its output port, or for a drop
+  # of frames that are already on their destination's segment, its in_port.
+  def flowStillValid(self, ruleClass, entry, now):
+    dpid = self.connection.dpid
+    if ruleClass in ("forward", "drop"):
+      rule = ruleFromFlowStats(entry)
+      if rule is None or rule.src is None or rule.dst is None or \
+         rule.src[1] != 32 or rule.dst[1] != 32:
+        return False
+      if ruleClass == "forward":
+        return rule.protocol is not None and \
+               self.policy.classify(dpid, rule.src[0], rule.dst[0], rule.protocol) == \
+               (FORWARD, rule.port)
+      # An "IP" drop covers every protocol
+      protocols = [rule.protocol]
+      if rule.protocol is None:
+        protocols = [pkt.ipv4.ICMP_PROTOCOL, pkt.ipv4.TCP_PROTOCOL, pkt.ipv4.UDP_PROTOCOL]
+      return all(self.policy.classify(dpid, rule.src[0], rule.dst[0], protocol)[0] == DROP
+                 for protocol in protocols)
+    if ruleClass == "unicast":
+      ports = [action.port for action in entry.actions
+               if isinstance(action, of.ofp_action_output)]
+      if not entry.actions and entry.match.in_port is not None:
+        ports = [entry.match.in_port]
+      if self.macs is None or len(ports) != 1 or entry.match.dl_dst is None:
+        return False
+      self.macs.learn(dpid, entry.match.dl_dst, ports[0], now)
+      return True
+    if ruleClass == "arp":
+      # With the ARP proxy, ARP has to keep coming to the controller
+      return self.arp_table is None
+    return True
+
+  # Records a flow found on the switch in the shadow flow table
+  def trackStats(self, entry, ruleClass, now):
+    if self.flowTable is None:
+      return
+    hard = entry.hard_timeout
+    if hard:
+      hard = max(1, hard - entry.duration_sec)
+    self.flowTable.add(flowKey(entry.match, entry.priority), ruleClass, entry.match,
+                       entry.priority, entry.idle_timeout, hard)
+
+  # The proactive rules of this switch under the current policy
+  def proactiveRules(self):
+    if self.aggregate:
+      return self.policy.aggregateRules(self.connection.dpid, of.OFP_DEFAULT_PRIORITY)
+    return self.policy.pairRules(self.connection.dpid, self.hosts, of.OFP_DEFAULT_PRIORITY)
+
+  def send(self, msg):
+    self.batcher.send(msg)
+
+  # Sends several messages to the switch in a single write
+  def sendBatch(self, msgs):
+    self.batcher.sendAll(msgs)
+
+  # Sends the flow mod installed because of packet_in. A buffered packet is released
+  # by the flow mod itself. An unbuffered one would never be forwarded, leaving the
+  # host to retransmit, so its data goes along in a packet out with the same actions,
+  # written together with the flow mod.
+  def sendForPacket(self, msg, packet_in):
+    msg.buffer_id = packet_in.buffer_id
+    if packet_in.buffer_id is not None or not msg.actions or packet_in.data is None:
+      self.send(msg)
+      return
+    out = of.ofp_packet_out()
+    out.data = packet_in.data
+    out.in_port = packet_in.in_port
+    out.actions = list(msg.actions)
+    self.sendBatch([msg, out])
+
   # Returns true if destination host is contained in the given list of hosts connected to a switch
   def deviceConnectedToSwitch(self, destination, switchConnections):
     return switchConnections.get(str(destination)) is not None
@@ -64,58 +687,141 @@ class Final (object):
 
   # Accepts ARP traffic. Floods the network
   def acceptARP(self, packet, packet_in):
-    if DEBUG_MODE:
-      print "ARP packet - accept"
+    self.metrics.event(self.connection.dpid, "arp_flood_rule")
     msg = of.ofp_flow_mod()
     match = of.ofp_match()
     match.dl_type = pkt.ethernet.ARP_TYPE
     msg.match = match
-    msg.idle_timeout = timeout
-    msg.hard_timeout = timeout
-    msg.buffer_id = packet_in.buffer_id
+    self.setTimeouts(msg, "arp")
+    self.metrics.flowMod(self.connection.dpid, "arp")
     msg.actions.append(of.ofp_action_output(port=of.OFPP_FLOOD))
-    self.connection.send(msg)
+    self.sendForPacket(msg, packet_in)
+
+  # Answers an ARP request for a known address with a reply sent back out the ingress
+  # port, instead of flooding it through the network. The sender's address is learned
+  # from every ARP packet. Packets that cannot be answered are flooded once, without
+  # a flow, so that later ARP packets still reach the controller. Gratuitous ARP and
+  # duplicate address probes (sender address equal to the target, or 0.0.0.0) are
+  # never answered, since a reply would tell the host its own address is taken.
+  def proxyARP(self, packet, packet_in, in_port):
+    arp_header = packet.find('arp')
+    unspecified = arp_header.protosrc == IPAddr("0.0.0.0")
+    if not unspecified:
+      self.arp_table.learn(arp_header.protosrc, arp_header.hwsrc)
+    if (arp_header.opcode == pkt.arp.REQUEST and not unspecified
+        and arp_header.protosrc != arp_header.protodst):
+      mac = self.arp_table.get(arp_header.protodst)
+      if mac is not None:
+        self.metrics.event(self.connection.dpid, "arp_proxy_reply", arp_header.protodst)
+        reply = pkt.arp()
+        reply.opcode = pkt.arp.REPLY
+        reply.hwsrc = mac
+        reply.hwdst = arp_header.hwsrc
+        reply.protosrc = arp_header.protodst
+        reply.protodst = arp_header.protosrc
+        eth = pkt.ethernet(type=pkt.ethernet.ARP_TYPE, src=mac, dst=arp_header.hwsrc)
+        eth.payload = reply
+        msg = of.ofp_packet_out()
+        msg.data = eth.pack()
+        msg.in_port = in_port
+        msg.actions.append(of.ofp_action_output(port=of.OFPP_IN_PORT))
+        self.send(msg)
+        return
+    self.metrics.event(self.connection.dpid, "arp_flood_once")
+    self.floodOnce(packet_in, in_port)
+
+  # Floods a packet with a packet out, installing no flow
+  def floodOnce(self, packet_in, in_port):
+    msg = of.ofp_packet_out()
+    msg.in_port = in_port
+    if packet_in.buffer_id is not None:
+      msg.buffer_id = packet_in.buffer_id
+    else:
+      msg.data = packet_in.data
+    msg.actions.append(of.ofp_action_output(port=of.OFPP_FLOOD))
+    self.send(msg)
 
   # Accepts IP traffic between two specific hosts on two specific ports
   def acceptIP(self, packet, packet_in, ip_header, in_port, out_port):
-    if DEBUG_MODE:
-      print "IP packet from ",
-      print ip_header.srcip,
-      print " to ",
-      print ip_header.dstip,
-      print " - allow"
+    self.metrics.event(self.connection.dpid, "allow", ip_header.srcip, ip_header.dstip)
     msg = of.ofp_flow_mod()
     match = of.ofp_match()
     match.dl_type = pkt.ethernet.IP_TYPE
-    match.nw_proto = pkt.ipv4.IPv4
+    # Verdicts depend on the protocol, so the rule must not cover the pair's other protocols
+    match.nw_proto = ip_header.protocol
     match.in_port = in_port
     match.nw_src = ip_header.srcip
     match.nw_dst = ip_header.dstip
     msg.match = match
-    msg.idle_timeout = timeout
-    msg.hard_timeout = timeout
-    msg.buffer_id = packet_in.buffer_id
+    self.setTimeouts(msg, "forward")
+    self.metrics.flowMod(self.connection.dpid, "forward")
     msg.actions.append(of.ofp_action_output(port=out_port))
-    self.connection.send(msg)
+    self.sendForPacket(msg, packet_in)
 
   # Accepts traffic using exact packet and in-port match. Floods the network
   def acceptFlood(self, packet, packet_in, in_port):
-    if DEBUG_MODE:
-      print "Non-IP packet - accept flood"
+    self.metrics.event(self.connection.dpid, "flood_rule")
     msg = of.ofp_flow_mod()
     match = of.ofp_match.from_packet(packet, in_port)
     msg.match = match
-    msg.idle_timeout = timeout
-    msg.hard_timeout = timeout
-    msg.buffer_id = packet_in.buffer_id
+    self.setTimeouts(msg, "flood")
+    self.metrics.flowMod(self.connection.dpid, "flood")
     msg.actions.append(of.ofp_action_output(port = of.OFPP_FLOOD))
-    self.connection.send(msg)
+    self.sendForPacket(msg, packet_in)
+
+  # Forwards a non-IP frame using the learned MAC addresses. A frame to a known
+  # address gets a rule for its destination MAC and ethertype (never IP or ARP, so
+  # the access rules still apply), whatever its source or ingress port. A frame to an
+  # unknown address is flooded once without a rule, and broadcasts and multicasts
+  # get the usual flood rule. A frame whose destination is on the port it came in
+  # on is already there, so the switch gets a rule dropping such frames on that port.
+  def forwardL2(self, packet, packet_in, in_port):
+    if packet.dst.is_multicast:
+      self.acceptFlood(packet, packet_in, in_port)
+      return
+    out_port = self.macs.lookup(self.connection.dpid, packet.dst, time.time())
+    if out_port is None:
+      self.metrics.event(self.connection.dpid, "flood_unknown", packet.dst)
+      self.floodOnce(packet_in, in_port)
+      return
+    if out_port == in_port:
+      self.metrics.event(self.connection.dpid, "unicast_same_port", packet.dst, in_port)
+      msg = of.ofp_flow_mod()
+      msg.match.dl_dst = packet.dst
+      msg.match.dl_type = packet.type
+      msg.match.in_port = in_port
+      # Above the destination's unicast rule, which does not match in_port
+      msg.priority = of.OFP_DEFAULT_PRIORITY + 1
+      self.setTimeouts(msg, "unicast")
+      self.metrics.flowMod(self.connection.dpid, "unicast")
+      # omit action to drop
+      self.sendForPacket(msg, packet_in)
+      return
+    self.metrics.event(self.connection.dpid, "unicast", packet.dst, out_port)
+    msg = of.ofp_flow_mod()
+    msg.match.dl_dst = packet.dst
+    msg.match.dl_type = packet.type
+    self.setTimeouts(msg, "unicast")
+    self.metrics.flowMod(self.connection.dpid, "unicast")
+    msg.actions.append(of.ofp_action_output(port=out_port))
+    self.sendForPacket(msg, packet_in)
+
+  # Learns the source address of a frame. If it moved to another port, the unicast
+  # rules towards its old port are deleted.
+  def learnMAC(self, mac, in_port):
+    moved = self.macs.learn(self.connection.dpid, mac, in_port, time.time())
+    if moved is not None:
+      self.metrics.event(self.connection.dpid, "mac_moved", mac, moved, in_port)
+      msg = of.ofp_flow_mod(command=of.OFPFC_DELETE)
+      msg.match.dl_dst = mac
+      self.untrackDelete(msg)
+      self.send(msg)
 
   # Unused in current implementation
   def dropUnconditional(self, packet, packet_in, duration = None):
     if duration is not None:
-      if DEBUG_MODE:
-        print "Packet match drop"
+      self.metrics.event(self.connection.dpid, "drop_match")
+      self.metrics.flowMod(self.connection.dpid, "drop")
       msg = of.ofp_flow_mod()
       match = of.ofp_match.from_packet(packet)
       msg.match = match
@@ -123,39 +829,104 @@ class Final (object):
       msg.hard_timeout = duration
       msg.buffer_id = packet_in.buffer_id
       # omit action to drop packet
-      self.connection.send(msg)
+      self.send(msg)
     elif packet_in.buffer_id is not None:
-      if DEBUG_MODE:
-        print "Unconditional drop - single"
+      self.metrics.event(self.connection.dpid, "drop_single")
+      self.metrics.flowMod(self.connection.dpid, "drop")
       msg = of.ofp_flow_mod()
       msg.buffer_id = packet_in.buffer_id
-      self.connection.send(msg)
+      self.send(msg)
     else:
-      if DEBUG_MODE:
-        print "IGNORING PACKET on drop uncondition"
+      self.metrics.event(self.connection.dpid, "drop_ignored")
 
   # Drop packet of certain protocol between two specific hosts
-  def dropProtocol(self, packet, packet_in, ip_header, protocol=None):
-    if DEBUG_MODE:
-      print "Want to drop packet of type",
-      print protocol
+  # (only from in_port when given). packet_in may be None when the rule is installed
+  # on a switch other than the one that sent the packet.
+  def dropProtocol(self, packet, packet_in, ip_header, protocol=None, in_port=None):
+    self.metrics.event(self.connection.dpid, "drop", protocol)
     msg = of.ofp_flow_mod()
     match = of.ofp_match()
     match.dl_type = pkt.ethernet.IP_TYPE
-    if protocol is "ICMP":
+    if protocol == "ICMP":
       match.nw_proto = pkt.ipv4.ICMP_PROTOCOL
-    elif protocol is "TCP":
+    elif protocol == "TCP":
       match.nw_proto = pkt.ipv4.TCP_PROTOCOL
-    elif protocol is "IP":
-      match.nw_proto = pkt.ipv4.IPv4
+    # "IP": leave nw_proto wildcarded so every IP protocol is dropped
+    if in_port is not None:
+      match.in_port = in_port
     match.nw_src = ip_header.srcip
     match.nw_dst = ip_header.dstip
     msg.match = match
-    msg.idle_timeout = timeout
-    msg.hard_timeout = timeout
-    msg.buffer_id = packet_in.buffer_id
+    # Drops win over forwarding rules for the same pair (e.g. at an ingress port)
+    msg.priority = of.OFP_DEFAULT_PRIORITY + 1
+    self.setTimeouts(msg, "drop")
+    self.metrics.flowMod(self.connection.dpid, "drop")
+    if packet_in is not None:
+      msg.buffer_id = packet_in.buffer_id
     # omit action to drop
-    self.connection.send(msg)
+    self.send(msg)
+
+  # Installs a drop on the switch and port the offending source is attached to, so
+  # denied traffic stops at the edge instead of crossing the core first. Falls back
+  # to dropping on this switch when ingress placement is off, the source is not a
+  # known host or its switch is not connected. When the packet came from a switch
+  # other than the source's (a spoofed or moved source), this switch gets the drop
+  # too, since its traffic may never pass the ingress switch.
+  def deny(self, packet, packet_in, ip_header, protocol, port_on_switch):
+    location = None
+    if self.ingress is not None:
+      location = self.ingress.get(str(ip_header.srcip))
+    if location is None or location[0] not in self.switches:
+      self.dropProtocol(packet, packet_in, ip_header, protocol)
+      return
+    dpid, port = location
+    if dpid == self.connection.dpid:
+      if port != port_on_switch:
+        # Source address is not coming from where that host is attached
+        self.dropProtocol(packet, packet_in, ip_header, protocol)
+        return
+      self.dropProtocol(packet, packet_in, ip_header, protocol, port)
+      return
+    self.metrics.event(self.connection.dpid, "drop_at_ingress", dpid)
+    self.switches[dpid].dropProtocol(None, None, ip_header, protocol, port)
+    self.dropProtocol(packet, packet_in, ip_header, protocol)
+
+  # Makes the switch drop everything arriving on in_port, or every IP packet from
+  # srcip (an integer), for the limiter's block time instead of sending it here.
+  # Blocks win over every other rule.
+  def block(self, kind, in_port, srcip):
+    msg = of.ofp_flow_mod()
+    match = of.ofp_match()
+    if kind == final_policy.LIMIT_PORT:
+      match.in_port = in_port
+    else:
+      match.dl_type = pkt.ethernet.IP_TYPE
+      match.nw_src = IPAddr(srcip)
+    msg.match = match
+    msg.priority = of.OFP_DEFAULT_PRIORITY + 2
+    msg.hard_timeout = self.limiter.blockTime
+    msg.cookie = final_policy.ruleClassCookie("block")
+    self.trackFlow(msg, "block")
+    self.metrics.flowMod(self.connection.dpid, "block")
+    # omit action to drop
+    self.send(msg)
+
+  # Charges a PacketIn to the limiter. Returns false if it is over budget, in which
+  # case it is not classified and its port or source may get blocked on this switch.
+  def admitPacketIn(self, in_port, headers):
+    srcip = None
+    if headers is not None:
+      srcip = headers[2]
+    refused = self.limiter.admit(self.connection.dpid, in_port, srcip)
+    if refused is None:
+      return True
+    kind, block = refused
+    if block:
+      log.warning("PacketIn rate limit: blocking %s %s on %s for %s seconds" % (
+        kind, in_port if kind == final_policy.LIMIT_PORT else IPAddr(srcip),
+        self.connection, self.limiter.blockTime))
+      self.block(kind, in_port, srcip)
+    return False
 
   # Secure client port id is same as subnet host id + 1 (port 1 connects to core switch)
   # Ex: secure client ip address = 40.2.5.3 --> switch port number 4
@@ -170,22 +941,13 @@ class Final (object):
     ipNums = str(ip).split('.')
     for i in range(0,3):
       if subnetNums[i] != ipNums[i]:
-        if DEBUG_MODE:  
-          print "IP",
-          print str(ip),
-          print " not part of subnet",
-          print subnetMask
         return False
     return True
   
-  # This is where you'll put your code. The following modifications have 
-  # been made from Lab 3:
-  #   - port_on_switch: represents the port that the packet was received on.
-  #   - switch_id represents the id of the switch that received the packet.
-  #      (for example, s1 would have switch_id == 1, s2 would have switch_id == 2, etc...)
-  # You should use these to determine where a packet came from. To figure out where a packet 
-  # is going, you can use the IP header information.
-  def do_final (self, packet, packet_in, port_on_switch, switch_id):
+  # Original hand-written policy, kept as the reference implementation the compiled
+  # policy is checked and benchmarked against. Returns the same (action, argument)
+  # verdicts as CompiledPolicy.classify.
+  def classifyLegacy (self, packet, switch_id):
     # Parse packet information
     ip_header = packet.find('ipv4')
     icmp_header = packet.find('icmp')
@@ -194,177 +956,533 @@ class Final (object):
 
     # Allow all ARP packets
     if arp_header is not None:
-      self.acceptARP(packet, packet_in)
-      return
+      return (ARP, None)
     elif ip_header is not None:
       sourceIP = ip_header.srcip
       destinationIP = ip_header.dstip
     else: # Flood all other non-IP traffic
-      self.acceptFlood(packet, packet_in, port_on_switch)
-      return
+      return (FLOOD, None)
 
     # Implied IP traffic from here on out
     if switch_id == 6:  # Air-gapped switch
-      if DEBUG_MODE:
-        print "Switch 6"
-        print sourceIP,
-        print " -> ",
-        print destinationIP
       # Traffic only allowed between secure clients
       if self.match24BitSubnetMask("40.2.5.0", sourceIP) and self.match24BitSubnetMask("40.2.5.0", destinationIP):
         out_port = self.getSecureClientOutPort(destinationIP)
-        self.acceptIP(packet, packet_in, ip_header, port_on_switch, out_port)
-        return
+        return (FORWARD, out_port)
       else:
         # Drop all other traffic that doesn't originate from Air-Gapped floor 
-        self.dropProtocol(packet, packet_in, ip_header, "IP")
-        return
+        return (DROP, "IP")
     # ENFORCE TCP RULES
     if tcp_header is not None:
       # Trusted Host cannot send TCP to Web Server
       if sourceIP == IPAddr("104.24.32.100") and destinationIP == IPAddr("30.1.4.66"):
-        self.dropProtocol(packet, packet_in, ip_header, "TCP")
-        return
+        return (DROP, "TCP")
     # ENFORCE ICMP RULES
     elif icmp_header is not None:
       protocol = "ICMP"
       # Untrusted Host cannot send ICMP to Floor 1, Floor 2, or Web Server
       if ip_header.srcip == IPAddr("108.44.83.103"):
         if self.match24BitSubnetMask("20.2.1.0", destinationIP) or self.match24BitSubnetMask("10.2.7.0", destinationIP) or destinationIP == IPAddr("30.1.4.66"):
-          self.dropProtocol(packet, packet_in, ip_header, protocol)
-          return 
+          return (DROP, protocol)
       # Trusted Host cannot send ICMP traffic Floor 1 Department A, or Web Server
       if ip_header.srcip == IPAddr("104.24.32.100"):
         if self.match24BitSubnetMask("20.2.1.0", destinationIP) or destinationIP == IPAddr("30.1.4.66"):
-          self.dropProtocol(packet, packet_in, ip_header, protocol)
-          return
+          return (DROP, protocol)
       # Hosts in Floor 1 Dept. A cannot send ICMP traffic to Floor 2 Dept. B, and vice versa
       if self.match24BitSubnetMask("20.2.1.0", sourceIP) and self.match24BitSubnetMask("10.2.7.0", destinationIP):
-        self.dropProtocol(packet, packet_in, ip_header, protocol)
-        return
+        return (DROP, protocol)
       if self.match24BitSubnetMask("10.2.7.0", sourceIP) and self.match24BitSubnetMask("20.2.1.0", destinationIP):
-        self.dropProtocol(packet, packet_in, ip_header, protocol)
-        return
+        return (DROP, protocol)
     
     # Examine fallthrough IP traffic
     # All IP traffic must have specified destination ports
     if switch_id == 1:  # Core switch
-      if DEBUG_MODE:
-        print "Switch 1"
       if self.deviceConnectedToSwitch(destinationIP, DataCenterSwitchConnections):
         # Send from Core to Data Center
         out_port = self.getOutputPort("DataCenterSwitch", CoreSwitchConnections)
-        self.acceptIP(packet, packet_in, ip_header, port_on_switch, out_port)
-        return
+        return (FORWARD, out_port)
       elif self.deviceConnectedToSwitch(destinationIP, Floor1Switch1Connections):
         # Send from Core to Floor 1 Switch 1
         out_port = self.getOutputPort("Floor1Switch1", CoreSwitchConnections)
-        self.acceptIP(packet, packet_in, ip_header, port_on_switch, out_port)
-        return
+        return (FORWARD, out_port)
       elif self.deviceConnectedToSwitch(destinationIP, Floor1Switch2Connections):
         # Send from Core to Floor 1 Switch 2
         out_port = self.getOutputPort("Floor1Switch2", CoreSwitchConnections)
-        self.acceptIP(packet, packet_in, ip_header, port_on_switch, out_port)
-        return
+        return (FORWARD, out_port)
       elif self.deviceConnectedToSwitch(destinationIP, Floor2Switch1Connections):
         # Send from Core to Floor 2 Switch 1
         out_port = self.getOutputPort("Floor2Switch1", CoreSwitchConnections)
-        self.acceptIP(packet, packet_in, ip_header, port_on_switch, out_port)
-        return
+        return (FORWARD, out_port)
       elif self.match24BitSubnetMask("40.2.5.0", destinationIP):
         # Send from Core to Air Gapped Switch
         out_port = self.getOutputPort("AirGappedSwitch", CoreSwitchConnections)
-        self.acceptIP(packet, packet_in, ip_header, port_on_switch, out_port)
-        return
+        return (FORWARD, out_port)
       elif destinationIP == IPAddr("104.24.32.100"):
         # Send from Core to Trusted Host
         out_port = self.getOutputPort(destinationIP, CoreSwitchConnections)
-        self.acceptIP(packet, packet_in, ip_header, port_on_switch, out_port)
-        return
+        return (FORWARD, out_port)
       elif destinationIP  == IPAddr("108.44.83.103"):
         # Send from Core to Untrusted Host
         out_port = self.getOutputPort(destinationIP, CoreSwitchConnections)
-        self.acceptIP(packet, packet_in, ip_header, port_on_switch, out_port)
-        return
+        return (FORWARD, out_port)
       else:
-        return  # Implicitly drop all other traffic
+        return (IGNORE, None)  # Implicitly drop all other traffic
     elif switch_id == 2:  # Data center switch
-      if DEBUG_MODE:
-        print "Switch 2"
       if sourceIP == IPAddr("108.44.83.103") and destinationIP == IPAddr("30.1.4.66"):
         # Drop IP traffic going from Untrusted Host to Web Server
-        self.dropProtocol(packet, packet_in, ip_header, "IP")
-        return
+        return (DROP, "IP")
       if self.deviceConnectedToSwitch(destinationIP, DataCenterSwitchConnections):
         # Send from Data Center to Web Server
         out_port = self.getOutputPort(destinationIP, DataCenterSwitchConnections)
-        self.acceptIP(packet, packet_in, ip_header, port_on_switch, out_port)
-        return
+        return (FORWARD, out_port)
       else:
         # Send all IP traffic outgoing from Data Center to Core
         out_port = 1
-        self.acceptIP(packet, packet_in, ip_header, port_on_switch, out_port)
-        return
+        return (FORWARD, out_port)
     elif switch_id == 3:  # Floor 1 Switch 1
-      if DEBUG_MODE:
-        print "Switch 3"
       if self.deviceConnectedToSwitch(destinationIP, Floor1Switch1Connections):
         # Send from Floor 1 Switch 1 connected Host
         out_port = self.getOutputPort(destinationIP, Floor1Switch1Connections)
-        self.acceptIP(packet, packet_in, ip_header, port_on_switch, out_port)
-        return
+        return (FORWARD, out_port)
       else:
         # Send all IP traffic outgoing from Floor 1 Switch 1 to Core
         out_port = 1
-        self.acceptIP(packet, packet_in, ip_header, port_on_switch, out_port)
-        return
+        return (FORWARD, out_port)
     elif switch_id == 4:  # Floor 1 Switch 2
-      if DEBUG_MODE:
-        print "Switch 4"
       if self.deviceConnectedToSwitch(destinationIP, Floor1Switch2Connections):
         # Send from Floor 1 Switch 2 to connected Host
         out_port = self.getOutputPort(destinationIP, Floor1Switch2Connections)
-        self.acceptIP(packet, packet_in, ip_header, port_on_switch, out_port)
-        return
+        return (FORWARD, out_port)
       else:
         # Send all IP traffic outgoing from Floor 1 Switch 2 to Core
         out_port = 1
-        self.acceptIP(packet, packet_in, ip_header, port_on_switch, out_port)
-        return
+        return (FORWARD, out_port)
     elif switch_id == 5:  # Floor 2 Switch 1
-      if DEBUG_MODE:
-        print "Switch 5"
       if self.deviceConnectedToSwitch(destinationIP, Floor2Switch1Connections):
         # Send from Floor 2 Switch 1 to connected Host
         out_port = self.getOutputPort(destinationIP, Floor2Switch1Connections)
-        self.acceptIP(packet, packet_in, ip_header, port_on_switch, out_port)
-        return
+        return (FORWARD, out_port)
       else:
         # Send all IP traffic outgoing from Floor 2 Switch 1 to Core
         out_port = 1
-        self.acceptIP(packet, packet_in, ip_header, port_on_switch, out_port)
-        return
+        return (FORWARD, out_port)
       
     # All other fallthrough traffic implicitly dropped (nothing should reach here)
-    return
+    return (IGNORE, None)
+
+  # Classifies a parsed packet using the compiled policy. IP verdicts are looked up
+  # in the decision cache first, if there is one.
+  def classify (self, packet, switch_id, in_port = None):
+    if packet.find('arp') is not None:
+      return (ARP, None)
+    ip_header = packet.find('ipv4')
+    if ip_header is None:
+      return (FLOOD, None)
+    return self.classifyIP(switch_id, in_port, ip_header.srcip.toUnsigned(),
+                           ip_header.dstip.toUnsigned(), ip_header.protocol)
+
+  # Classifies IP header fields (integer addresses), using the decision cache if any
+  def classifyIP (self, switch_id, in_port, srcip, dstip, protocol):
+    if self.cache is None:
+      return self.policy.classify(switch_id, srcip, dstip, protocol)
+    key = (switch_id, in_port, srcip, dstip, protocol)
+    now = time.time()
+    verdict = self.cache.get(key, now)
+    if verdict is None:
+      verdict = self.policy.classify(switch_id, srcip, dstip, protocol)
+      self.cache.put(key, verdict, now)
+    return verdict
+
+  # Installs the rule for a packet according to the compiled policy.
+  #   - port_on_switch: represents the port that the packet was received on.
+  #   - switch_id represents the id of the switch that received the packet.
+  #      (for example, s1 would have switch_id == 1, s2 would have switch_id == 2, etc...)
+  # Returns the verdict's action.
+  def do_final (self, packet, packet_in, port_on_switch, switch_id):
+    if self.macs is not None:
+      self.learnMAC(packet.src, port_on_switch)
+    action, argument = self.classify(packet, switch_id, port_on_switch)
+    if action == FORWARD:
+      self.acceptIP(packet, packet_in, packet.find('ipv4'), port_on_switch, argument)
+    elif action == DROP:
+      self.deny(packet, packet_in, packet.find('ipv4'), argument, port_on_switch)
+    elif action == ARP:
+      if self.arp_table is not None:
+        self.proxyARP(packet, packet_in, port_on_switch)
+      else:
+        self.acceptARP(packet, packet_in)
+    elif action == FLOOD:
+      if self.macs is not None:
+        self.forwardL2(packet, packet_in, port_on_switch)
+      else:
+        self.acceptFlood(packet, packet_in, port_on_switch)
+    # IGNORE: implicitly drop, no rule installed
+    return action
+
+  # Same as do_final for a frame already read by parseRawHeaders. IP header objects are
+  # only built when a rule is actually installed. The source MAC is learned straight
+  # from the raw frame.
+  def do_final_raw (self, headers, packet_in, port_on_switch, switch_id):
+    if self.macs is not None:
+      self.learnMAC(EthAddr(packet_in.data[6:12]), port_on_switch)
+    ethertype, protocol, srcip, dstip = headers
+    if ethertype == pkt.ethernet.ARP_TYPE:
+      self.acceptARP(None, packet_in)
+      return ARP
+    action, argument = self.classifyIP(switch_id, port_on_switch, srcip, dstip, protocol)
+    if action == FORWARD:
+      ip_header = RawIPHeader(IPAddr(srcip), IPAddr(dstip), protocol)
+      self.acceptIP(None, packet_in, ip_header, port_on_switch, argument)
+    elif action == DROP:
+      ip_header = RawIPHeader(IPAddr(srcip), IPAddr(dstip), protocol)
+      self.deny(None, packet_in, ip_header, argument, port_on_switch)
+    return action
+
+  def _handle_FlowRemoved (self, event):
+    """
+    Feeds removed reactive flows to the adaptive timeouts and drops them from the
+    shadow flow table.
+    """
+    removed = event.ofp
+    if self.flowTable is not None:
+      self.flowTable.remove(flowKey(removed.match, removed.priority))
+    ruleClass = final_policy.cookieRuleClass(removed.cookie)
+    if ruleClass is not None:
+      self.timeouts.flowRemoved(ruleClass, event.idleTimeout, event.hardTimeout,
+                                removed.duration_sec, removed.packet_count, removed.byte_count)
+
+  def _handle_ErrorIn (self, event):
+    """
+    Drops failed flow mods from the shadow flow table. A full table also brings
+    the table's capacity down to what is installed and evicts flows to make room.
+    """
+    error = event.ofp
+    if error.type != of.OFPET_FLOW_MOD_FAILED:
+      return
+    tableFull = error.code == of.OFPFMFC_ALL_TABLES_FULL
+    if tableFull:
+      # Logged here, once, instead of by POX for every failed flow mod
+      event.should_log = False
+      self.tableFullErrors += 1
+      self.metrics.event(self.connection.dpid, "table_full", error.xid)
+      if self.tableFullErrors == 1:
+        log.warning("Flow table of %s is full%s" % (self.connection,
+          "" if self.flowTable is None else
+          " at %d flows, evicting" % len(self.flowTable)))
+    if self.flowTable is not None:
+      self.flowTable.flowModFailed(error.xid, tableFull)
+      if tableFull:
+        self.evictFlows()
+
+  def _handle_FlowStatsReceived (self, event):
+    """
+    Resynchronizes with the flows already on the switch after a warm restart.
+    """
+    if self.resyncing:
+      self.resyncing = False
+      self.resync(event.stats)
+
+  def _handle_BarrierIn (self, event):
+    self.batcher.barrierReply(event.xid)
+
+  def _handle_ConnectionDown (self, event):
+    if self.switches.get(self.connection.dpid) is self:
+      del self.switches[self.connection.dpid]
+      if self.macs is not None:
+        self.macs.clear(self.connection.dpid)
+      if self.flowTable is not None:
+        self.metrics.unwatch("flow_table", self.connection.dpid)
 
   def _handle_PacketIn (self, event):
     """
-    Handles packet in messages from the switch.
+    Handles packet in messages from the switch, counting each by verdict along
+    with how long it took.
     """
+    start = time.time()
+    action = self.handlePacketIn(event)
+    self.metrics.packetIn(event.dpid, event.port, action, time.time() - start)
+
+  # Handles a PacketIn event. Returns the verdict's action, "refused" if the limiter
+  # refused it or "incomplete" if it could not be parsed.
+  def handlePacketIn (self, event):
+    headers = None
+    if self.fast_path or self.limiter is not None:
+      # event.parsed is only built if we fall back to it
+      headers = parseRawHeaders(event.ofp.data)
+    if self.limiter is not None and not self.admitPacketIn(event.port, headers):
+      return "refused"
+    if self.fast_path:
+      # The ARP proxy needs the parsed ARP packet
+      if headers is not None and (headers[0] != pkt.ethernet.ARP_TYPE or
+                                  self.arp_table is None):
+        return self.do_final_raw(headers, event.ofp, event.port, event.dpid)
+
     packet = event.parsed # This is the parsed packet data.
     if not packet.parsed:
-      log.warning("Ignoring incomplete packet")
-      return
+      self.metrics.event(event.dpid, "incomplete")
+      return "incomplete"
 
     packet_in = event.ofp # The actual ofp_packet_in message.
-    self.do_final(packet, packet_in, event.port, event.dpid)
+    return self.do_final(packet, packet_in, event.port, event.dpid)
+
+class PolicyWatcher (object):
+  """
+  Polls a policy file and, when it changes, compiles it and hands the new policy
+  to every connected switch, which sends only the flow mods that differ (see
+  Final.updatePolicy). Switches that connect later get it through the shared
+  options. A file that cannot be loaded is logged and the current policy kept.
+  """
+
+  def __init__ (self, path, options, routing = None):
+    self.path = path
+    self.options = options
+    # RouteUpdater to hand the new hosts and routes to, with --discovery
+    self.routing = routing
+    self.mtime = os.path.getmtime(path)
+
+  # Reloads the policy if the file was modified since it was last read
+  def check(self):
+    try:
+      mtime = os.path.getmtime(self.path)
+    except OSError:
+      return
+    if mtime != self.mtime:
+      self.mtime = mtime
+      self.reload()
+
+  def reload(self):
+    old = self.options["policy"]
+    oldSpec = self.routing.spec if self.routing is not None else None
+    try:
+      spec = final_policy.PolicySpec.load(self.path)
+      # Unchanged access rules keep their aggregate priority bands
+      policy = spec.compile(old)
+      if self.routing is not None:
+        self.routing.setSpec(spec)
+        policy = self.routing.routedPolicy(policy)
+    except Exception as e:
+      # Whatever is wrong with the file, the running policy stays and the file is
+      # still checked for the next change
+      if oldSpec is not None:
+        self.routing.setSpec(oldSpec)
+      log.error("Keeping the current policy: %s: %s" % (type(e).__name__, e))
+      return
+    hosts = spec.knownHosts()
+    changes = final_policy.changedFlowMatches(old, policy)
+    self.options["policy"] = policy
+    self.options["hosts"] = hosts
+    # Shared tables are updated in place so every switch sees them
+    if self.options["ingress"] is not None:
+      self.options["ingress"].clear()
+      self.options["ingress"].update(spec.hostLocations())
+    if self.options["arp_table"] is not None:
+      self.options["arp_table"].reseed(dict((IPAddr(ip), EthAddr(mac))
+                                            for ip, mac in spec.hostMACs().items()))
+    if self.options["limiter"] is not None:
+      self.options["limiter"].exempt = frozenset(spec.switchLinks())
+    for final in list(self.options["switches"].values()):
+      final.updatePolicy(policy, hosts, changes)
+    log.info("Reloaded policy %s on %d switches" % (self.path, len(self.options["switches"])))
 
-def launch ():
+class RouteUpdater (object):
+  """
+  Keeps the forwarding tables on shortest paths as openflow.discovery reports
+  links between switches coming and going. The switch graph is the links of the
+  policy, with every link discovery has reported since going up or down added or
+  taken out. Only the tables of switches whose next hops changed are rebuilt, and
+  switches get only the flow mods that differ (see Final.updatePolicy). Policies
+  with explicit forwarding tables are left alone.
+  """
+
+  def __init__ (self, spec, options):
+    self.options = options
+    # (dpid, port, dpid, port) with the lower end first -> True if the last report
+    # of the link was that it came up
+    self.discovered = {}
+    self.setSpec(spec)
+
+  # Switches to a new policy spec, e.g. a reloaded file, rebuilding the switch graph
+  # from its links and what discovery has reported
+  def setSpec(self, spec):
+    self.spec = spec
+    self.locations = spec.hostLocations()
+    self.router = spec.router()
+    for link, up in self.discovered.items():
+      if up:
+        self.router.linkUp(*link)
+      else:
+        self.router.linkDown(*link)
+
+  # policy with the forwarding tables of the current switch graph
+  def routedPolicy(self, policy):
+    if self.spec.forwarding is not None:
+      return policy
+    return policy.withForwarding(self.router.forwardingTables(self.locations, self.spec.routes))
+
+  def _handle_LinkEvent (self, event):
+    link = event.link
+    ends = sorted([(link.dpid1, link.port1), (link.dpid2, link.port2)])
+    self.discovered[ends[0] + ends[1]] = event.added
+    if event.added:
+      changed = self.router.linkUp(link.dpid1, link.port1, link.dpid2, link.port2)
+    else:
+      changed = self.router.linkDown(link.dpid1, link.port1, link.dpid2, link.port2)
+    if not changed or self.spec.forwarding is not None:
+      return
+    old = self.options["policy"]
+    policy = old.withForwarding(self.router.forwardingTables(self.locations, self.spec.routes,
+                                                             changed))
+    changes = final_policy.changedFlowMatches(old, policy)
+    self.options["policy"] = policy
+    for final in list(self.options["switches"].values()):
+      final.updatePolicy(policy, self.options["hosts"], changes)
+    log.info("Link %s %s: rerouted %d switches" % (link, "up" if event.added else "down",
+                                                  len(changed)))
+
+# Turns launch() options into keyword arguments for Final. Shared state (the compiled
+# policy, decision cache and ARP table) is created once for all switches.
+def finalOptions(proactive = False, aggregate = False, cache_size = 4096, fast_path = False,
+                 arp_proxy = False, ingress_drops = False, forward_timeout = None,
+                 drop_timeout = None, arp_timeout = None, flood_timeout = None,
+                 adaptive_timeouts = False, port_rate = None, source_rate = None,
+                 block_time = 10, policy_file = None, event_sample = 100,
+                 unicast_timeout = None, mac_limit = 4096, mac_aging = 300,
+                 table_capacity = None, batch_messages = True, warm_restart = False):
+  if policy_file is not None:
+    spec = final_policy.PolicySpec.load(policy_file)
+  else:
+    spec = builtinPolicySpec()
+  cache_size = int(cache_size)
+  cache = None
+  if cache_size > 0:
+    cache = final_policy.DecisionCache(cache_size, timeout)
+  arp_table = None
+  if str_to_bool(arp_proxy):
+    # Seed with the topology's hosts; learned addresses replace these
+    arp_table = final_policy.ArpTable((IPAddr(ip), EthAddr(mac))
+                                      for ip, mac in spec.hostMACs().items())
+  profiles = dict(TimeoutProfiles)
+  for ruleClass, value in (("forward", forward_timeout), ("drop", drop_timeout),
+                           ("arp", arp_timeout), ("flood", flood_timeout),
+                           ("unicast", unicast_timeout)):
+    if value is not None:
+      # "<idle>" or "<idle>/<hard>"
+      values = [int(v) for v in str(value).split("/")]
+      profiles[ruleClass] = (values[0], values[-1])
+  macs = None
+  if int(mac_limit) > 0:
+    macs = final_policy.MacTable(int(mac_limit), int(mac_aging))
+  limiter = None
+  if port_rate is not None or source_rate is not None:
+    # "<rate>" or "<rate>/<burst>"; inter-switch links only get per-source limits
+    rates = [None, None, None, None]
+    for i, value in ((0, port_rate), (2, source_rate)):
+      if value is not None:
+        values = [float(v) for v in str(value).split("/")]
+        rates[i:i + 2] = (values[0], values[-1])
+    limiter = final_policy.PacketInLimiter(*rates, blockTime=int(block_time),
+                                           exempt=spec.switchLinks())
+  # The shared components' counters show up in core.final_metrics.snapshot()
+  metrics = final_policy.ControllerMetrics(int(event_sample))
+  for name, component in (("cache", cache), ("mac_table", macs), ("limiter", limiter)):
+    if component is not None:
+      metrics.watch(name, component.stats)
+  return {
+    "policy": spec.compile(),
+    "proactive": str_to_bool(proactive),
+    "aggregate": str_to_bool(aggregate),
+    "cache": cache,
+    "fast_path": str_to_bool(fast_path),
+    "arp_table": arp_table,
+    "switches": {},
+    "ingress": spec.hostLocations() if str_to_bool(ingress_drops) else None,
+    "timeouts": final_policy.FlowTimeouts(profiles, str_to_bool(adaptive_timeouts)),
+    "limiter": limiter,
+    "hosts": spec.knownHosts(),
+    "metrics": metrics,
+    "macs": macs,
+    "table_capacity": int(table_capacity) if table_capacity is not None else None,
+    "batch_messages": str_to_bool(batch_messages),
+    "warm_restart": str_to_bool(warm_restart),
+  }
+
+# Logs the metrics summary and the shared components' counters (cache, limiter, ...),
+# and writes out the sampled events buffered since last time
+def logMetrics(metrics):
+  log.info("Metrics: " + metrics.summary())
+  for name, stats in sorted(metrics.sources.items()):
+    log.info("Metrics %s: %s" % (name, stats()))
+  for event in metrics.takeEvents():
+    log.debug("Event at %.3f on %s: %s" % (event[0], event[1],
+                                          " ".join(str(detail) for detail in event[2:])))
+
+def launch (proactive = False, aggregate = False, cache_size = 4096, fast_path = False,
+            arp_proxy = False, ingress_drops = False, forward_timeout = None,
+            drop_timeout = None, arp_timeout = None, flood_timeout = None,
+            adaptive_timeouts = False, port_rate = None, source_rate = None,
+            block_time = 10, policy_file = None, policy_poll = 2, discovery = False,
+            event_sample = 100, metrics_interval = 60, unicast_timeout = None,
+            mac_limit = 4096, mac_aging = 300, table_capacity = None,
+            batch_messages = True, warm_restart = False):
   """
   Starts the component
+
+  --proactive installs every rule for the known hosts when a switch connects
+  --aggregate does the same with destination-prefix rules instead of per host pair
+  --cache_size=<n> caches up to n IP verdicts for the flow timeout (0 disables)
+  --fast_path reads IP/ARP headers from the raw frame instead of fully parsing it
+  --arp_proxy answers ARP requests from the controller instead of flooding them
+  --ingress_drops installs drops on the port the denied source is attached to
+  --<forward|drop|arp|flood|unicast>_timeout=<idle>[/<hard>] sets the timeouts of a
+    class of rule
+  --adaptive_timeouts tunes those timeouts from FlowRemoved statistics
+  --port_rate=<rate>[/<burst>] limits PacketIns per second from each switch port
+  --source_rate=<rate>[/<burst>] limits PacketIns per second from each source IP
+  --block_time=<seconds> is how long ports and sources over their limit are dropped
+  --policy_file=<file> reads hosts, forwarding tables and access rules from a JSON
+    (or YAML) file instead of the built-in tables, and reloads it when it changes
+  --policy_poll=<seconds> is how often the policy file is checked for changes
+  --discovery reroutes around links openflow.discovery finds going up or down
+  --mac_limit=<n> learns up to n MAC addresses per switch to forward non-IP frames
+    with unicast rules instead of flooding them (0 disables)
+  --mac_aging=<seconds> is how long a learned MAC address is kept without being seen
+  --table_capacity=<n> tracks the flows installed on each switch and evicts the
+    least valuable ones as the table nears n flows
+  --batch_messages=False writes every message to a switch as it is sent instead of
+    once per pass of the event loop
+  --warm_restart keeps the flows on switches that connect, reads them back and
+    reconciles them with the policy instead of starting from an empty table
+  --event_sample=<n> keeps one in every n controller events for the log (0 for none)
+  --metrics_interval=<seconds> is how often the metrics summary and sampled events
+    are logged (0 never); core.final_metrics.snapshot() returns the counters
   """
+  # Compile the policy once and share it between all switches
+  options = finalOptions(proactive, aggregate, cache_size, fast_path, arp_proxy,
+                         ingress_drops, forward_timeout, drop_timeout, arp_timeout,
+                         flood_timeout, adaptive_timeouts, port_rate, source_rate,
+                         block_time, policy_file, event_sample, unicast_timeout,
+                         mac_limit, mac_aging, table_capacity, batch_messages,
+                         warm_restart)
+  if options["warm_restart"]:
+    # Otherwise POX deletes every flow of a switch when it connects
+    core.openflow.clear_flows_on_connect = False
   def start_switch (event):
     log.debug("Controlling %s" % (event.connection,))
-    Final(event.connection)
+    Final(event.connection, **options)
   core.openflow.addListenerByName("ConnectionUp", start_switch)
+  core.register("final_metrics", options["metrics"])
+  if float(metrics_interval) > 0:
+    Timer(float(metrics_interval), logMetrics, args=[options["metrics"]], recurring=True)
+  routing = None
+  if str_to_bool(discovery):
+    if policy_file is not None:
+      spec = final_policy.PolicySpec.load(policy_file)
+    else:
+      spec = builtinPolicySpec()
+    routing = RouteUpdater(spec, options)
+    def start_discovery ():
+      core.openflow_discovery.addListeners(routing)
+    core.call_when_ready(start_discovery, "openflow_discovery")
+  if policy_file is not None:
+    watcher = PolicyWatcher(policy_file, options, routing)
+    Timer(float(policy_poll), watcher.check, recurring=True)
@@ -0,0 +1,316 @@
+#!/usr/bin/python
+
+# final_matrix.py - Offline all-pairs evaluation of the CSE 150 final project policy
+# Kyle Won, UCSC
+# kwon, 1724327
+# CSE 150 Final Project
+#
+# Works out what happens to ICMP, TCP and other IP traffic between every pair of
+# hosts under a compiled policy, without Mininet or POX: traffic is followed from
+# the source's switch through the forwarding tables and dropped at the first switch
+# whose access rules deny it. Addresses are integers in NumPy arrays, and paths are
+# followed once per (switch, destination) since forwarding only depends on the
+# destination, so a campus of 10000 hosts takes seconds. The result is written as
+# text with one run-length encoded line per source host and protocol, so two
+# versions of a policy can be compared with diff:
+#   $ python final_matrix.py --policy_file=final_policy.json --output=before.txt
+#   $ python final_matrix.py --floors=10 --switches=20 --hosts=50 --output=campus.txt
+
+import os
+import sys
+import time
+
+import final_campus
+import final_policy
+from final_policy import DROP
+
+# Optional: only this tool needs NumPy, not the controller
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+# Outcome of traffic from one host to another, one character each in the matrix
+DELIVERED = "A"  # reaches the destination host
+DENIED = "D"     # dropped by an access rule
+NO_ROUTE = "N"   # a switch has no route for it (the policy ignores it)
+MISROUTED = "X"  # leaves the network anywhere but at the destination
+LOOP = "L"       # still in the network after MAX_HOPS switches
+SELF = "-"       # source and destination are the same host
+
+# Protocols evaluated, by name and final_policy protocol class. "IP" is any IP
+# protocol other than ICMP and TCP.
+PROTOCOLS = (("ICMP", 1), ("TCP", 2), ("IP", 0))
+
+# Longest path followed before traffic counts as looping
+MAX_HOPS = 16
+
+class PolicyMatrix (object):
+  """
+  Outcome and path of traffic between every pair of a PolicySpec's hosts under a
+  compiled policy, for each protocol in PROTOCOLS.
+
+  Hosts, sorted by address, are numbered 0..n-1 and switches (sorted dpids)
+  0..m-1. nextPort[s, d] is the port switch s sends traffic for host d out of (-1
+  for no route), and outcome[s, d] is how that traffic ends when it is followed
+  from switch s. Access rules only depend on the classes of the two addresses
+  (see CompiledPolicy.accessTables), so a pair's verdict combines the path from
+  the source's switch with, for each distinct access table, the first hop of the
+  path at a switch using that table. rows() computes the verdicts a block of
+  source hosts at a time.
+  """
+
+  def __init__ (self, spec, policy = None, maxHops = MAX_HOPS):
+    if numpy is None:
+      raise ImportError("PolicyMatrix needs NumPy")
+    if policy is None:
+      policy = spec.compile()
+    self.policy = policy
+    self.maxHops = maxHops
+    self.hosts = spec.knownHosts()
+    self.hostIndex = dict((ip, i) for i, ip in enumerate(self.hosts))
+    self.addresses = numpy.array([final_policy.ipToInt(ip) for ip in self.hosts],
+                                 dtype=numpy.uint32)
+    locations = spec.hostLocations()
+    links = spec.switchLinks()
+    dpids = set(policy.forwardingTables)
+    dpids.update(dpid for dpid, port in locations.values())
+    dpids.update(dpid for dpid, port in links)
+    self.switches = sorted(dpids)
+    index = dict((dpid, i) for i, dpid in enumerate(self.switches))
+    self.hostSwitch = numpy.array([index[locations[ip][0]] for ip in self.hosts],
+                                  dtype=numpy.int32)
+    self.hostPort = numpy.array([locations[ip][1] for ip in self.hosts], dtype=numpy.int32)
+
+    # What is at the other end of each (switch, port): a host, or a switch and its port
+    width = max([port for dpid, port in list(locations.values()) + list(links)] + [0]) + 1
+    shape = (len(self.switches), width)
+    self._portHost = numpy.full(shape, -1, dtype=numpy.int32)
+    self._portHost[self.hostSwitch, self.hostPort] = numpy.arange(len(self.hosts))
+    self._peerSwitch = numpy.full(shape, -1, dtype=numpy.int32)
+    self._peerPort = numpy.full(shape, -1, dtype=numpy.int32)
+    for (dpid, port), (peer, peerPort) in links.items():
+      self._peerSwitch[index[dpid], port] = index[peer]
+      self._peerPort[index[dpid], port] = peerPort
+
+    self.nextPort = numpy.full((len(self.switches), len(self.hosts)), -1, dtype=numpy.int32)
+    for s, dpid in enumerate(self.switches):
+      table = policy.forwardingTables.get(dpid, [])
+      entries = [(final_policy.parsePrefix(prefix), port)
+                 for prefix, port in table if port is not None]
+      self.nextPort[s] = self._longestMatch(entries)
+    self._compileAccessTables()
+    self._follow()
+
+  # Longest prefix match of every host address in a [((network, length), value)]
+  # table. Returns the values as an array, default where nothing matches.
+  def _longestMatch(self, entries, default = -1):
+    result = numpy.full(len(self.addresses), default, dtype=numpy.int32)
+    found = numpy.zeros(len(self.addresses), dtype=bool)
+    byLength = {}
+    for (network, length), value in entries:
+      byLength.setdefault(length, []).append((network, value))
+    for length in sorted(byLength, reverse=True):
+      networks, values = zip(*sorted(byLength[length]))
+      networks = numpy.array(networks, dtype=numpy.uint32)
+      keys = self.addresses & numpy.uint32(final_policy.prefixMask(length))
+      at = numpy.searchsorted(networks, keys)
+      at[at == len(networks)] = 0
+      hit = (networks[at] == keys) & ~found
+      result[hit] = numpy.array(values, dtype=numpy.int32)[at[hit]]
+      found |= hit
+    return result
+
+  # Address classes of every host and, for each distinct access table, which
+  # (protocol class, source class, destination class) combinations it drops
+  def _compileAccessTables(self):
+    srcClasses, dstClasses, tables = self.policy.accessTables()
+    # Class 0 is None: no rule prefix contains the address
+    srcIndex = dict((prefix, i + 1) for i, prefix in enumerate(srcClasses))
+    dstIndex = dict((prefix, i + 1) for i, prefix in enumerate(dstClasses))
+    self.srcClass = self._longestMatch(srcIndex.items(), 0)
+    self.dstClass = self._longestMatch(dstIndex.items(), 0)
+    srcIndex[None] = dstIndex[None] = 0
+    seen = []
+    self._drops = []
+    self._switchTable = numpy.zeros(len(self.switches), dtype=numpy.int32)
+    for s, dpid in enumerate(self.switches):
+      table = tables.get(dpid, tables[None])
+      if table not in seen:
+        seen.append(table)
+        drops = numpy.zeros((3, len(srcClasses) + 1, len(dstClasses) + 1), dtype=bool)
+        for (protocolClass, srcClass, dstClass), verdict in table.items():
+          if verdict[0] == DROP:
+            drops[protocolClass, srcIndex[srcClass], dstIndex[dstClass]] = True
+        self._drops.append(drops)
+      self._switchTable[s] = seen.index(table)
+
+  # Follows the traffic for every destination from every switch, all of it a hop at
+  # a time. Fills outcome, hops (switches on the path) and firstHop[table]: the
+  # first hop at a switch using that access table, -1 if the path has none.
+  def _follow(self):
+    switches, hosts = len(self.switches), len(self.hosts)
+    width = self._portHost.shape[1]
+    self.outcome = numpy.full(switches * hosts, ord(LOOP), dtype=numpy.uint8)
+    self.hops = numpy.zeros(switches * hosts, dtype=numpy.int16)
+    self.firstHop = numpy.full((len(self._drops), switches * hosts), -1, dtype=numpy.int16)
+    pending = numpy.arange(switches * hosts)
+    current = pending // hosts
+    destination = pending % hosts
+    # Port traffic came in on; at the first hop that is the source host's (see rows)
+    inPort = numpy.full(len(pending), -1, dtype=numpy.int32)
+    for hop in range(self.maxHops):
+      if not len(pending):
+        break
+      table = self._switchTable[current]
+      first = self.firstHop[table, pending]
+      self.firstHop[table, pending] = numpy.where(first < 0, hop, first)
+      self.hops[pending] = hop + 1
+      port = self.nextPort[current, destination]
+      valid = (port >= 0) & (port < width)
+      port = numpy.where(valid, port, 0)
+      host = numpy.where(valid, self._portHost[current, port], -1)
+      peer = numpy.where(valid, self._peerSwitch[current, port], -1)
+      outcome = numpy.full(len(pending), ord(MISROUTED), dtype=numpy.uint8)
+      outcome[self.nextPort[current, destination] < 0] = ord(NO_ROUTE)
+      outcome[host == destination] = ord(DELIVERED)
+      self.outcome[pending] = outcome
+      # A switch never sends traffic back out of the port it came in on
+      onward = (peer >= 0) & (port != inPort)
+      inPort = self._peerPort[current, port][onward]
+      pending = pending[onward]
+      current = peer[onward]
+      destination = destination[onward]
+    self.outcome[pending] = ord(LOOP)
+    self.outcome = self.outcome.reshape(switches, hosts)
+    self.hops = self.hops.reshape(switches, hosts)
+    self.firstHop = self.firstHop.reshape(len(self._drops), switches, hosts)
+
+  # Outcome characters (as uint8) of the traffic of a protocol class from hosts
+  # start..stop-1 (rows) to every host (columns)
+  def rows(self, protocolClass, start, stop):
+    sources = numpy.arange(start, stop)
+    switch = self.hostSwitch[sources]
+    result = self.outcome[switch]
+    dropHop = numpy.full(result.shape, self.maxHops, dtype=numpy.int16)
+    for table, drops in enumerate(self._drops):
+      first = self.firstHop[table][switch]
+      denied = drops[protocolClass][self.srcClass[sources][:, None], self.dstClass[None, :]]
+      denied &= first >= 0
+      dropHop = numpy.where(denied, numpy.minimum(dropHop, first), dropHop)
+    # Sent back out of the source's own port at the first switch, unless the access
+    # rules drop it there first
+    bounced = self.nextPort[switch] == self.hostPort[sources][:, None]
+    result[bounced] = ord(MISROUTED)
+    result[(dropHop < self.maxHops) & (~bounced | (dropHop == 0))] = ord(DENIED)
+    result[numpy.arange(len(sources)), sources] = ord(SELF)
+    return result
+
+  # Outcome character of traffic of a protocol (a PROTOCOLS name) between two hosts
+  def verdict(self, src, dst, protocol):
+    i = self.hostIndex[src]
+    return chr(self.rows(dict(PROTOCOLS)[protocol], i, i + 1)[0][self.hostIndex[dst]])
+
+  # Switches traffic from src to dst goes through, as [(dpid, out port)], whatever
+  # the access rules say. Ends early if a switch has no route or the traffic leaves
+  # the network.
+  def path(self, src, dst):
+    s, d = self.hostSwitch[self.hostIndex[src]], self.hostIndex[dst]
+    path = []
+    while s >= 0 and len(path) < self.maxHops:
+      port = self.nextPort[s, d]
+      path.append((self.switches[s], int(port)))
+      if port < 0 or port >= self._peerSwitch.shape[1]:
+        break
+      s = self._peerSwitch[s, port]
+    return path
+
+  # {protocol name: {outcome character: number of host pairs}}
+  def counts(self, block = 512):
+    result = {}
+    for name, protocolClass in PROTOCOLS:
+      totals = numpy.zeros(256, dtype=numpy.int64)
+      for start in range(0, len(self.hosts), block):
+        rows = self.rows(protocolClass, start, min(start + block, len(self.hosts)))
+        totals += numpy.bincount(rows.ravel(), minlength=256)
+      result[name] = dict((chr(c), int(totals[c])) for c in numpy.flatnonzero(totals))
+    return result
+
+  # Writes the matrix as text: the hosts with their switch and port, then for each
+  # protocol a line per source host of its outcome to every host (in host order),
+  # then a line per switch of the port it sends each host's traffic out of, both
+  # run-length encoded. Between two policies over the same hosts only the lines of
+  # changed sources and switches differ. Returns the counts() of the matrix.
+  def write(self, out, block = 512):
+    out.write("# final_matrix: %s delivered, %s denied, %s no route, %s misrouted, "
+              "%s loop, %s same host\n" % (DELIVERED, DENIED, NO_ROUTE, MISROUTED, LOOP,
+                                           SELF))
+    out.write("hosts %d\n" % len(self.hosts))
+    for i, ip in enumerate(self.hosts):
+      out.write("%s s%d %d\n" % (ip, self.switches[self.hostSwitch[i]], self.hostPort[i]))
+    result = {}
+    for name, protocolClass in PROTOCOLS:
+      out.write("verdicts %s\n" % name)
+      totals = numpy.zeros(256, dtype=numpy.int64)
+      for start in range(0, len(self.hosts), block):
+        rows = self.rows(protocolClass, start, min(start + block, len(self.hosts)))
+        totals += numpy.bincount(rows.ravel(), minlength=256)
+        for i, row in enumerate(rows):
+          out.write("%s %s\n" % (self.hosts[start + i],
+                                 " ".join("%s%d" % (chr(c), n) for c, n in runs(row))))
+      result[name] = dict((chr(c), int(totals[c])) for c in numpy.flatnonzero(totals))
+    out.write("paths\n")
+    for s, dpid in enumerate(self.switches):
+      out.write("s%d %s\n" % (dpid, " ".join("%s:%d" % (port if port >= 0 else "-", n)
+                                             for port, n in runs(self.nextPort[s]))))
+    return result
+
+# Run-length encodes a 1-d array as [(value, count)]
+def runs(values):
+  if not len(values):
+    return []
+  starts = numpy.concatenate(([0], numpy.flatnonzero(values[1:] != values[:-1]) + 1))
+  counts = numpy.diff(numpy.concatenate((starts, [len(values)])))
+  return zip(values[starts].tolist(), counts.tolist())
+
+# Arguments are --policy_file=<file> (final_policy.json by default) or
+# final_campus.py options (--floors, --switches, ...) for a generated campus, and
+# --output=<file> (standard output by default). A summary goes to standard error.
+def main(args):
+  policyFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "final_policy.json")
+  output = None
+  campusArgs = []
+  for arg in args:
+    name, _, value = arg.lstrip("-").partition("=")
+    if name == "policy_file":
+      policyFile = value
+    elif name == "output":
+      output = value
+    else:
+      campusArgs.append(arg)
+  if numpy is None:
+    sys.stderr.write("final_matrix.py needs NumPy\n")
+    return 1
+  start = time.time()
+  if campusArgs:
+    plan = final_campus.generateCampus(**final_campus.campusOptions(campusArgs))
+    spec = plan.policySpec()
+  else:
+    spec = final_policy.PolicySpec.load(policyFile)
+  policy = spec.compile()
+  compiled = time.time()
+  matrix = PolicyMatrix(spec, policy)
+  if output is None:
+    counts = matrix.write(sys.stdout)
+  else:
+    with open(output, "w") as out:
+      counts = matrix.write(out)
+  sys.stderr.write("%d hosts on %d switches: policy in %.1f s, matrix in %.1f s\n" % (
+    len(matrix.hosts), len(matrix.switches), compiled - start, time.time() - compiled))
+  for name, protocolClass in PROTOCOLS:
+    totals = sorted(counts[name].items())
+    sys.stderr.write("  %-4s %s\n" % (name, ", ".join("%s %d" % item for item in totals)))
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
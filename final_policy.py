@@ -0,0 +1,1207 @@
+# final_policy.py - Policy compiler for the CSE 150 final project controller
+# Kyle Won, UCSC
+# kwon, 1724327
+# CSE 150 Final Project
+#
+# Turns the controller's ACL rules and per-switch forwarding tables into integer
+# longest-prefix-match tables once, so that classifying a packet at runtime is a
+# handful of dict lookups instead of string splitting and IPAddr comparisons.
+# This module does not depend on POX so it can be used by offline tools.
+
+import copy
+import difflib
+import json
+import socket
+import struct
+import time
+from collections import deque, namedtuple, OrderedDict
+
+# Optional: YAML policy files
+try:
+  import yaml
+  PolicyParseErrors = (ValueError, yaml.YAMLError)
+except ImportError:
+  yaml = None
+  PolicyParseErrors = (ValueError,)
+
+# Verdicts returned by the classifiers. Every verdict is a tuple of
+# (action, argument) where argument is the output port for FORWARD and the
+# protocol name ("TCP", "ICMP" or "IP") for DROP.
+FORWARD = "forward"
+DROP = "drop"
+IGNORE = "ignore"  # No rule installed, packet implicitly dropped
+ARP = "arp"
+FLOOD = "flood"
+
+ALLOW = "allow"
+
+# IP protocol numbers used by the ACL rules
+ICMP_PROTOCOL = 1
+TCP_PROTOCOL = 6
+
+# Protocol name used in ACL rules -> protocol class index. "IP" matches anything.
+PROTOCOL_CLASSES = {
+  "IP": 0,
+  "ICMP": 1,
+  "TCP": 2,
+}
+PROTOCOL_NUMBER_CLASSES = {
+  ICMP_PROTOCOL: 1,
+  TCP_PROTOCOL: 2,
+}
+
+# Representative protocol number for each protocol class, used when enumerating rules
+CLASS_PROTOCOL_NUMBERS = (17, ICMP_PROTOCOL, TCP_PROTOCOL)
+
+# Switch-independent description of an IP flow rule. src and dst are
+# (network, length) prefixes or None for a wildcard, protocol is an IP
+# protocol number or None, action is FORWARD (out port in port) or DROP.
+FlowRule = namedtuple("FlowRule", "priority protocol src dst in_port action port")
+
+# Converts a dotted-quad string (or anything whose str() is one) to a 32-bit integer
+def ipToInt(ip):
+  return struct.unpack("!I", socket.inet_aton(str(ip)))[0]
+
+# Converts a 32-bit integer to a dotted-quad string
+def intToIP(value):
+  return socket.inet_ntoa(struct.pack("!I", value))
+
+# Returns the netmask for a prefix length as a 32-bit integer
+def prefixMask(length):
+  return (0xffffffff << (32 - length)) & 0xffffffff
+
+# Parses "a.b.c.d/len" (or a bare address, treated as /32) to (network, length)
+def parsePrefix(prefix):
+  if "/" in prefix:
+    address, length = prefix.split("/")
+    length = int(length)
+  else:
+    address, length = prefix, 32
+  return (ipToInt(address) & prefixMask(length), length)
+
+# Formats a (network, length) prefix as "a.b.c.d/len"
+def prefixString(prefix):
+  return "%s/%d" % (intToIP(prefix[0]), prefix[1])
+
+# Returns true if prefix a contains prefix b
+def prefixContains(a, b):
+  return a[1] <= b[1] and (b[0] & prefixMask(a[1])) == a[0]
+
+# Returns the intersection of two prefixes (they are either nested or disjoint), or None
+def prefixIntersection(a, b):
+  if prefixContains(a, b):
+    return b
+  if prefixContains(b, a):
+    return a
+  return None
+
+# Returns true if a FlowRule matches the given packet fields
+def ruleMatches(rule, srcip, dstip, protocol, in_port = None):
+  if rule.protocol is not None and rule.protocol != protocol:
+    return False
+  if rule.in_port is not None and rule.in_port != in_port:
+    return False
+  if rule.src is not None and (srcip & prefixMask(rule.src[1])) != rule.src[0]:
+    return False
+  if rule.dst is not None and (dstip & prefixMask(rule.dst[1])) != rule.dst[0]:
+    return False
+  return True
+
+# Returns the highest priority FlowRule matching the packet fields (what a switch
+# holding exactly these rules would apply), or None for a table miss
+def lookupFlowRules(rules, srcip, dstip, protocol, in_port = None):
+  best = None
+  for rule in rules:
+    if (best is None or rule.priority > best.priority) and \
+       ruleMatches(rule, srcip, dstip, protocol, in_port):
+      best = rule
+  return best
+
+
+class PrefixTable (object):
+  """
+  Longest-prefix-match table keyed on 32-bit integer addresses.
+  Entries are grouped by prefix length; a lookup masks the address once per
+  distinct length (most specific first) and does a dict lookup.
+  """
+
+  def __init__ (self, entries = ()):
+    self._tables = {}
+    self._levels = []
+    for prefix, value in entries:
+      self.add(prefix, value)
+
+  # Adds (or replaces) the value for a (network, length) prefix
+  def add(self, prefix, value):
+    network, length = prefix
+    self._tables.setdefault(length, {})[network] = value
+    self._levels = [(prefixMask(l), self._tables[l])
+                    for l in sorted(self._tables, reverse=True)]
+
+  # Returns the value of the most specific prefix containing address, or default
+  def lookup(self, address, default = None):
+    for mask, table in self._levels:
+      value = table.get(address & mask)
+      if value is not None:
+        return value
+    return default
+
+  # Iterates over ((network, length), value) pairs
+  def items(self):
+    for length, table in self._tables.items():
+      for network, value in table.items():
+        yield ((network, length), value)
+
+  def __len__ (self):
+    return sum(len(table) for table in self._tables.values())
+
+
+class CompiledPolicy (object):
+  """
+  Compiled form of the controller policy.
+
+  forwardingTables maps dpid -> list of (prefix string, output port). A port of
+  None means there is no route to the prefix (its traffic is ignored).
+  accessRules is an ordered list of (dpid or None, protocol name, source prefix,
+  destination prefix, ALLOW or DROP); the first matching rule wins and traffic
+  that is allowed (or matches no rule) is looked up in the forwarding table.
+
+  ACL compilation: every distinct source (and destination) prefix used by a
+  rule is put in a PrefixTable. Because prefixes are either nested or
+  disjoint, the most specific matching prefix determines exactly which rule
+  prefixes contain an address, so (dpid, protocol class, source class,
+  destination class) -> first matching rule can be precomputed for every
+  combination.
+
+  bands gives every access rule the priority band its entries get in
+  aggregateRules, counted down from the top. Compiled with the policy it
+  replaces as previous, rules both policies have keep their bands and new rules
+  go in the gaps between them, so a reload only touches the bands of the rules
+  that changed.
+  """
+
+  def __init__ (self, forwardingTables, accessRules, previous = None):
+    self.forwardingTables = dict((dpid, list(entries))
+                                 for dpid, entries in forwardingTables.items())
+    self.accessRules = list(accessRules)
+    self.bands = self._numberBands(previous)
+
+    rules = []
+    for dpid, protocol, src, dst, action in self.accessRules:
+      rules.append((dpid, PROTOCOL_CLASSES[protocol], parsePrefix(src),
+                    parsePrefix(dst), action, protocol))
+
+    self._srcClasses = PrefixTable((rule[2], rule[2]) for rule in rules)
+    self._dstClasses = PrefixTable((rule[3], rule[3]) for rule in rules)
+    srcClasses = [None] + [prefix for prefix, _ in self._srcClasses.items()]
+    dstClasses = [None] + [prefix for prefix, _ in self._dstClasses.items()]
+
+    # Shared verdict tuples so that classification never allocates
+    self._verdicts = {}
+
+    dpids = set(self.forwardingTables)
+    dpids.update(rule[0] for rule in rules if rule[0] is not None)
+    self._acl = {}
+    for dpid in list(dpids) + [None]:
+      applicable = [rule for rule in rules if rule[0] is None or rule[0] == dpid]
+      table = {}
+      for protocolClass in (0, 1, 2):
+        for srcClass in srcClasses:
+          for dstClass in dstClasses:
+            verdict = self._firstMatch(applicable, protocolClass, srcClass, dstClass)
+            if verdict is not None:
+              table[(protocolClass, srcClass, dstClass)] = verdict
+      self._acl[dpid] = table
+
+    self._ignore = self.verdict(IGNORE)
+    self._forward = {}
+    for dpid, entries in self.forwardingTables.items():
+      self._forward[dpid] = self._forwardingTable(entries)
+    self._noForwarding = PrefixTable()
+
+  # Bands of the access rules, BAND_GAP apart (less if there are too many rules)
+  # with a gap above the first, or kept from previous where the rules are the same
+  def _numberBands(self, previous):
+    count = len(self.accessRules)
+    gap = min(BAND_GAP, AGGREGATE_BANDS // (count + 1))
+    fresh = [(i + 1) * gap if gap else i for i in range(count)]
+    if previous is None:
+      return fresh
+    bands = [None] * count
+    matcher = difflib.SequenceMatcher(None, previous.accessRules, self.accessRules,
+                                      autojunk=False)
+    for i, j, size in matcher.get_matching_blocks():
+      bands[j:j + size] = previous.bands[i:i + size]
+    # Each run of new rules is spread over the gap between its neighbours' bands
+    start = 0
+    while start < count:
+      if bands[start] is not None:
+        start += 1
+        continue
+      end = start
+      while end < count and bands[end] is None:
+        end += 1
+      low = bands[start - 1] if start > 0 else -1
+      high = bands[end] if end < count else AGGREGATE_BANDS
+      if high - low - 1 < end - start:
+        return fresh
+      for k in range(end - start):
+        bands[start + k] = low + (high - low) * (k + 1) // (end - start + 1)
+      start = end
+    return bands
+
+  def _forwardingTable(self, entries):
+    return PrefixTable((parsePrefix(prefix),
+                        self.verdict(FORWARD, port) if port is not None else self._ignore)
+                       for prefix, port in entries)
+
+  # Returns a copy of this policy with the forwarding tables of the switches in
+  # forwardingTables replaced. The compiled access rules are shared.
+  def withForwarding(self, forwardingTables):
+    policy = copy.copy(self)
+    policy.forwardingTables = dict(self.forwardingTables)
+    policy._forward = dict(self._forward)
+    for dpid, entries in forwardingTables.items():
+      policy.forwardingTables[dpid] = list(entries)
+      policy._forward[dpid] = self._forwardingTable(entries)
+    return policy
+
+  # Returns the shared verdict tuple for (action, argument)
+  def verdict(self, action, argument = None):
+    return self._verdicts.setdefault((action, argument), (action, argument))
+
+  # Finds the first rule matching the given classes. Rules that match on a
+  # prefix match an address class only if the class prefix is inside it.
+  def _firstMatch(self, rules, protocolClass, srcClass, dstClass):
+    for dpid, ruleProtocol, src, dst, action, protocol in rules:
+      if ruleProtocol != 0 and ruleProtocol != protocolClass:
+        continue
+      if not self._classInPrefix(srcClass, src):
+        continue
+      if not self._classInPrefix(dstClass, dst):
+        continue
+      if action == ALLOW:
+        return self.verdict(ALLOW)
+      return self.verdict(DROP, protocol)
+    return None
+
+  def _classInPrefix(self, addressClass, prefix):
+    if prefix[1] == 0:
+      return True
+    return addressClass is not None and prefixContains(prefix, addressClass)
+
+  # Classifies an IPv4 packet given integer addresses and the IP protocol number
+  def classify(self, dpid, srcip, dstip, protocol):
+    acl = self._acl.get(dpid)
+    if acl is None:
+      acl = self._acl[None]
+    verdict = acl.get((PROTOCOL_NUMBER_CLASSES.get(protocol, 0),
+                       self._srcClasses.lookup(srcip),
+                       self._dstClasses.lookup(dstip)))
+    if verdict is not None and verdict[0] == DROP:
+      return verdict
+    return self._forward.get(dpid, self._noForwarding).lookup(dstip, self._ignore)
+
+  # The compiled access rules, for evaluating the policy in bulk: (source classes,
+  # destination classes, {dpid or None for the other switches: {(protocol class,
+  # source class, destination class): verdict}}). Classes are the rule prefixes
+  # (network, length); an address belongs to the most specific one containing it, or
+  # to class None. Combinations missing from a table match no access rule.
+  def accessTables(self):
+    return ([prefix for prefix, _ in self._srcClasses.items()],
+            [prefix for prefix, _ in self._dstClasses.items()],
+            dict((dpid, dict(table)) for dpid, table in self._acl.items()))
+
+  # Applicable access rules for a switch, in order, with parsed prefixes and bands
+  def _switchRules(self, dpid):
+    return [(PROTOCOL_CLASSES[protocol], parsePrefix(src), parsePrefix(dst), action, band)
+            for (ruleDpid, protocol, src, dst, action), band in zip(self.accessRules, self.bands)
+            if ruleDpid is None or ruleDpid == dpid]
+
+  # Destination-prefix rules with wildcarded sources and in_ports for a switch.
+  # Each access rule gets its own priority band, above all later rules and the
+  # forwarding entries, so the first matching access rule still wins. Band b starts
+  # b * AGGREGATE_BAND below AGGREGATE_TOP_PRIORITY (see bands):
+  #   - a DROP rule is a single drop entry,
+  #   - an ALLOW rule is expanded into the forwarding entries that overlap its
+  #     destination prefix (restricted to its source and protocol), plus a drop for
+  #     the rest of its region.
+  # Forwarding entries sit in the lowest band ordered by prefix length so that the
+  # switch does the longest prefix match, above a catch-all drop for IP traffic
+  # the policy would implicitly drop. Those use priorities from priority upwards.
+  def aggregateRules(self, dpid, priority):
+    band = AGGREGATE_BAND
+    rules = self._switchRules(dpid)
+    top = AGGREGATE_TOP_PRIORITY + 1 - band
+    if rules and top - rules[-1][4] * band <= priority + band - 1:
+      raise ValueError("%d access rules do not fit above priority %d" % (len(rules), priority))
+    forwarding = [(parsePrefix(prefix), port)
+                  for prefix, port in self.forwardingTables.get(dpid, [])]
+    flowRules = [FlowRule(priority, None, None, None, None, DROP, None)]
+    for dst, port in forwarding:
+      flowRules.append(self._forwardRule(priority + 1 + dst[1], None, None, dst, port))
+    for protocolClass, src, dst, action, ruleBand in rules:
+      bandPriority = top - ruleBand * band
+      protocol = CLASS_PROTOCOL_NUMBERS[protocolClass] if protocolClass != 0 else None
+      src = src if src[1] > 0 else None
+      flowRules.append(FlowRule(bandPriority, protocol, src, dst if dst[1] > 0 else None,
+                                None, DROP, None))
+      if action != ALLOW:
+        continue
+      for forwardDst, port in forwarding:
+        region = prefixIntersection(dst, forwardDst)
+        if region is not None:
+          flowRules.append(self._forwardRule(bandPriority + 1 + forwardDst[1], protocol, src,
+                                             region if region[1] > 0 else None, port))
+    return flowRules
+
+  # Forwards out of port, or drops if there is no route (port None)
+  def _forwardRule(self, priority, protocol, src, dst, port):
+    if port is None:
+      return FlowRule(priority, protocol, src, dst, None, DROP, None)
+    return FlowRule(priority, protocol, src, dst, None, FORWARD, port)
+
+  # Exact source/destination rules for every ordered pair of known hosts on a switch.
+  # Pairs whose verdict does not depend on the protocol get a single rule matching all
+  # IP traffic; otherwise the ICMP and TCP verdicts get protocol-specific rules one
+  # priority above it. Implicitly dropped traffic gets an explicit drop so that it does
+  # not reach the controller either.
+  def pairRules(self, dpid, hosts, priority):
+    addresses = [ipToInt(host) for host in hosts]
+    rules = []
+    for src in addresses:
+      for dst in addresses:
+        if src == dst:
+          continue
+        verdicts = [self.classify(dpid, src, dst, protocol)
+                    for protocol in CLASS_PROTOCOL_NUMBERS]
+        rules.append(self._pairRule(priority, None, src, dst, verdicts[0]))
+        for protocol, verdict in zip(CLASS_PROTOCOL_NUMBERS[1:], verdicts[1:]):
+          if verdict != verdicts[0]:
+            rules.append(self._pairRule(priority + 1, protocol, src, dst, verdict))
+    return rules
+
+  def _pairRule(self, priority, protocol, src, dst, verdict):
+    action, argument = verdict
+    if action == FORWARD:
+      return FlowRule(priority, protocol, (src, 32), (dst, 32), None, FORWARD, argument)
+    return FlowRule(priority, protocol, (src, 32), (dst, 32), None, DROP, None)
+
+
+# Highest priority of the rules aggregateRules builds, and the priorities of each
+# access rule's band: one per prefix length plus one for the band's drop
+AGGREGATE_TOP_PRIORITY = 0xffff
+AGGREGATE_BAND = 34
+
+# Bands that fit above OpenFlow's default priority (0x8000, where the controller
+# puts the forwarding entries), and the gap between the bands of neighbouring rules
+# when they are first numbered, which leaves room for rules inserted later
+AGGREGATE_BANDS = (AGGREGATE_TOP_PRIORITY + 1 - 0x8000) // AGGREGATE_BAND - 1
+BAND_GAP = 8
+
+# Splits the change from one list of FlowRules to another into the rules to add, the
+# rules whose action or port changed (same match and priority) and the rules to delete
+def diffRules(old, new):
+  oldRules = dict((rule[:5], rule) for rule in old)
+  newKeys = set(rule[:5] for rule in new)
+  adds = [rule for rule in new if rule[:5] not in oldRules]
+  modifies = [rule for rule in new
+              if rule[:5] in oldRules and oldRules[rule[:5]] != rule]
+  deletes = [rule for rule in old if rule[:5] not in newKeys]
+  return adds, modifies, deletes
+
+# Matches covering every reactive flow whose verdict may differ between two compiled
+# policies, as {dpid, or None for every switch: [FlowRule]} with only src and dst
+# set. Access rules that were added or removed (all of them if the remaining ones
+# were reordered) cover their prefixes on every switch, since drops may sit at the
+# source's ingress. The protocol is left wildcarded: a delete only removes flows at
+# least as specific as its match, and drops for "IP" rules match any protocol.
+# Changed forwarding entries cover their destination prefix on their own switch.
+def changedFlowMatches(old, new):
+  changes = {}
+  common = [rule for rule in old.accessRules if rule in new.accessRules]
+  if common == [rule for rule in new.accessRules if rule in old.accessRules]:
+    changed = [rule for rule in old.accessRules + new.accessRules if rule not in common]
+  else:
+    changed = old.accessRules + new.accessRules
+  for ruleDpid, protocol, src, dst, action in changed:
+    src, dst = parsePrefix(src), parsePrefix(dst)
+    changes.setdefault(None, set()).add(FlowRule(
+      None, None, src if src[1] > 0 else None, dst if dst[1] > 0 else None,
+      None, None, None))
+  for dpid in set(old.forwardingTables) | set(new.forwardingTables):
+    oldEntries = set((parsePrefix(prefix), port)
+                     for prefix, port in old.forwardingTables.get(dpid, []))
+    newEntries = set((parsePrefix(prefix), port)
+                     for prefix, port in new.forwardingTables.get(dpid, []))
+    for dst, port in oldEntries ^ newEntries:
+      changes.setdefault(dpid, set()).add(FlowRule(
+        None, None, None, dst if dst[1] > 0 else None, None, None, None))
+  return dict((dpid, sorted(matches)) for dpid, matches in changes.items())
+
+
+class PolicySpec (object):
+  """
+  Everything the controller knows about the network: where each host is attached
+  (and its MAC address), the links between switches, the networks behind
+  switches, and the ordered access rules. Read from a policy file, JSON or (with
+  PyYAML installed) YAML, of the form:
+
+    {"hosts": {"30.1.4.66": {"switch": 2, "port": 2, "mac": "00:00:00:00:00:66"}},
+     "links": [[1, 1, 2, 1]],
+     "routes": [["0.0.0.0/0", 1]],
+     "access_rules": [{"switch": null, "protocol": "TCP", "src": "104.24.32.100/32",
+                       "dst": "30.1.4.66/32", "action": "drop"}]}
+
+  A link is [dpid, port, dpid, port], a route is [prefix, dpid of the switch the
+  network is behind] and "switch": null applies a rule everywhere. Forwarding
+  tables are computed from these by final_routing.Router, unless the file gives
+  them as "forwarding": {"<dpid>": [[prefix, port], ...]}.
+  """
+
+  def __init__ (self, hosts, links, forwarding, accessRules, routes = ()):
+    # ip -> (dpid, port, mac or None)
+    self.hosts = hosts
+    # [(dpid, port, dpid, port)]
+    self.links = links
+    # dpid -> [(prefix, port)], or None to route
+    self.forwarding = forwarding
+    # [(dpid or None, protocol, source prefix, destination prefix, action)]
+    self.accessRules = accessRules
+    # [(prefix, dpid)]
+    self.routes = list(routes)
+
+  # Reads a policy file. Raises ValueError (or IOError) if it cannot be used.
+  @classmethod
+  def load(cls, path):
+    with open(path) as policyFile:
+      text = policyFile.read()
+    isYAML = path.endswith((".yaml", ".yml"))
+    if isYAML and yaml is None:
+      raise ValueError("%s: YAML policy files need PyYAML" % path)
+    try:
+      if isYAML:
+        document = yaml.safe_load(text)
+      else:
+        document = json.loads(text)
+    except PolicyParseErrors as e:
+      raise ValueError("%s: %s" % (path, e))
+    try:
+      return cls.fromDocument(document)
+    except (KeyError, TypeError, AttributeError, ValueError, socket.error) as e:
+      raise ValueError("%s: bad policy: %s" % (path, e))
+
+  @classmethod
+  def fromDocument(cls, document):
+    hosts = {}
+    for ip, host in document["hosts"].items():
+      mac = host.get("mac")
+      hosts[intToIP(ipToInt(ip))] = (int(host["switch"]), int(host["port"]),
+                                     str(mac) if mac is not None else None)
+    links = [tuple(int(value) for value in link) for link in document.get("links", [])]
+    for link in links:
+      if len(link) != 4:
+        raise ValueError("link %s is not [switch, port, switch, port]" % (list(link),))
+    for route in document.get("routes", []):
+      if len(route) != 2:
+        raise ValueError("route %s is not [prefix, switch]" % (route,))
+    routes = [(prefixString(parsePrefix(str(prefix))), int(dpid))
+              for prefix, dpid in document.get("routes", [])]
+    forwarding = None
+    if "forwarding" in document:
+      forwarding = {}
+      for dpid, entries in document["forwarding"].items():
+        forwarding[int(dpid)] = [(prefixString(parsePrefix(str(prefix))),
+                                  int(port) if port is not None else None)
+                                 for prefix, port in entries]
+    accessRules = []
+    for rule in document.get("access_rules", []):
+      if rule["protocol"] not in PROTOCOL_CLASSES:
+        raise ValueError("unknown protocol %s" % rule["protocol"])
+      if rule["action"] not in (ALLOW, DROP):
+        raise ValueError("unknown action %s" % rule["action"])
+      switch = rule.get("switch")
+      accessRules.append((int(switch) if switch is not None else None,
+                          str(rule["protocol"]),
+                          prefixString(parsePrefix(str(rule["src"]))),
+                          prefixString(parsePrefix(str(rule["dst"]))),
+                          str(rule["action"])))
+    return cls(hosts, links, forwarding, accessRules, routes)
+
+  def toDocument(self):
+    document = {
+      "hosts": dict((ip, {"switch": dpid, "port": port, "mac": mac})
+                    for ip, (dpid, port, mac) in self.hosts.items()),
+      "links": [list(link) for link in self.links],
+      "routes": [list(route) for route in self.routes],
+      "access_rules": [{"switch": dpid, "protocol": protocol, "src": src, "dst": dst,
+                        "action": action}
+                       for dpid, protocol, src, dst, action in self.accessRules],
+    }
+    if self.forwarding is not None:
+      document["forwarding"] = dict((str(dpid), [list(entry) for entry in entries])
+                                    for dpid, entries in self.forwarding.items())
+    return document
+
+  # Switch graph of the links, with every switch a host is attached to
+  def router(self):
+    import final_routing  # final_routing imports this module
+    return final_routing.Router(self.links, set(dpid for dpid, port, mac in self.hosts.values()))
+
+  # dpid -> [(prefix, port)], given or routed
+  def forwardingTables(self):
+    if self.forwarding is not None:
+      return self.forwarding
+    return self.router().forwardingTables(self.hostLocations(), self.routes)
+
+  # previous is the compiled policy this one replaces, whose priority bands are kept
+  # (see CompiledPolicy)
+  def compile(self, previous = None):
+    return CompiledPolicy(self.forwardingTables(), self.accessRules, previous)
+
+  # IP addresses of every host, in address order
+  def knownHosts(self):
+    return sorted(self.hosts, key=ipToInt)
+
+  # ip -> (dpid, port) the host is attached to
+  def hostLocations(self):
+    return dict((ip, (dpid, port)) for ip, (dpid, port, mac) in self.hosts.items())
+
+  # ip -> MAC address of every host that has one
+  def hostMACs(self):
+    return dict((ip, mac) for ip, (dpid, port, mac) in self.hosts.items()
+                if mac is not None)
+
+  # (dpid, port) of both ends of every link -> the other end
+  def switchLinks(self):
+    links = {}
+    for dpid1, port1, dpid2, port2 in self.links:
+      links[(dpid1, port1)] = (dpid2, port2)
+      links[(dpid2, port2)] = (dpid1, port1)
+    return links
+
+
+class DecisionCache (object):
+  """
+  Cache of classifier verdicts keyed by (dpid, in_port, source, destination,
+  IP protocol).
+
+  Entries live for ttl seconds, matching the flow timeout, and the cache holds at
+  most size entries. Once full the oldest inserted entry is evicted; since every
+  entry expires after ttl anyway this approximates LRU while keeping a hit to a
+  single dict lookup. invalidate() must be called whenever the policy changes.
+  """
+
+  def __init__ (self, size = 4096, ttl = 50):
+    self.size = size
+    self.ttl = ttl
+    self._entries = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    self.expirations = 0
+    self.evictions = 0
+    self.invalidations = 0
+
+  # Returns the cached verdict for key, or None if missing or expired
+  def get(self, key, now):
+    entry = self._entries.get(key)
+    if entry is not None:
+      if now < entry[1]:
+        self.hits += 1
+        return entry[0]
+      del self._entries[key]
+      self.expirations += 1
+    self.misses += 1
+    return None
+
+  def put(self, key, verdict, now):
+    if key in self._entries:
+      del self._entries[key]
+    elif len(self._entries) >= self.size:
+      self._entries.popitem(last=False)
+      self.evictions += 1
+    self._entries[key] = (verdict, now + self.ttl)
+
+  # Drops every entry, e.g. after the policy changed
+  def invalidate(self):
+    self._entries.clear()
+    self.invalidations += 1
+
+  def stats(self):
+    return {
+      "entries": len(self._entries),
+      "hits": self.hits,
+      "misses": self.misses,
+      "expirations": self.expirations,
+      "evictions": self.evictions,
+      "invalidations": self.invalidations,
+    }
+
+  def __len__ (self):
+    return len(self._entries)
+
+
+class ArpTable (dict):
+  """
+  IP -> MAC addresses the ARP proxy answers with, seeded from the policy's hosts
+  and learned from ARP packets. Learned addresses replace seeded ones. reseed()
+  switches to another policy's hosts: seeded addresses the new policy no longer
+  has are forgotten, learned ones are kept.
+  """
+
+  def __init__ (self, seeded = ()):
+    dict.__init__(self, seeded)
+    self.learned = set()
+
+  def learn(self, ip, mac):
+    self[ip] = mac
+    self.learned.add(ip)
+
+  def reseed(self, seeded):
+    for ip in list(self):
+      if ip not in seeded and ip not in self.learned:
+        del self[ip]
+    for ip, mac in seeded.items():
+      if ip not in self.learned:
+        self[ip] = mac
+
+
+class MacTable (object):
+  """
+  MAC addresses learned on each switch: (dpid, MAC) -> port it was last seen on.
+
+  An address not seen for aging seconds is forgotten. Each switch holds at most
+  size addresses; once full, the one seen longest ago is evicted, so a host
+  cycling through source addresses only pushes out stale entries of its own
+  switch.
+  """
+
+  def __init__ (self, size = 4096, aging = 300):
+    self.size = size
+    self.aging = aging
+    # dpid -> OrderedDict of MAC -> (port, time last seen), oldest first
+    self._switches = {}
+    self.learned = 0
+    self.moves = 0
+    self.expirations = 0
+    self.evictions = 0
+
+  # Records mac as seen on port of switch dpid. Returns the port it was on before if
+  # it moved, otherwise None.
+  def learn(self, dpid, mac, port, now):
+    entries = self._switches.get(dpid)
+    if entries is None:
+      entries = self._switches[dpid] = OrderedDict()
+    entry = entries.pop(mac, None)
+    if entry is None:
+      self.learned += 1
+      if len(entries) >= self.size:
+        entries.popitem(last=False)
+        self.evictions += 1
+    entries[mac] = (port, now)
+    if entry is not None and entry[0] != port and now - entry[1] < self.aging:
+      self.moves += 1
+      return entry[0]
+    return None
+
+  # Port mac was learned on at switch dpid, or None if unknown or aged out
+  def lookup(self, dpid, mac, now):
+    entries = self._switches.get(dpid)
+    if entries is None:
+      return None
+    entry = entries.get(mac)
+    if entry is None:
+      return None
+    if now - entry[1] >= self.aging:
+      del entries[mac]
+      self.expirations += 1
+      return None
+    return entry[0]
+
+  # Forgets everything learned on switch dpid, e.g. when it disconnects
+  def clear(self, dpid):
+    self._switches.pop(dpid, None)
+
+  def stats(self):
+    return {
+      "entries": sum(len(entries) for entries in self._switches.values()),
+      "learned": self.learned,
+      "moves": self.moves,
+      "expirations": self.expirations,
+      "evictions": self.evictions,
+    }
+
+
+# Rule classes a FlowTable may evict, least valuable first: single-frame flood
+# rules before drops (their traffic comes back as PacketIns, not lost) before
+# forwarding rules. Anything else (proactive rules, ARP, blocks) is never evicted.
+EVICTABLE_CLASSES = ("flood", "unicast", "drop", "forward")
+
+class FlowTable (object):
+  """
+  Shadow of one switch's flow table: every flow the controller installed, keyed
+  by (priority, match) as the caller encodes it, oldest (least recently
+  installed) first, with its rule class, match object and the time it looks
+  expired by from its timeouts.
+
+  With a capacity, needsEviction() turns true once the table is highWater full,
+  and evictions() then picks entries to delete to bring it down to lowWater:
+  first evictable entries that look expired (the switch has probably removed
+  them without telling), then the least valuable class, least recently
+  installed first. A table full error from the switch lowers the capacity to
+  what is installed.
+  """
+
+  def __init__ (self, capacity = None, highWater = 0.95, lowWater = 0.85,
+                clock = time.time):
+    self.capacity = capacity
+    self.highWater = highWater
+    self.lowWater = lowWater
+    self.clock = clock
+    # key -> [rule class, match, priority, looks expired at or None]
+    self._entries = OrderedDict()
+    # xid of recent flow mods -> key, to trace errors back to flows
+    self._xids = OrderedDict()
+    self.installed = 0
+    self.removed = 0
+    self.evicted = 0
+    self.failed = 0
+    self.tableFull = 0
+
+  def add(self, key, ruleClass, match, priority, idleTimeout, hardTimeout, xid = None):
+    now = self.clock()
+    timeout = idleTimeout or hardTimeout
+    expires = now + timeout if timeout else None
+    self._entries.pop(key, None)
+    self._entries[key] = [ruleClass, match, priority, expires]
+    self.installed += 1
+    if xid is not None:
+      self._xids[xid] = key
+      if len(self._xids) > 1024:
+        self._xids.popitem(last=False)
+
+  # Forgets a flow, e.g. on FlowRemoved. Returns false if it was not known.
+  def remove(self, key):
+    if self._entries.pop(key, None) is None:
+      return False
+    self.removed += 1
+    return True
+
+  # Forgets every flow whose match object covered(match) is true for, e.g. after
+  # a non-strict delete. Returns how many.
+  def removeCovered(self, covered):
+    keys = [key for key, entry in self._entries.items() if covered(entry[1])]
+    for key in keys:
+      del self._entries[key]
+    self.removed += len(keys)
+    return len(keys)
+
+  # The flow mod with this xid failed. tableFull tells whether the switch said its
+  # table was full. Returns the key of the flow, or None if it is not known.
+  def flowModFailed(self, xid, tableFull = False):
+    key = self._xids.pop(xid, None)
+    if key is not None and self._entries.pop(key, None) is not None:
+      self.failed += 1
+    if tableFull:
+      self.tableFull += 1
+      if self.capacity is None or len(self._entries) < self.capacity:
+        self.capacity = max(1, len(self._entries))
+    return key
+
+  def needsEviction(self):
+    return self.capacity is not None and \
+           len(self._entries) >= self.capacity * self.highWater
+
+  # Removes and returns [(key, match, priority)] of the entries to evict
+  def evictions(self):
+    count = len(self._entries) - int(self.capacity * self.lowWater)
+    if count <= 0:
+      return []
+    now = self.clock()
+    chosen = []
+    for key, (ruleClass, match, priority, expires) in self._entries.items():
+      if len(chosen) >= count:
+        break
+      if ruleClass in EVICTABLE_CLASSES and expires is not None and expires <= now:
+        chosen.append(key)
+    for ruleClass in EVICTABLE_CLASSES:
+      if len(chosen) >= count:
+        break
+      picked = set(chosen)
+      for key, entry in self._entries.items():
+        if len(chosen) >= count:
+          break
+        if entry[0] == ruleClass and key not in picked:
+          chosen.append(key)
+    result = []
+    for key in chosen:
+      ruleClass, match, priority, expires = self._entries.pop(key)
+      result.append((key, match, priority))
+    self.evicted += len(result)
+    return result
+
+  def stats(self):
+    classes = {}
+    for entry in self._entries.values():
+      classes[entry[0]] = classes.get(entry[0], 0) + 1
+    return {
+      "entries": len(self._entries),
+      "capacity": self.capacity,
+      "classes": classes,
+      "installed": self.installed,
+      "removed": self.removed,
+      "evicted": self.evicted,
+      "failed": self.failed,
+      "table_full": self.tableFull,
+    }
+
+  def __len__ (self):
+    return len(self._entries)
+
+
+# Classes of rules the controller installs; all but "proactive" get their own
+# timeouts. The flow cookie of a rule is its class's index + 1, so FlowRemoved and
+# flow stats can be traced back to a class.
+RULE_CLASSES = ("forward", "drop", "arp", "flood", "block", "unicast", "proactive")
+
+def ruleClassCookie(ruleClass):
+  return RULE_CLASSES.index(ruleClass) + 1
+
+def cookieRuleClass(cookie):
+  if 1 <= cookie <= len(RULE_CLASSES):
+    return RULE_CLASSES[cookie - 1]
+  return None
+
+
+# What a PacketIn went over the budget of (see PacketInLimiter)
+LIMIT_PORT = "port"
+LIMIT_SOURCE = "source"
+
+class PacketInLimiter (object):
+  """
+  Token buckets capping the PacketIn rate of every switch port (dpid, in_port)
+  and of every source IP address, in PacketIns per second with bursts of up to
+  burst. Either limit can be turned off by leaving its rate None.
+
+  A PacketIn over budget is refused and the caller is told to block its port or
+  source on that switch for blockTime seconds, once per block, so the switch drops
+  the traffic itself instead of punting every packet. Ports in exempt (the links
+  between switches, which carry everybody's traffic) only have per-source limits.
+  At most maxSources source buckets are kept; full ones are forgotten first.
+  """
+
+  def __init__ (self, portRate = None, portBurst = None, sourceRate = None,
+                sourceBurst = None, blockTime = 10, exempt = (), maxSources = 65536,
+                clock = time.time):
+    self.portRate = portRate
+    self.portBurst = portBurst if portBurst is not None else portRate
+    self.sourceRate = sourceRate
+    self.sourceBurst = sourceBurst if sourceBurst is not None else sourceRate
+    self.blockTime = blockTime
+    self.exempt = frozenset(exempt)
+    self.maxSources = maxSources
+    self.clock = clock
+    self._ports = {}
+    self._sources = {}
+    # (kind, dpid, port or source) -> time the block on the switch expires
+    self._blocks = {}
+    self._limited = {}
+    self.admitted = 0
+    self.refused = {LIMIT_PORT: 0, LIMIT_SOURCE: 0}
+    self.blocks = {LIMIT_PORT: 0, LIMIT_SOURCE: 0}
+
+  # Takes a token from the bucket of key, creating it full. False if it is empty.
+  def _take(self, buckets, key, rate, burst, now):
+    bucket = buckets.get(key)
+    if bucket is None:
+      bucket = buckets[key] = [burst, now]
+    else:
+      bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+      bucket[1] = now
+    if bucket[0] < 1:
+      return False
+    bucket[0] -= 1
+    return True
+
+  # Charges a PacketIn from in_port of switch dpid sent by srcip (an integer, None
+  # for non-IP frames). Returns None if it is admitted, otherwise (kind, block):
+  # kind is LIMIT_PORT or LIMIT_SOURCE, and block is true if the caller should
+  # install a block for it now.
+  def admit(self, dpid, in_port, srcip):
+    now = self.clock()
+    kind = None
+    if self.portRate is not None and (dpid, in_port) not in self.exempt:
+      if not self._take(self._ports, (dpid, in_port), self.portRate, self.portBurst, now):
+        kind, key = LIMIT_PORT, in_port
+    if kind is None and self.sourceRate is not None and srcip is not None:
+      if len(self._sources) >= self.maxSources and srcip not in self._sources:
+        self._forget(now)
+      if not self._take(self._sources, srcip, self.sourceRate, self.sourceBurst, now):
+        kind, key = LIMIT_SOURCE, srcip
+    if kind is None:
+      self.admitted += 1
+      return None
+    self.refused[kind] += 1
+    block = (kind, dpid, key)
+    self._limited[block] = self._limited.get(block, 0) + 1
+    if self._blocks.get(block, 0) > now:
+      return (kind, False)
+    self._blocks[block] = now + self.blockTime
+    self.blocks[kind] += 1
+    return (kind, True)
+
+  # Drops source buckets that have refilled (a new bucket would be the same) and
+  # expired blocks. If every source is still busy, the whole table is reset.
+  def _forget(self, now):
+    rate, burst = self.sourceRate, self.sourceBurst
+    for srcip, (tokens, last) in list(self._sources.items()):
+      if tokens + (now - last) * rate >= burst:
+        del self._sources[srcip]
+    if len(self._sources) >= self.maxSources:
+      self._sources.clear()
+    for block, expires in list(self._blocks.items()):
+      if expires <= now:
+        del self._blocks[block]
+        self._limited.pop(block, None)
+
+  # Returns (kind, dpid, port or source, refused PacketIns) for the count ports and
+  # sources with the most refused PacketIns
+  def topLimited(self, count = 5):
+    ranked = sorted(self._limited.items(), key=lambda item: -item[1])[:count]
+    return [block + (refused,) for block, refused in ranked]
+
+  def stats(self):
+    now = self.clock()
+    return {
+      "admitted": self.admitted,
+      "refused_port": self.refused[LIMIT_PORT],
+      "refused_source": self.refused[LIMIT_SOURCE],
+      "port_blocks": self.blocks[LIMIT_PORT],
+      "source_blocks": self.blocks[LIMIT_SOURCE],
+      "active_blocks": sum(1 for expires in self._blocks.values() if expires > now),
+      "tracked_sources": len(self._sources),
+      "top_limited": self.topLimited(),
+    }
+
+
+class FlowTimeouts (object):
+  """
+  Idle and hard timeouts (seconds, 0 = none) for each class of rule.
+
+  In adaptive mode the controller reports every FlowRemoved message here. After
+  every window removals of a class its timeouts are adjusted from how the flows
+  were used:
+    - most flows were still being reused when the hard timeout evicted them:
+      double the hard timeout (up to maximum) so they stop being re-punted,
+    - most flows idled out after at most one packet: halve the idle timeout
+      (down to minimum) so single-use rules free their table slots sooner,
+    - almost no flow was single-use: move the idle timeout back up towards its
+      configured value.
+  """
+
+  def __init__ (self, profiles, adaptive = False, minimum = 5, maximum = 3600,
+                window = 20):
+    self.configured = dict(profiles)
+    self.profiles = dict(profiles)
+    self.adaptive = adaptive
+    self.minimum = minimum
+    self.maximum = maximum
+    self.window = window
+    self._stats = dict((ruleClass, self._emptyStats()) for ruleClass in self.profiles)
+    self._recent = dict((ruleClass, [0, 0, 0]) for ruleClass in self.profiles)
+
+  def _emptyStats(self):
+    return {"removed": 0, "packets": 0, "bytes": 0, "duration": 0,
+            "evicted_in_use": 0, "single_use": 0, "adjustments": 0}
+
+  # Returns (idle_timeout, hard_timeout) for a class of rule
+  def get(self, ruleClass):
+    return self.profiles[ruleClass]
+
+  # Records a removed flow. hardTimeout/idleTimeout tell why it was removed.
+  def flowRemoved(self, ruleClass, idleTimeout, hardTimeout, duration, packets, bytes):
+    stats = self._stats.get(ruleClass)
+    if stats is None:
+      return
+    stats["removed"] += 1
+    stats["packets"] += packets
+    stats["bytes"] += bytes
+    stats["duration"] += duration
+    recent = self._recent[ruleClass]
+    recent[0] += 1
+    if hardTimeout and packets > 1:
+      stats["evicted_in_use"] += 1
+      recent[1] += 1
+    elif idleTimeout and packets <= 1:
+      stats["single_use"] += 1
+      recent[2] += 1
+    if self.adaptive and recent[0] >= self.window:
+      self._adjust(ruleClass, recent)
+      self._recent[ruleClass] = [0, 0, 0]
+
+  def _adjust(self, ruleClass, recent):
+    removed, evictedInUse, singleUse = recent
+    idle, hard = self.profiles[ruleClass]
+    configuredIdle = self.configured[ruleClass][0]
+    if hard and evictedInUse * 2 > removed:
+      hard = min(self.maximum, hard * 2)
+    if idle and singleUse * 2 > removed:
+      idle = max(self.minimum, idle // 2)
+    elif idle and singleUse * 10 < removed and idle < configuredIdle:
+      idle = min(configuredIdle, idle * 2)
+    if hard:
+      idle = min(idle, hard)
+    if (idle, hard) != self.profiles[ruleClass]:
+      self.profiles[ruleClass] = (idle, hard)
+      self._stats[ruleClass]["adjustments"] += 1
+
+  def stats(self):
+    result = {}
+    for ruleClass, stats in self._stats.items():
+      result[ruleClass] = dict(stats)
+      result[ruleClass]["idle_timeout"], result[ruleClass]["hard_timeout"] = \
+        self.profiles[ruleClass]
+    return result
+
+
+class LatencyHistogram (object):
+  """
+  Latencies in power-of-two microsecond buckets: bucket b counts latencies of
+  less than 2 ** b microseconds (and at least half that). Recording is one
+  bit_length and one list increment, so it can stay on the PacketIn path.
+  """
+
+  def __init__ (self, buckets = 32):
+    self.counts = [0] * buckets
+    self.count = 0
+    self.total = 0.0
+    self.maximum = 0.0
+
+  def record(self, seconds):
+    bucket = min(int(seconds * 1000000).bit_length(), len(self.counts) - 1)
+    self.counts[bucket] += 1
+    self.count += 1
+    self.total += seconds
+    if seconds > self.maximum:
+      self.maximum = seconds
+
+  # Upper bound in microseconds of the bucket holding the given fraction of latencies
+  def percentile(self, fraction):
+    if self.count == 0:
+      return 0
+    rank = fraction * self.count
+    seen = 0
+    for bucket, count in enumerate(self.counts):
+      seen += count
+      if seen >= rank:
+        return 2 ** bucket
+    return 2 ** (len(self.counts) - 1)
+
+  def stats(self):
+    return {
+      "count": self.count,
+      "mean_us": self.total / self.count * 1000000 if self.count else 0,
+      "p50_us": self.percentile(0.5),
+      "p99_us": self.percentile(0.99),
+      "max_us": self.maximum * 1000000,
+      "buckets": dict((2 ** bucket, count) for bucket, count in enumerate(self.counts)
+                      if count),
+    }
+
+
+class ControllerMetrics (object):
+  """
+  Always-on counters of the controller, shared by all switches:
+    - PacketIns per (dpid, port, verdict action),
+    - flow mods sent per (dpid, rule class),
+    - a LatencyHistogram of PacketIn handling time,
+    - a buffered event log keeping one in every sampleEvery events (0 keeps none),
+      at most capacity of them until they are taken by takeEvents(),
+    - the stats() of components registered with watch(), such as the
+      DecisionCache, PacketInLimiter and each switch's FlowTable.
+  snapshot() returns all of it as plain data; summary() is a one line digest.
+  """
+
+  def __init__ (self, sampleEvery = 100, capacity = 1000, clock = time.time):
+    self.sampleEvery = sampleEvery
+    self.clock = clock
+    self.packetIns = {}
+    self.flowMods = {}
+    self.latency = LatencyHistogram()
+    self.events = deque(maxlen=capacity)
+    self.eventCount = 0
+    self._last = (0, 0)
+    # name -> stats function, and name -> {dpid: stats function} for per switch ones
+    self.sources = {}
+    self.switchSources = {}
+
+  def packetIn(self, dpid, port, action, seconds):
+    key = (dpid, port, action)
+    self.packetIns[key] = self.packetIns.get(key, 0) + 1
+    self.latency.record(seconds)
+
+  def flowMod(self, dpid, ruleClass, count = 1):
+    key = (dpid, ruleClass)
+    self.flowMods[key] = self.flowMods.get(key, 0) + count
+
+  # Records an event (a short name and its details) if it is sampled
+  def event(self, dpid, kind, *details):
+    self.eventCount += 1
+    if self.sampleEvery and self.eventCount % self.sampleEvery == 0:
+      self.events.append((self.clock(), dpid, kind) + details)
+
+  # Returns and clears the buffered events, as (time, dpid, kind, details...)
+  def takeEvents(self):
+    events = list(self.events)
+    self.events.clear()
+    return events
+
+  # Adds what stats() returns to every snapshot under name, per switch if dpid is given
+  def watch(self, name, stats, dpid = None):
+    if dpid is None:
+      self.sources[name] = stats
+    else:
+      self.switchSources.setdefault(name, {})[dpid] = stats
+
+  def unwatch(self, name, dpid = None):
+    if dpid is None:
+      self.sources.pop(name, None)
+    else:
+      self.switchSources.get(name, {}).pop(dpid, None)
+
+  # Counters as nested dicts, only for switch dpid if given:
+  #   packet_ins: {dpid: {port: {action: count}}}, flow_mods: {dpid: {class: count}},
+  #   then each watched component's stats, as {dpid: stats} for per switch ones
+  def snapshot(self, dpid = None):
+    packetIns = {}
+    for (switch, port, action), count in self.packetIns.items():
+      if dpid is None or switch == dpid:
+        ports = packetIns.setdefault(switch, {})
+        ports.setdefault(port, {})[action] = count
+    flowMods = {}
+    for (switch, ruleClass), count in self.flowMods.items():
+      if dpid is None or switch == dpid:
+        flowMods.setdefault(switch, {})[ruleClass] = count
+    result = {
+      "packet_ins": packetIns,
+      "flow_mods": flowMods,
+      "latency": self.latency.stats(),
+      "events": self.eventCount,
+    }
+    for name, stats in self.sources.items():
+      result[name] = stats()
+    for name, switches in self.switchSources.items():
+      result[name] = dict((switch, stats()) for switch, stats in switches.items()
+                          if dpid is None or switch == dpid)
+    return result
+
+  # PacketIns and flow mods in total and since the last summary, and latency
+  def summary(self):
+    packetIns = sum(self.packetIns.values())
+    flowMods = sum(self.flowMods.values())
+    lastPacketIns, lastFlowMods = self._last
+    self._last = (packetIns, flowMods)
+    return "%d PacketIns (+%d), %d flow mods (+%d), p50 %d us, p99 %d us, max %.0f us" % (
+      packetIns, packetIns - lastPacketIns, flowMods, flowMods - lastFlowMods,
+      self.latency.percentile(0.5), self.latency.percentile(0.99),
+      self.latency.maximum * 1000000)
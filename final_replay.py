@@ -0,0 +1,743 @@
+#!/usr/bin/python
+
+# final_replay.py - Offline PacketIn replay harness for the CSE 150 final project
+# Kyle Won, UCSC
+# kwon, 1724327
+# CSE 150 Final Project
+#
+# Feeds synthetic or pcap frames through Final._handle_PacketIn using stand-in
+# Connection and PacketIn objects, without Mininet or a running POX. Each switch of
+# final_topology is emulated with a flow table built from the flow mods the
+# controller sends, so only table misses reach the controller, and frames are
+# followed hop by hop across the switch links. Frames may carry an arrival time, in
+# which case the controller is modelled as a single queue and each PacketIn's delay
+# (queueing plus handling) is recorded too. Needs POX on the path:
+#   $ PYTHONPATH=<pox directory> python final_replay.py [scenario ...] [--pcap=<file>]
+#       [--unbuffered] [--<controller option>[=<value>] ...]
+
+import struct
+import sys
+import time
+
+import pox.openflow.libopenflow_01 as of
+import pox.lib.packet as pkt
+from pox.lib.addresses import IPAddr, EthAddr
+import final_controller
+import final_policy
+from final_controller import Final
+
+# Longest path a frame may take before the replay gives up on it (loop protection)
+MAX_HOPS = 16
+
+# Header fields of an ofp_match
+MatchFields = ("in_port", "dl_src", "dl_dst", "dl_vlan", "dl_vlan_pcp", "dl_type",
+               "nw_tos", "nw_proto", "nw_src", "nw_dst", "tp_src", "tp_dst")
+
+# POX's table of message unpackers, indexed by OpenFlow message type
+Unpackers = of.make_type_to_unpacker_table()
+
+# Splits several packed OpenFlow messages back into message objects
+def unpackMessages(data):
+  msgs = []
+  offset = 0
+  while offset + 4 <= len(data):
+    ofp_type = ord(data[offset + 1:offset + 2])
+    length = struct.unpack_from("!H", data, offset + 2)[0]
+    msgs.append(Unpackers[ofp_type](data, offset)[1])
+    offset += length
+  return msgs
+
+class ReplayConnection (object):
+  """
+  Stand-in for a POX Connection. Records every message the controller sends;
+  messages sent already packed are unpacked and recorded one by one.
+  """
+
+  def __init__ (self, dpid):
+    self.dpid = dpid
+    self.listeners = []
+    self.sent = []
+    self.writes = 0
+
+  def addListeners(self, listener):
+    self.listeners.append(listener)
+
+  def send(self, msg):
+    self.writes += 1
+    if isinstance(msg, bytes):
+      self.sent += unpackMessages(msg)
+    else:
+      self.sent.append(msg)
+
+  def __str__ (self):
+    return "[replay %s]" % (self.dpid,)
+
+
+class ReplayPacketIn (object):
+  """
+  Stand-in for a POX PacketIn event. As in POX, the frame is only parsed the first
+  time event.parsed is used.
+  """
+
+  def __init__ (self, connection, port, data, buffer_id = None):
+    self.connection = connection
+    self.dpid = connection.dpid
+    self.port = port
+    self.data = data
+    self.ofp = of.ofp_packet_in(in_port=port, data=data, buffer_id=buffer_id,
+                                total_len=len(data))
+    self._parsed = None
+
+  @property
+  def parsed(self):
+    if self._parsed is None:
+      self._parsed = pkt.ethernet(self.data)
+    return self._parsed
+
+
+class ReplayErrorIn (object):
+  """
+  Stand-in for a POX ErrorIn event: a flow mod failed because the table is full.
+  """
+
+  def __init__ (self, connection, msg):
+    self.connection = connection
+    self.dpid = connection.dpid
+    self.ofp = of.ofp_error(type=of.OFPET_FLOW_MOD_FAILED, code=of.OFPFMFC_ALL_TABLES_FULL)
+    self.ofp.xid = msg.xid
+    self.should_log = True
+
+
+class ReplayBarrierIn (object):
+  """
+  Stand-in for a POX BarrierIn event: the reply to a barrier request.
+  """
+
+  def __init__ (self, connection, msg):
+    self.connection = connection
+    self.dpid = connection.dpid
+    self.xid = msg.xid
+
+
+class ReplayFlowStatsReceived (object):
+  """
+  Stand-in for a POX FlowStatsReceived event: every flow of a switch's table.
+  """
+
+  def __init__ (self, connection, stats):
+    self.connection = connection
+    self.dpid = connection.dpid
+    self.stats = stats
+
+
+class ReplaySwitch (object):
+  """
+  Emulated switch: a ReplayConnection plus a flow table kept up to date from the
+  flow mods sent on it. Timeouts are not emulated; a replay is much shorter than
+  the flow timeout. Flows matching a whole packet (built with
+  ofp_match.from_packet, e.g. flood rules) are kept in a dict so that floods of
+  them do not make every lookup slower. With a capacity, adding a flow to a full
+  table fails.
+  """
+
+  def __init__ (self, dpid, ports, capacity = None):
+    self.dpid = dpid
+    self.ports = sorted(ports)
+    self.capacity = capacity
+    self.connection = ReplayConnection(dpid)
+    self.flows = []
+    self.exact = {}
+    self.size = 0
+    self.nextBufferId = 1
+
+  # Dict key of a match naming every header field a packet has
+  @staticmethod
+  def exactKey(match):
+    if match.in_port is None or match.dl_src is None or match.dl_dst is None:
+      return None
+    return tuple(str(getattr(match, field, None)) for field in MatchFields)
+
+  # Applies a flow mod to the table. Returns false if the table was full.
+  def applyFlowMod(self, msg):
+    if msg.command in (of.OFPFC_DELETE, of.OFPFC_DELETE_STRICT):
+      if msg.command == of.OFPFC_DELETE_STRICT:
+        remove = lambda flow: flow.match == msg.match and flow.priority == msg.priority
+      else:
+        remove = lambda flow: msg.match.matches_with_wildcards(flow.match)
+      self.flows = [flow for flow in self.flows if not remove(flow)]
+      for key, flows in list(self.exact.items()):
+        self.exact[key] = [flow for flow in flows if not remove(flow)]
+      self.size = len(self.flows) + sum(len(flows) for flows in self.exact.values())
+      return True
+    key = self.exactKey(msg.match)
+    flows = self.flows if key is None else self.exact.setdefault(key, [])
+    kept = [flow for flow in flows
+            if not (flow.match == msg.match and flow.priority == msg.priority)]
+    if len(kept) == len(flows) and self.capacity is not None and self.size >= self.capacity:
+      return False
+    self.size += len(kept) + 1 - len(flows)
+    kept.append(msg)
+    flows[:] = kept
+    return True
+
+  # Flow stats entries of every flow in the table
+  def flowStats(self):
+    return [of.ofp_flow_stats(match=flow.match, priority=flow.priority, cookie=flow.cookie,
+                              idle_timeout=flow.idle_timeout, hard_timeout=flow.hard_timeout,
+                              actions=list(flow.actions))
+            for flow in self.flows + [flow for flows in self.exact.values() for flow in flows]]
+
+  # Returns the highest priority flow matching a parsed frame, or None on a table miss
+  def lookup(self, packet, in_port):
+    match = of.ofp_match.from_packet(packet, in_port)
+    best = None
+    for flow in self.exact.get(self.exactKey(match), []) + self.flows:
+      if (best is None or flow.priority > best.priority) and \
+         flow.match.matches_with_wildcards(match, consider_other_wildcards=False):
+        best = flow
+    return best
+
+
+class ReplayStats (object):
+  """
+  Counters and handler latencies collected during a replay.
+  """
+
+  def __init__ (self):
+    self.frames = 0
+    self.packet_ins = 0
+    self.latencies = []
+    # (source IP as an integer or None, delay) of every timed PacketIn
+    self.delays = []
+    self.flow_mods = 0
+    self.packet_outs = 0
+    self.writes = 0
+    self.other_messages = 0
+    self.table_hits = 0
+    self.delivered = 0
+    self.dropped = 0
+    self.hop_limit = 0
+    self.table_full = 0
+    self.barriers = 0
+
+  def percentile(self, fraction):
+    if not self.latencies:
+      return 0.0
+    ordered = sorted(self.latencies)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+  # Delay percentile of the timed PacketIns, only those from sources if given
+  def delayPercentile(self, fraction, sources = None):
+    ordered = sorted(delay for srcip, delay in self.delays
+                     if sources is None or srcip in sources)
+    if not ordered:
+      return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+  def report(self):
+    handling = sum(self.latencies)
+    return {
+      "frames": self.frames,
+      "packet_ins": self.packet_ins,
+      "decisions_per_sec": self.packet_ins / handling if handling else 0.0,
+      "p50_us": self.percentile(0.50) * 1e6,
+      "p99_us": self.percentile(0.99) * 1e6,
+      "flow_mods": self.flow_mods,
+      "flow_mods_per_packet_in": float(self.flow_mods) / self.packet_ins if self.packet_ins else 0.0,
+      "packet_outs": self.packet_outs,
+      "writes": self.writes,
+      "table_hits": self.table_hits,
+      "delivered": self.delivered,
+      "dropped": self.dropped,
+      "table_full": self.table_full,
+      "barriers": self.barriers,
+      "p50_delay_us": self.delayPercentile(0.50) * 1e6,
+      "p99_delay_us": self.delayPercentile(0.99) * 1e6,
+    }
+
+
+class Replay (object):
+  """
+  Replays frames through one Final per switch of final_topology.
+
+  Controller options (policy, proactive, cache, ...) are passed to every Final.
+  With emulate=False every frame is handed to the controller at its ingress
+  switch only, which measures raw PacketIn handling. A PacketIn limiter in the
+  options runs on the replay's clock, which follows the arrival times of timed
+  frames.
+  """
+
+  def __init__ (self, emulate = True, capacity = None, **options):
+    self.emulate = emulate
+    self.links = final_controller.switchLinks()
+    self.hosts = final_controller.hostLocations()
+    ports = {}
+    for dpid, port in list(self.links) + list(self.hosts.values()):
+      ports.setdefault(dpid, set()).add(port)
+    if "policy" not in options:
+      options["policy"] = final_controller.compilePolicy()
+    self.switches = {}
+    self.finals = {}
+    self.stats = ReplayStats()
+    # Simulated time of the PacketIn being handled and when the controller is free
+    self.now = None
+    self.busyUntil = 0.0
+    # Calls the controller left for the event loop, e.g. writing batched messages
+    self.later = []
+    for dpid in sorted(ports):
+      self.switches[dpid] = ReplaySwitch(dpid, ports[dpid], capacity)
+    self.startControllers(options)
+
+  # Connects a new Final (made with the given options) to every switch
+  def startControllers(self, options):
+    if options.get("limiter") is not None:
+      options["limiter"].clock = self.clock
+    for dpid, switch in sorted(self.switches.items()):
+      self.finals[dpid] = Final(switch.connection, **options)
+      # Writes what the constructor sent (e.g. proactive rules) now; later flushes
+      # are left for runLater()
+      self.finals[dpid].batcher.schedule = self.later.append
+      self.finals[dpid].batcher.flush()
+    self.flush()
+
+  # Replaces the controller of every switch with a new one, as if POX restarted with
+  # the given options. With clear, the switches' tables are emptied first, as POX
+  # does when a switch connects unless told not to.
+  def restart(self, clear = True, **options):
+    for switch in self.switches.values():
+      del switch.connection.listeners[:]
+      if clear:
+        switch.applyFlowMod(of.ofp_flow_mod(command=of.OFPFC_DELETE))
+    self.startControllers(options)
+
+  # Simulated time once timed frames have been replayed, otherwise the real time
+  def clock(self):
+    if self.now is None:
+      return time.time()
+    return self.now
+
+  # Replays one frame entering switch dpid on port, at time arrival if given
+  def inject(self, dpid, port, data, buffered = True, arrival = None):
+    self.stats.frames += 1
+    pending = [(dpid, port, data, 0)]
+    while pending:
+      dpid, port, data, hops = pending.pop(0)
+      if hops >= MAX_HOPS:
+        self.stats.hop_limit += 1
+        continue
+      switch = self.switches[dpid]
+      outputs = None
+      if self.emulate:
+        flow = switch.lookup(pkt.ethernet(data), port)
+        if flow is not None:
+          self.stats.table_hits += 1
+          outputs = [(dpid, port, data, flow.actions)]
+      if outputs is None:
+        outputs = self._packetIn(switch, port, data, buffered, arrival)
+      sent = 0
+      for out_dpid, in_port, frame, actions in outputs:
+        for out_port in self._outputPorts(self.switches[out_dpid], in_port, actions):
+          sent += 1
+          peer = self.links.get((out_dpid, out_port))
+          if peer is None:
+            self.stats.delivered += 1
+          elif self.emulate:
+            pending.append((peer[0], peer[1], frame, hops + 1))
+      if sent == 0:
+        self.stats.dropped += 1
+
+  # Replays a list of (dpid, port, frame) or (dpid, port, frame, arrival) in order of
+  # arrival and returns the stats report
+  def run(self, frames, buffered = True):
+    for frame in frames:
+      self.inject(frame[0], frame[1], frame[2], buffered, *frame[3:])
+    return self.stats.report()
+
+  # Hands a frame to the controller. Returns [(dpid, in_port, frame, actions)] for
+  # every frame the controller's messages make a switch send: the buffered packet for
+  # a flow mod or packet out naming its buffer, or a packet out's own data. Flow mods
+  # sent to any switch are applied to that switch's table.
+  def _packetIn(self, switch, port, data, buffered, arrival = None):
+    buffer_id = None
+    if buffered:
+      buffer_id = switch.nextBufferId
+      switch.nextBufferId += 1
+    event = ReplayPacketIn(switch.connection, port, data, buffer_id)
+    if arrival is not None:
+      # Waits for the PacketIns that arrived before it
+      self.now = max(arrival, self.busyUntil)
+    start = time.time()
+    for listener in switch.connection.listeners:
+      listener._handle_PacketIn(event)
+    self.runLater()
+    elapsed = time.time() - start
+    self.stats.latencies.append(elapsed)
+    self.stats.packet_ins += 1
+    if arrival is not None:
+      self.busyUntil = self.now + elapsed
+      headers = final_controller.parseRawHeaders(data)
+      srcip = headers[2] if headers is not None else None
+      self.stats.delays.append((srcip, self.busyUntil - arrival))
+
+    outputs = []
+    for other in self.switches.values():
+      buffered = other is switch and buffer_id is not None
+      # Error handlers may send more messages while these are applied
+      sent = other.connection.sent
+      i = 0
+      while i < len(sent):
+        msg = sent[i]
+        i += 1
+        if isinstance(msg, of.ofp_flow_mod):
+          if not self._applyFlowMod(other, msg):
+            continue
+          if buffered and msg.buffer_id == buffer_id:
+            outputs.append((other.dpid, port, data, msg.actions))
+        elif isinstance(msg, of.ofp_barrier_request):
+          self._barrierReply(other, msg)
+        elif isinstance(msg, of.ofp_stats_request):
+          self._statsReply(other)
+        elif isinstance(msg, of.ofp_packet_out):
+          if buffered and msg.buffer_id == buffer_id:
+            outputs.append((other.dpid, port, data, msg.actions))
+          elif msg.data is not None:
+            frame = msg.data if isinstance(msg.data, bytes) else msg.data.pack()
+            outputs.append((other.dpid, msg.in_port, frame, msg.actions))
+    self._countMessages()
+    return outputs
+
+  # Applies and counts the flow mods the controller sent outside a PacketIn, e.g.
+  # proactive rules or a policy update
+  def flush(self):
+    self.runLater()
+    for switch in self.switches.values():
+      sent = switch.connection.sent
+      i = 0
+      while i < len(sent):
+        if isinstance(sent[i], of.ofp_flow_mod):
+          self._applyFlowMod(switch, sent[i])
+        elif isinstance(sent[i], of.ofp_barrier_request):
+          self._barrierReply(switch, sent[i])
+        elif isinstance(sent[i], of.ofp_stats_request):
+          self._statsReply(switch)
+        i += 1
+    self._countMessages()
+
+  # Runs the calls the controller left for the event loop, as POX does once the
+  # current event has been handled
+  def runLater(self):
+    while self.later:
+      calls = self.later[:]
+      del self.later[:]
+      for call in calls:
+        call()
+
+  # Applies a flow mod to an emulated switch. If its table is full, the controller
+  # gets an ErrorIn instead and false is returned.
+  def _applyFlowMod(self, switch, msg):
+    if switch.applyFlowMod(msg):
+      return True
+    self.stats.table_full += 1
+    event = ReplayErrorIn(switch.connection, msg)
+    for listener in switch.connection.listeners:
+      listener._handle_ErrorIn(event)
+    self.runLater()
+    return False
+
+  # Answers a barrier request: the emulated switch applies messages in order, so
+  # everything before it is done already
+  def _barrierReply(self, switch, msg):
+    self.stats.barriers += 1
+    event = ReplayBarrierIn(switch.connection, msg)
+    for listener in switch.connection.listeners:
+      listener._handle_BarrierIn(event)
+    self.runLater()
+
+  # Answers a flow stats request with every flow in the emulated switch's table
+  def _statsReply(self, switch):
+    event = ReplayFlowStatsReceived(switch.connection, switch.flowStats())
+    for listener in switch.connection.listeners:
+      listener._handle_FlowStatsReceived(event)
+    self.runLater()
+
+  # Port numbers a list of actions sends a frame out of
+  def _outputPorts(self, switch, in_port, actions):
+    ports = []
+    for action in actions:
+      port = getattr(action, "port", None)
+      if port is None:
+        continue
+      if port in (of.OFPP_FLOOD, of.OFPP_ALL):
+        ports += [p for p in switch.ports if p != in_port]
+      elif port == of.OFPP_IN_PORT:
+        ports.append(in_port)
+      elif port in switch.ports and port != in_port:
+        # Like a real switch, never send back out the ingress port unless asked to
+        ports.append(port)
+    return ports
+
+  # Moves every recorded message into the stats
+  def _countMessages(self):
+    for switch in self.switches.values():
+      for msg in switch.connection.sent:
+        if isinstance(msg, of.ofp_flow_mod):
+          self.stats.flow_mods += 1
+        elif isinstance(msg, of.ofp_packet_out):
+          self.stats.packet_outs += 1
+        else:
+          self.stats.other_messages += 1
+      del switch.connection.sent[:]
+      self.stats.writes += switch.connection.writes
+      switch.connection.writes = 0
+
+
+HostMACs = final_controller.hostMACs()
+
+# MAC address of a host IP: the topology's address for known hosts, otherwise a
+# locally administered address derived from the IP
+def hostMAC(ip):
+  mac = HostMACs.get(str(ip))
+  if mac is not None:
+    return EthAddr(mac)
+  return EthAddr(b"\x02\x00" + IPAddr(ip).toRaw())
+
+# Raw ethernet/IPv4 frame of the given IP protocol between two hosts
+def ipFrame(srcip, dstip, protocol):
+  ip = pkt.ipv4(srcip=IPAddr(srcip), dstip=IPAddr(dstip), protocol=protocol)
+  if protocol == pkt.ipv4.ICMP_PROTOCOL:
+    ip.payload = pkt.icmp()
+  elif protocol == pkt.ipv4.TCP_PROTOCOL:
+    ip.payload = pkt.tcp(srcport=40000, dstport=80)
+  eth = pkt.ethernet(src=hostMAC(srcip), dst=hostMAC(dstip), type=pkt.ethernet.IP_TYPE)
+  eth.payload = ip
+  return eth.pack()
+
+# Raw broadcast ARP request from one host for another address
+def arpRequestFrame(srcip, dstip):
+  arp = pkt.arp()
+  arp.opcode = pkt.arp.REQUEST
+  arp.hwsrc = hostMAC(srcip)
+  arp.protosrc = IPAddr(srcip)
+  arp.protodst = IPAddr(dstip)
+  eth = pkt.ethernet(src=hostMAC(srcip), dst=pkt.ethernet.ETHER_BROADCAST,
+                     type=pkt.ethernet.ARP_TYPE)
+  eth.payload = arp
+  return eth.pack()
+
+# Raw non-IP unicast frame from one host to another (local experimental ethertype)
+def l2Frame(srcip, dstip, ethertype = 0x88b5):
+  eth = pkt.ethernet(src=hostMAC(srcip), dst=hostMAC(dstip), type=ethertype)
+  eth.payload = b"\x00" * 46
+  return eth.pack()
+
+# Every host asks for every other host's address, rounds times over
+def arpStorm(rounds = 5):
+  locations = final_controller.hostLocations()
+  hosts = final_controller.knownHosts()
+  frames = []
+  for i in range(rounds):
+    for src in hosts:
+      for dst in hosts:
+        if src != dst:
+          frames.append(locations[src] + (arpRequestFrame(src, dst),))
+  return frames
+
+# A non-IP frame between every ordered pair of hosts, rounds times over
+def l2Pairs(rounds = 3):
+  locations = final_controller.hostLocations()
+  hosts = final_controller.knownHosts()
+  frames = []
+  for i in range(rounds):
+    for src in hosts:
+      for dst in hosts:
+        if src != dst:
+          frames.append(locations[src] + (l2Frame(src, dst),))
+  return frames
+
+# The untrusted host pings every address of every subnet in the topology
+def icmpSweep(source = "108.44.83.103"):
+  dpid, port = final_controller.hostLocations()[source]
+  subnets = set(host.rsplit(".", 1)[0] for host in final_controller.knownHosts())
+  frames = []
+  for subnet in sorted(subnets):
+    for i in range(1, 255):
+      frames.append((dpid, port, ipFrame(source, "%s.%d" % (subnet, i),
+                                         pkt.ipv4.ICMP_PROTOCOL)))
+  return frames
+
+# A TCP segment between every ordered pair of hosts, rounds times over
+def allPairsTCP(rounds = 3):
+  locations = final_controller.hostLocations()
+  hosts = final_controller.knownHosts()
+  frames = []
+  for i in range(rounds):
+    for src in hosts:
+      for dst in hosts:
+        if src != dst:
+          frames.append(locations[src] + (ipFrame(src, dst, pkt.ipv4.TCP_PROTOCOL),))
+  return frames
+
+# The untrusted host opens TCP connections to count addresses outside the topology.
+# No rule can be installed for them, so every one is a PacketIn.
+def tcpScan(count = 2000, source = "108.44.83.103"):
+  dpid, port = final_controller.hostLocations()[source]
+  return [(dpid, port, ipFrame(source, final_policy.intToIP(0x08000000 + i),
+                               pkt.ipv4.TCP_PROTOCOL))
+          for i in range(1, count + 1)]
+
+# Non-IP frames with a different source MAC each, sent from the untrusted host's
+# port. Every one misses the exact-match flood rules of the ones before it.
+def nonIPFlood(count = 2000, source = "108.44.83.103"):
+  dpid, port = final_controller.hostLocations()[source]
+  frames = []
+  for i in range(1, count + 1):
+    eth = pkt.ethernet(src=EthAddr(struct.pack("!HI", 0x0200, i)),
+                       dst=pkt.ethernet.ETHER_BROADCAST, type=0x88b5)
+    eth.payload = b"\x00" * 46
+    frames.append((dpid, port, eth.pack()))
+  return frames
+
+# Gives frames arrival times rate per second apart, starting at start
+def paced(frames, rate, start = 0.0):
+  return [frame + (start + i / float(rate),) for i, frame in enumerate(frames)]
+
+# Merges timed frame lists into one in order of arrival
+def interleave(*timedFrames):
+  merged = []
+  for frames in timedFrames:
+    merged += frames
+  merged.sort(key=lambda frame: frame[3])
+  return merged
+
+# Frames of a libpcap capture (ethernet link type)
+def readPcap(path):
+  with open(path, "rb") as capture:
+    header = capture.read(24)
+    magic = struct.unpack("<I", header[:4])[0]
+    if magic in (0xa1b2c3d4, 0xa1b23c4d):
+      order = "<"
+    elif magic in (0xd4c3b2a1, 0x4d3cb2a1):
+      order = ">"
+    else:
+      raise ValueError("%s is not a pcap file" % path)
+    if struct.unpack(order + "I", header[20:24])[0] != 1:
+      raise ValueError("%s does not contain ethernet frames" % path)
+    while True:
+      record = capture.read(16)
+      if len(record) < 16:
+        return
+      length = struct.unpack(order + "IIII", record)[2]
+      yield capture.read(length)
+
+# Frames of a pcap file entering at (dpid, port), or at the attachment point of
+# their source IP address when no ingress is given
+def pcapFrames(path, dpid = None, port = None):
+  locations = final_controller.hostLocations()
+  frames = []
+  for data in readPcap(path):
+    ingress = (dpid, port)
+    if dpid is None:
+      headers = final_controller.parseRawHeaders(data)
+      if headers is None or headers[2] is None:
+        continue
+      ingress = locations.get(final_policy.intToIP(headers[2]))
+      if ingress is None:
+        continue
+    frames.append(ingress + (data,))
+  return frames
+
+Scenarios = {
+  "arp_storm": arpStorm,
+  "icmp_sweep": icmpSweep,
+  "l2_pairs": l2Pairs,
+  "all_pairs_tcp": allPairsTCP,
+  "tcp_scan": tcpScan,
+}
+
+# Expected results of each scenario with the default controller options and
+# buffering switches. PacketIns and flow mods per PacketIn may exceed these by at
+# most BaselineSlack before the run counts as a regression; deliveries and drops
+# must match exactly. Latency depends on the machine and is not checked.
+Baselines = {
+  "all_pairs_tcp": {"packet_ins": 405, "flow_mods_per_packet_in": 1.00,
+                    "delivered": 300, "dropped": 330},
+  "arp_storm": {"packet_ins": 6, "flow_mods_per_packet_in": 1.00,
+                "delivered": 14700, "dropped": 0},
+  "icmp_sweep": {"packet_ins": 1778, "flow_mods_per_packet_in": 0.58,
+                 "delivered": 1, "dropped": 1523},
+  "l2_pairs": {"packet_ins": 741, "flow_mods_per_packet_in": 0.12,
+               "delivered": 2067, "dropped": 0},
+  "tcp_scan": {"packet_ins": 2000, "flow_mods_per_packet_in": 0.00,
+               "delivered": 0, "dropped": 2000},
+}
+BaselineSlack = 0.05
+
+# Ways a scenario's report is worse than its baseline, as printable strings
+def baselineFailures(report, baseline):
+  failures = []
+  for key, format in (("packet_ins", "%d"), ("flow_mods_per_packet_in", "%.2f")):
+    if report[key] > baseline[key] * (1 + BaselineSlack) + 1e-9:
+      failures.append(("%s " + format + " over baseline " + format) % (
+        key, report[key], baseline[key]))
+  for key in ("delivered", "dropped"):
+    if report[key] != baseline[key]:
+      failures.append("%s %d, baseline %d" % (key, report[key], baseline[key]))
+  return failures
+
+# Runs each scenario in a fresh network and prints its report. Options are the
+# controller's launch() options, e.g. arp_proxy=True. With check set, reports are
+# compared with Baselines (which assume the default options) and the failures are
+# printed; returns the reports and whether every scenario was within its baseline.
+def runSuite(names = None, emulate = True, buffered = True, check = False, **launchOptions):
+  reports = {}
+  ok = True
+  for name in names or sorted(Scenarios):
+    replay = Replay(emulate, **final_controller.finalOptions(**launchOptions))
+    reports[name] = replay.run(Scenarios[name](), buffered)
+    printReport(name, reports[name])
+    if check and name in Baselines:
+      for failure in baselineFailures(reports[name], Baselines[name]):
+        print "  REGRESSION: %s" % failure
+        ok = False
+  return reports, ok
+
+def printReport(name, report):
+  print "%s: %d frames, %d PacketIns, %.0f decisions/sec, p50 %.1f us, p99 %.1f us" % (
+    name, report["frames"], report["packet_ins"], report["decisions_per_sec"],
+    report["p50_us"], report["p99_us"])
+  print "  %d flow mods (%.2f per PacketIn), %d packet outs, %d writes, %d table hits, " \
+        "%d delivered, %d dropped" % (
+    report["flow_mods"], report["flow_mods_per_packet_in"], report["packet_outs"],
+    report["writes"], report["table_hits"], report["delivered"], report["dropped"])
+
+# Arguments are scenario names, --pcap=<file>, --unbuffered (switches send whole
+# frames instead of buffering them) and controller launch() options such as
+# --arp_proxy or --cache_size=0. With neither of the last two, the scenarios are
+# checked against Baselines and main returns False if any regressed.
+def main(args):
+  names = []
+  pcaps = []
+  buffered = True
+  launchOptions = {}
+  for arg in args:
+    if not arg.startswith("--"):
+      names.append(arg)
+      continue
+    name, _, value = arg[2:].partition("=")
+    if name == "pcap":
+      pcaps.append(value)
+    elif name == "unbuffered":
+      buffered = False
+    else:
+      launchOptions[name] = value or True
+  for path in pcaps:
+    replay = Replay(**final_controller.finalOptions(**launchOptions))
+    printReport(path, replay.run(pcapFrames(path), buffered))
+  ok = True
+  if names or not pcaps:
+    check = buffered and not launchOptions
+    reports, ok = runSuite(names, buffered=buffered, check=check, **launchOptions)
+  return ok
+
+if __name__ == '__main__':
+  sys.exit(0 if main(sys.argv[1:]) else 1)
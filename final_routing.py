@@ -0,0 +1,231 @@
+# final_routing.py - Switch graph routing for the CSE 150 final project controller
+# Kyle Won, UCSC
+# kwon, 1724327
+# CSE 150 Final Project
+#
+# Keeps fewest-hop next hops between every pair of switches and turns them, with the
+# host attachment points, into the per-switch forwarding tables the policy compiler
+# uses. Link changes only recompute the destinations they affect. Like
+# final_policy.py this module does not depend on POX.
+
+from collections import deque
+
+import final_policy
+
+class Router (object):
+  """
+  All-pairs next hops of a switch graph.
+
+  For every destination switch d, dist[d] maps each switch that can reach d to
+  its hop count and nextPort[d] maps it to the port it sends d's traffic out of.
+  Both come from a breadth-first search outwards from d, so they form a
+  shortest-path tree per destination.
+
+  linkUp() relaxes only the switches the new link brings closer to each
+  destination. linkDown() searches again only for the destinations whose tree
+  used the link. Among equal-cost paths the result can differ from a full
+  recomputation, but every next hop is always on a shortest path.
+  Parallel links between two switches are kept; traffic uses the lowest port.
+  """
+
+  def __init__ (self, links = (), switches = ()):
+    # dpid -> {neighbour dpid: [ports to it]}
+    self.ports = {}
+    self.dist = {}
+    self.nextPort = {}
+    for dpid in switches:
+      self.ports.setdefault(dpid, {})
+    for dpid1, port1, dpid2, port2 in links:
+      self._addPorts(dpid1, port1, dpid2, port2)
+    for dpid in self.ports:
+      self._search(dpid)
+
+  # Switches of the graph
+  def switches(self):
+    return list(self.ports)
+
+  # Links of the graph as (dpid, port, dpid, port), each reported from both ends
+  def links(self):
+    return [(dpid, port, neighbour, self._peerPort(dpid, port, neighbour))
+            for dpid, neighbours in self.ports.items()
+            for neighbour, ports in neighbours.items() for port in ports]
+
+  # Port switch dpid sends traffic for switch dst out of, or None if dpid is dst or
+  # cannot reach it
+  def nextHop(self, dpid, dst):
+    return self.nextPort.get(dst, {}).get(dpid)
+
+  def addSwitch(self, dpid):
+    if dpid not in self.ports:
+      self.ports[dpid] = {}
+      self._search(dpid)
+
+  # Adds a link. Returns the set of switches whose next hops changed.
+  def linkUp(self, dpid1, port1, dpid2, port2):
+    for dpid in (dpid1, dpid2):
+      self.addSwitch(dpid)
+    if port1 in self.ports[dpid1].get(dpid2, ()):
+      return set()
+    if dpid2 in self.ports[dpid1]:
+      oldPorts1 = list(self.ports[dpid1][dpid2])
+      oldPorts2 = list(self.ports[dpid2][dpid1])
+      self._addPorts(dpid1, port1, dpid2, port2)
+      return self._repointParallel(dpid1, dpid2, oldPorts1) | \
+             self._repointParallel(dpid2, dpid1, oldPorts2)
+    self._addPorts(dpid1, port1, dpid2, port2)
+    changed = set()
+    for dst, dist in self.dist.items():
+      hops1 = dist.get(dpid1)
+      hops2 = dist.get(dpid2)
+      if hops1 is not None and (hops2 is None or hops1 + 1 < hops2):
+        changed |= self._relax(dst, dpid2, dpid1)
+      elif hops2 is not None and (hops1 is None or hops2 + 1 < hops1):
+        changed |= self._relax(dst, dpid1, dpid2)
+    return changed
+
+  # Removes a link (reported from either end). Returns the set of switches whose
+  # next hops changed.
+  def linkDown(self, dpid1, port1, dpid2, port2):
+    if port1 not in self.ports.get(dpid1, {}).get(dpid2, ()):
+      return set()
+    oldPorts1 = list(self.ports[dpid1][dpid2])
+    oldPorts2 = list(self.ports[dpid2][dpid1])
+    self.ports[dpid1][dpid2].remove(port1)
+    if port2 in self.ports[dpid2][dpid1]:
+      self.ports[dpid2][dpid1].remove(port2)
+    if self.ports[dpid1][dpid2] and self.ports[dpid2][dpid1]:
+      return self._repointParallel(dpid1, dpid2, oldPorts1) | \
+             self._repointParallel(dpid2, dpid1, oldPorts2)
+    del self.ports[dpid1][dpid2]
+    self.ports[dpid2].pop(dpid1, None)
+    changed = set()
+    for dst, nextPort in self.nextPort.items():
+      if nextPort.get(dpid1) == port1 or nextPort.get(dpid2) == port2:
+        changed |= self._search(dst)
+    return changed
+
+  # Recomputes every destination from scratch
+  def recompute(self):
+    for dst in self.ports:
+      self._search(dst)
+
+  # Forwarding table of every switch (or only of dpids) as {dpid: [(prefix, port)]}.
+  # hosts maps host IP -> (dpid, port) it is attached to. routes is a list of
+  # (prefix, dpid) for networks behind a switch; that switch itself gets no route
+  # for them (port None, which the policy treats as no route), so its more specific
+  # entries decide. Entries a less specific entry already covers are left out.
+  def forwardingTables(self, hosts, routes = (), dpids = None):
+    if dpids is None:
+      dpids = set(self.ports)
+      dpids.update(dpid for dpid, port in hosts.values())
+    tables = {}
+    for dpid in dpids:
+      entries = []
+      for ip, (hostDpid, hostPort) in hosts.items():
+        port = hostPort if hostDpid == dpid else self.nextHop(dpid, hostDpid)
+        entries.append((final_policy.parsePrefix(ip), port))
+      for prefix, owner in routes:
+        entries.append((final_policy.parsePrefix(prefix), self.nextHop(dpid, owner)))
+      tables[dpid] = [(final_policy.prefixString(prefix), port)
+                      for prefix, port in compressTable(entries)]
+    return tables
+
+  def _addPorts(self, dpid1, port1, dpid2, port2):
+    for dpid, port, neighbour in ((dpid1, port1, dpid2), (dpid2, port2, dpid1)):
+      ports = self.ports.setdefault(dpid, {}).setdefault(neighbour, [])
+      if port not in ports:
+        ports.append(port)
+        ports.sort()
+
+  # The port at neighbour's end of the link leaving dpid on port (parallel links are
+  # paired up in port order)
+  def _peerPort(self, dpid, port, neighbour):
+    return self.ports[neighbour][dpid][self.ports[dpid][neighbour].index(port)]
+
+  # Breadth-first search outwards from dst. Returns the switches whose next hop
+  # towards dst changed.
+  def _search(self, dst):
+    oldNextPort = self.nextPort.get(dst, {})
+    dist = {dst: 0}
+    nextPort = {}
+    queue = deque([dst])
+    while queue:
+      dpid = queue.popleft()
+      for neighbour in sorted(self.ports[dpid]):
+        if neighbour not in dist:
+          dist[neighbour] = dist[dpid] + 1
+          nextPort[neighbour] = self.ports[neighbour][dpid][0]
+          queue.append(neighbour)
+    self.dist[dst] = dist
+    self.nextPort[dst] = nextPort
+    return set(dpid for dpid in set(oldNextPort) | set(nextPort)
+               if oldNextPort.get(dpid) != nextPort.get(dpid))
+
+  # dpid is one hop closer to dst through via than before: update it and whatever it
+  # brings closer in turn. Returns the switches whose next hop changed.
+  def _relax(self, dst, dpid, via):
+    dist = self.dist[dst]
+    nextPort = self.nextPort[dst]
+    dist[dpid] = dist[via] + 1
+    nextPort[dpid] = self.ports[dpid][via][0]
+    changed = set([dpid])
+    queue = deque([dpid])
+    while queue:
+      current = queue.popleft()
+      for neighbour in sorted(self.ports[current]):
+        hops = dist.get(neighbour)
+        if hops is None or dist[current] + 1 < hops:
+          dist[neighbour] = dist[current] + 1
+          nextPort[neighbour] = self.ports[neighbour][current][0]
+          changed.add(neighbour)
+          queue.append(neighbour)
+    return changed
+
+  # After the parallel links between dpid and neighbour changed (they were on
+  # oldPorts), moves next hops that used them to the lowest port left. Returns the
+  # switches changed.
+  def _repointParallel(self, dpid, neighbour, oldPorts):
+    port = self.ports[dpid][neighbour][0]
+    changed = set()
+    for nextPort in self.nextPort.values():
+      if nextPort.get(dpid) in oldPorts and nextPort[dpid] != port:
+        nextPort[dpid] = port
+        changed.add(dpid)
+    return changed
+
+
+# Drops the entries of a [((network, length), port)] table that a less specific
+# entry already gives the same port (no entry at all is the same as port None).
+# Returns the remaining entries, most specific first.
+def compressTable(entries):
+  kept = final_policy.PrefixTable()
+  result = []
+  for prefix, port in sorted(entries, key=lambda entry: entry[0][1]):
+    # PrefixTable skips None values, so ports are stored in a tuple
+    parent = kept.lookup(prefix[0], (None,))[0]
+    if port != parent:
+      kept.add(prefix, (port,))
+      result.append((prefix, port))
+  result.sort(key=lambda entry: (-entry[0][1], entry[0][0]))
+  return result
+
+# Builds a Router from a Mininet Topo such as final_topology.final_topo, without
+# needing Mininet itself: switch sN is dpid N (Mininet's default) and links between
+# switches use the ports given to addLink. Returns (router, {host IP: (dpid, port)}).
+def routerFromTopo(topo):
+  switches = set(topo.switches())
+  def dpid(name):
+    return int("".join(c for c in name if c.isdigit()))
+  links = []
+  hosts = {}
+  for node1, node2, info in topo.links(withInfo=True):
+    if node1 in switches and node2 in switches:
+      links.append((dpid(node1), info["port1"], dpid(node2), info["port2"]))
+    elif node1 in switches or node2 in switches:
+      if node2 in switches:
+        node1, node2 = node2, node1
+        info = dict(info, port1=info["port2"])
+      ip = topo.nodeInfo(node2).get("ip")
+      if ip is not None:
+        hosts[ip.split("/")[0]] = (dpid(node1), info["port1"])
+  return Router(links, [dpid(name) for name in switches]), hosts
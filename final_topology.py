@@ -6,12 +6,14 @@
 # CSE 150 Final Project
 
 import math
+import sys
 from mininet.topo import Topo
 from mininet.net import Mininet
 from mininet.util import dumpNodeConnections
 from mininet.log import setLogLevel
 from mininet.cli import CLI
 from mininet.node import RemoteController
+import final_campus
 
 class final_topo(Topo):
 
@@ -24,7 +26,7 @@ class final_topo(Topo):
     numberClients = (2 ** (32 - int(subnetMask))) - 2
     for i in range(1, numberClients + 1):
       clientName = "client" + str(i)
-      clientMAC = "00.00.00.00.00." + str(i * 10)
+      clientMAC = "00:00:00:00:00:" + str(i * 10)
       clientIP = subnetAddress[0: len(subnetAddress) - 1] + str(i)
       clientRoute = clientName + "-eth0"
       #print "client name: " + clientName
@@ -53,18 +55,18 @@ class final_topo(Topo):
     # h2 = self.addHost('h2',mac='00:00:00:00:00:02',ip='2.2.2.2/24', defaultRoute="h2-eth0")
     
     # Data center
-    web_server = self.addHost('h_server', mac='00.00.00.00.00.66', ip='30.1.4.66/24', defaultRoute="h_server-eth0")
+    web_server = self.addHost('h_server', mac='00:00:00:00:00:66', ip='30.1.4.66/24', defaultRoute="h_server-eth0")
     # Floor 1
     laptop = self.addHost('laptop', mac='00:00:00:00:00:01', ip='20.2.1.10/24', defaultRoute="laptop-eth0")
     lab_machine = self.addHost('lab', mac='00:00:00:00:00:02', ip='20.2.1.20/24', defaultRoute="lab-eth0")
-    device1 = self.addHost('device1', mac='00.00.00.00.00.03', ip='20.2.1.30/24', defaultRoute="device1-eth0")
-    device2 = self.addHost('device2', mac='00.00.00.00.00.04', ip='20.2.1.40/24', defaultRoute="device2-eth0")
+    device1 = self.addHost('device1', mac='00:00:00:00:00:03', ip='20.2.1.30/24', defaultRoute="device1-eth0")
+    device2 = self.addHost('device2', mac='00:00:00:00:00:04', ip='20.2.1.40/24', defaultRoute="device2-eth0")
     # Floor 2
-    host1 = self.addHost('host1', mac='00.00.00.00.00.05', ip='10.2.7.10/24', defaultRoute="host1-eth0")
-    host2 = self.addHost('host2', mac='00.00.00.00.00.06', ip='10.2.7.20/24', defaultRoute="host2-eth0")
+    host1 = self.addHost('host1', mac='00:00:00:00:00:05', ip='10.2.7.10/24', defaultRoute="host1-eth0")
+    host2 = self.addHost('host2', mac='00:00:00:00:00:06', ip='10.2.7.20/24', defaultRoute="host2-eth0")
     # Other hosts
-    trusted_host = self.addHost('h_trust', mac='00.00.00.00.00.07', ip='104.24.32.100/24', defaultRoute="h_trust-eth0")
-    untrusted_host = self.addHost('h_untrust', mac='00.00.00.00.00.08', ip='108.44.83.103/24', defaultRoute="h_untrust-eth0")
+    trusted_host = self.addHost('h_trust', mac='00:00:00:00:00:07', ip='104.24.32.100/24', defaultRoute="h_trust-eth0")
+    untrusted_host = self.addHost('h_untrust', mac='00:00:00:00:00:08', ip='108.44.83.103/24', defaultRoute="h_untrust-eth0")
     # Air-gapped floor secure clients
     numSecureClients = self.defineSecureClients('40.2.5.0/29')
 
@@ -135,8 +137,28 @@ class final_topo(Topo):
     
     print "Network Initialized"
 
-def configure():
-  topo = final_topo()
+class campus_topo(Topo):
+
+  # Builds the network of a final_campus.CampusPlan. Switch sN is dpid N.
+  def build(self, plan):
+    for dpid in plan.switches:
+      self.addSwitch("s" + str(dpid))
+    for dpid1, port1, dpid2, port2 in plan.links:
+      self.addLink("s" + str(dpid1), "s" + str(dpid2), port1=port1, port2=port2)
+    for host in plan.hosts:
+      self.addHost(host.name, mac=host.mac, ip=host.ip + "/" + str(host.length),
+                   defaultRoute=host.name + "-eth0")
+      self.addLink("s" + str(host.dpid), host.name, port1=host.port, port2=0)
+    print "Campus Initialized: %d switches, %d hosts" % (len(plan.switches),
+                                                       len(plan.hosts))
+
+# With final_campus.py options (--floors=<n> --switches=<n> --hosts=<n> ...) starts a
+# generated campus instead of the final project network
+def configure(args = ()):
+  if args:
+    topo = campus_topo(final_campus.generateCampus(**final_campus.campusOptions(args)))
+  else:
+    topo = final_topo()
   #net = Mininet(topo=topo)
   net = Mininet(topo=topo, controller=RemoteController)
   net.start()
@@ -147,4 +169,4 @@ def configure():
 
 
 if __name__ == '__main__':
-  configure()
+  configure(sys.argv[1:])